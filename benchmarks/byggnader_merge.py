@@ -0,0 +1,95 @@
+"""Compares the merge of multi-part buildings in ByggnaderLoader with the previous dissolve based implementation.
+
+Checks that both give the same result on synthetic data before timing them, e.g.
+
+    python benchmarks/byggnader_merge.py --rows 200000 --duplicated 0.1
+"""
+import argparse
+import time
+from typing import Any
+
+import numpy as np
+import pandas as pd
+import shapely
+from geopandas import GeoDataFrame
+from pandas.testing import assert_frame_equal
+
+from reality_synchronization.sources.lantmateriet.stac import ByggnaderLoader
+
+
+def _none_if_different(series: pd.Series) -> Any:
+    if series.nunique() > 1:
+        return None
+    return series.iloc[0]
+
+
+def legacy_postprocess(df: GeoDataFrame) -> GeoDataFrame:
+    duplicates = df.duplicated(subset=["objektidentitet"], keep=False)
+    non_duplicated = df[~duplicates].set_index("objektidentitet")
+    duplicated = df[duplicates].dissolve(by="objektidentitet", aggfunc=_none_if_different, as_index=True, sort=False)
+    df = pd.concat([non_duplicated, duplicated])
+
+    df.huvudbyggnad = df.huvudbyggnad == "Ja"
+    df.husnummer = df.husnummer.astype("Int64")
+    return df
+
+
+def make_dataframe(rows: int, duplicated: float) -> GeoDataFrame:
+    # Buildings with up to four adjacent parts, whose attributes differ between the parts for some of the buildings
+    rng = np.random.default_rng(42)
+    buildings = int(rows * (1 - duplicated))
+    ids = np.concatenate([np.arange(buildings), rng.integers(0, max(int(buildings * duplicated), 1), rows - buildings)])
+    rng.shuffle(ids)
+    part = pd.Series(ids).groupby(ids).cumcount().to_numpy()
+    x = 300000 + (ids % 1000) * 100.0 + part * 10
+    y = 6100000 + (ids // 1000) * 100.0
+    attribute = rng.integers(0, 3, rows)
+    stable = ids % 7
+    return GeoDataFrame(
+        {
+            "objektidentitet": [f"{i:08x}-0000-0000-0000-000000000000" for i in ids],
+            "objektversion": stable + np.where(part == 0, 0, attribute == 0),
+            "versiongiltigfran": pd.Timestamp("2024-01-01") + pd.to_timedelta(stable, unit="D"),
+            "andamal1": np.array(["Bostad; Småhus friliggande", "Komplementbyggnad; Garage", "Industri"])[
+                np.where(attribute == 1, attribute, stable % 3)
+            ],
+            "andamal2": np.where(stable == 0, None, "Ekonomibyggnad"),
+            "husnummer": np.where(part == 0, stable, np.where(attribute == 2, np.nan, stable)),
+            "huvudbyggnad": np.where(stable > 3, "Ja", "Nej"),
+        },
+        geometry=shapely.box(x, y, x + 10, y + 10),
+        crs=3006,
+    )
+
+
+def check(expected: GeoDataFrame, actual: GeoDataFrame) -> None:
+    expected = expected.sort_index()
+    actual = actual.sort_index()
+    geometry = expected.geometry.name
+    assert_frame_equal(expected.drop(columns=geometry), actual.drop(columns=geometry))
+    assert expected.geometry.geom_equals(actual.geometry).all()
+
+
+def timed(postprocess, df: GeoDataFrame) -> tuple[GeoDataFrame, float]:
+    start = time.perf_counter()
+    result = postprocess(df.copy())
+    return result, time.perf_counter() - start
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--duplicated", type=float, default=0.1, help="Share of rows that are parts of another building")
+    args = parser.parse_args()
+
+    df = make_dataframe(args.rows, args.duplicated)
+    loader = ByggnaderLoader()
+    expected, legacy_elapsed = timed(legacy_postprocess, df)
+    actual, elapsed = timed(lambda df: loader._postprocess("byggnad", df), df)
+    check(expected, actual)
+    print(f"{'dissolve':>10}: {legacy_elapsed:8.2f} s")
+    print(f"{'vectorized':>10}: {elapsed:8.2f} s ({legacy_elapsed / elapsed:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
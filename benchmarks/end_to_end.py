@@ -0,0 +1,265 @@
+"""Synchronizes synthetic items from a local stand-in of the STAC API into a disposable PostGIS and reports the
+throughput and peak memory of every stage.
+
+Each stage (download, read and postprocess, write) is first run on its own so that its peak memory can be told apart,
+then the items are synchronized twice through the pipeline as in production: into empty tables and again into the
+populated ones. The results are written as JSON, and can be compared with those of another commit, e.g.
+
+    python benchmarks/end_to_end.py --rows 200000 --items 2
+    python benchmarks/end_to_end.py --rows 200000 --items 2 --compare benchmarks/results/<earlier>.json
+
+Requires Docker, unless --dsn points to an existing database, whose data schema is dropped between the runs. Memory
+is sampled from /proc, so the per-stage peaks are only available on Linux.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+from dataclasses import asdict, replace
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Iterator
+
+import psycopg
+from pandas import DataFrame
+from requests import Session
+
+from local_postgis import IMAGE, disposable_postgis, prepare
+from stand_in import StandIn
+from synthetic import COLLECTIONS, write_item
+from reality_synchronization.sources import get_loader
+from reality_synchronization.sync import SyncJob, SyncOptions, Synchronizer, _write_layer
+from reality_synchronization.util.load_remote_zip import Subset
+from reality_synchronization.util.pipeline import PipelineStats, peak_rss
+from reality_synchronization.util.stac import stac_client
+
+def _rss() -> int | None:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return None
+
+
+class PeakRss:
+    # Samples the resident set size while the block runs, as getrusage only knows the peak of the whole process
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.start: int | None = None
+        self.peak: int | None = None
+        self._stopped = threading.Event()
+
+    def _sample(self) -> None:
+        while not self._stopped.wait(self.interval):
+            rss = _rss()
+            if rss is not None:
+                self.peak = max(self.peak or 0, rss)
+
+    def __enter__(self) -> "PeakRss":
+        self.start = self.peak = _rss()
+        self._thread = threading.Thread(target=self._sample, name="rss", daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self._stopped.set()
+        self._thread.join()
+        rss = _rss()
+        if rss is not None:
+            self.peak = max(self.peak or 0, rss)
+
+    def as_dict(self) -> dict:
+        return dict(
+            peak_rss_bytes=self.peak,
+            peak_rss_increase_bytes=None if self.peak is None or self.start is None else self.peak - self.start,
+        )
+
+
+@contextmanager
+def measured(results: dict, name: str) -> Iterator[PipelineStats]:
+    # Records the wall time, peak memory and the stats of the stages run in the block under results[name]
+    stats = PipelineStats()
+    start = time.perf_counter()
+    with PeakRss() as rss:
+        yield stats
+    results[name] = dict(seconds=round(time.perf_counter() - start, 3), **rss.as_dict(), **stats.summary())
+
+
+def reset(dsn: str) -> None:
+    with psycopg.connect(dsn, autocommit=True) as connection:
+        connection.execute("DROP SCHEMA IF EXISTS data CASCADE")
+        connection.execute("DROP SCHEMA IF EXISTS temporary_data CASCADE")
+    prepare(dsn)
+
+
+def _rows(layers: list[tuple[str, DataFrame | list[DataFrame]]]) -> int:
+    return sum(len(data) if isinstance(data, DataFrame) else sum(map(len, data)) for _, data in layers)
+
+
+def run_stages(jobs: list[SyncJob], options: SyncOptions, dsn: str, results: dict) -> None:
+    # Runs the stages one after another for every item, holding the read layers in memory for the write
+    reset(dsn)
+    for job in jobs:
+        name = f"{job.item.collection_id}/{job.item.id}"
+        with ExitStack() as stack:
+            with measured(results, f"{name}/download") as stats:
+                with stats.stage("download"):
+                    file = stack.enter_context(
+                        job.loader.download(
+                            job.item,
+                            job.session,
+                            options.zip_mode,
+                            None,
+                            options.download_parts,
+                            lambda count, size: stats.add_bytes("download", count),
+                            options.subset,
+                        )
+                    )
+            with measured(results, f"{name}/read") as stats:
+                with stats.stage("read"):
+                    layers = [
+                        (layer, data if isinstance(data, DataFrame) else list(data))
+                        for layer, data in job.loader.read(file, options.batch_size, stats, options.subset)
+                    ]
+                stats.add_rows("read", _rows(layers))
+        with measured(results, f"{name}/write") as stats, psycopg.connect(dsn) as connection:
+            for layer, data in layers:
+                with stats.stage("write"):
+                    _write_layer(
+                        job.item, layer, data if isinstance(data, DataFrame) else iter(data), connection, options, stats
+                    )
+                    connection.commit()
+        del layers
+
+
+def run_pipeline(jobs: list[SyncJob], options: SyncOptions, dsn: str, results: dict, name: str) -> None:
+    start = time.perf_counter()
+    with PeakRss() as rss, Synchronizer(lambda: psycopg.connect(dsn), options) as synchronizer:
+        items = list(synchronizer.sync(jobs))
+    results[name] = dict(
+        seconds=round(time.perf_counter() - start, 3),
+        **rss.as_dict(),
+        **synchronizer.stats.summary(),
+        changes={item["item"]: item["changes"] for item in items},
+    )
+
+
+def _git(*args: str) -> str | None:
+    try:
+        return subprocess.run(["git", *args], check=True, capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(current: dict, baseline: dict) -> None:
+    # Prints the change in seconds and peak memory of every measurement found in both results
+    print(f"{'':40} {'seconds':>20} {'peak RSS MiB':>20}")
+    for name, values in current["results"].items():
+        previous = baseline["results"].get(name)
+        if previous is None:
+            continue
+        columns = []
+        for key, scale in (("seconds", 1), ("peak_rss_bytes", 1 << 20)):
+            if values.get(key) is None or previous.get(key) is None:
+                columns.append(f"{'':>20}")
+                continue
+            change = (values[key] - previous[key]) / previous[key] * 100 if previous[key] else 0.0
+            columns.append(f"{previous[key] / scale:8.1f} → {values[key] / scale:8.1f} {change:+5.0f}%")
+        print(f"{name:40} {' '.join(columns)}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--collections", nargs="+", choices=COLLECTIONS, default=list(COLLECTIONS))
+    parser.add_argument("--items", type=int, default=1, help="Items per collection")
+    parser.add_argument("--rows", type=int, default=100000, help="Rows per layer")
+    parser.add_argument("--duplicated", type=float, default=0.1, help="Share of rows that repeat an objektidentitet")
+    parser.add_argument("--vertices", type=int, default=8, help="Vertices per polygon")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--bandwidth", type=int, help="Bytes/s per connection served by the stand-in")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds before every response of the stand-in")
+    parser.add_argument("--zip-mode", default="vsizip", choices=["extract", "vsizip", "vsicurl"])
+    parser.add_argument("--batch-size", type=int)
+    parser.add_argument("--download-parts", type=int, default=4)
+    parser.add_argument("--write-concurrency", type=int, default=1)
+    parser.add_argument("--storage", default="table", choices=["table", "partition_merge", "partition_swap"])
+    parser.add_argument("--load", default="merge", choices=["merge", "swap", "auto"])
+    parser.add_argument("--spatial-index", default="gist", choices=["gist", "spgist", "brin", "none"])
+    parser.add_argument("--bbox", type=float, nargs=4, help="Only load features in this SWEREF 99 TM bbox")
+    parser.add_argument("--columns", nargs="+", help="Only load these columns")
+    parser.add_argument("--layers", nargs="+", help="Only load these layers")
+    parser.add_argument("--skip-stages", action="store_true", help="Only run the pipeline")
+    parser.add_argument("--dsn", default=os.environ.get("BENCHMARK_DSN"), help="Use this database instead of Docker")
+    parser.add_argument("--image", default=IMAGE)
+    parser.add_argument("--data", type=Path, default=Path(tempfile.gettempdir()) / "reality-synchronization-benchmark")
+    parser.add_argument("--output", type=Path, default=Path(__file__).parent / "results")
+    parser.add_argument("--compare", type=Path, help="Results of an earlier run to compare with")
+    args = parser.parse_args()
+
+    options = SyncOptions(
+        zip_mode=args.zip_mode,
+        batch_size=args.batch_size,
+        download_parts=args.download_parts,
+        write_concurrency=args.write_concurrency,
+        storage=args.storage,
+        load=args.load,
+        spatial_index=args.spatial_index,
+        subset=Subset.from_params(args.bbox, "EPSG:3006", args.columns, args.layers),
+    )
+    # Generated files are reused by later runs with the same parameters
+    data = args.data / f"{args.rows}-{args.duplicated}-{args.vertices}-{args.seed}"
+    items = [
+        write_item(data, collection, f"{idx:04d}", args.rows, args.duplicated, args.vertices, args.seed)
+        for collection in args.collections
+        for idx in range(args.items)
+    ]
+
+    results: dict = {}
+    with ExitStack() as stack:
+        stand_in = stack.enter_context(StandIn(items, bandwidth=args.bandwidth, latency=args.latency))
+        dsn = args.dsn or stack.enter_context(disposable_postgis(args.image))
+        client = stac_client(f"{stand_in.url}/")
+        session = stack.enter_context(Session())
+        jobs = [
+            SyncJob(get_loader(collection), item, session)
+            for collection in args.collections
+            for item in client.get_collection(collection).get_items()
+        ]
+        if not args.skip_stages:
+            run_stages(jobs, replace(options, download_prefetch=0), dsn, results)
+        reset(dsn)
+        run_pipeline(jobs, options, dsn, results, "pipeline/initial")
+        run_pipeline(jobs, options, dsn, results, "pipeline/update")
+
+    output = dict(
+        commit=_git("rev-parse", "HEAD"),
+        dirty=bool(_git("status", "--porcelain", "--untracked-files=no")),
+        created=datetime.now(timezone.utc).isoformat(),
+        python=sys.version.split()[0],
+        platform=platform.platform(),
+        cpus=os.cpu_count(),
+        parameters={key: str(value) if isinstance(value, Path) else value for key, value in vars(args).items()},
+        options=asdict(options),
+        items={f"{item.collection}/{item.id}": dict(bytes=item.path.stat().st_size, rows=item.rows) for item in items},
+        process_peak_rss_bytes=peak_rss(),
+        results=results,
+    )
+    args.output.mkdir(parents=True, exist_ok=True)
+    path = args.output / f"{datetime.now():%Y%m%d-%H%M%S}-{(output['commit'] or 'unknown')[:8]}.json"
+    path.write_text(json.dumps(output, indent=2, default=str))
+    print(f"Results written to {path}")
+    for name, values in results.items():
+        print(f"{name:40} {values['seconds']:8.2f} s {(values['peak_rss_bytes'] or 0) / (1 << 20):8.0f} MiB")
+
+    if args.compare is not None:
+        compare(output, json.loads(args.compare.read_text()))
+
+
+if __name__ == "__main__":
+    main()
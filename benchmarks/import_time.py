@@ -0,0 +1,77 @@
+"""Measures how long importing the modules a job starts with takes, in a fresh interpreter for every run, e.g.
+
+    python benchmarks/import_time.py
+    python benchmarks/import_time.py reality_synchronization.sources --top 20 --json
+
+The total is the fastest of --repeat runs, and the slowest modules are listed from `python -X importtime` of that run
+(cumulative microseconds, including the modules they import).
+"""
+import argparse
+import json
+import subprocess
+import sys
+
+MODULES = [
+    "reality_synchronization.sources",
+    "reality_synchronization.windmill.tasks",
+    "reality_synchronization.windmill.tasks.plan_lantmateriet_stac",
+    "reality_synchronization.windmill.tasks.fetch_lantmateriet_stac",
+    "reality_synchronization.windmill.tasks.fetch_source",
+    "reality_synchronization.sinks.postgis",
+    "reality_synchronization.sources.lantmateriet.stac",
+    "reality_synchronization.sources.smhi.svar2022",
+]
+
+
+def _import_time(module: str) -> tuple[int, dict[str, int]]:
+    # Returns the cumulative microseconds of the module and of every module imported along the way
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"], capture_output=True, text=True
+    )
+    if process.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed: {process.stderr.strip().splitlines()[-1]}")
+    cumulative = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, total, name = (part.strip() for part in line.removeprefix("import time:").split("|"))
+        if total.isdigit():
+            cumulative[name.strip()] = int(total)
+    return cumulative.get(module, max(cumulative.values(), default=0)), cumulative
+
+
+def measure(module: str, repeat: int) -> dict:
+    runs = [_import_time(module) for _ in range(repeat)]
+    total, cumulative = min(runs, key=lambda run: run[0])
+    return dict(module=module, microseconds=total, runs=[run[0] for run in runs], modules=cumulative)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("modules", nargs="*", default=MODULES)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10, help="Slowest imported modules listed per module")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    args = parser.parse_args()
+
+    results = []
+    for module in args.modules:
+        try:
+            result = measure(module, args.repeat)
+        except RuntimeError as error:
+            print(error, file=sys.stderr)
+            continue
+        top = sorted(result.pop("modules").items(), key=lambda entry: entry[1], reverse=True)[1 : args.top + 1]
+        result["slowest"] = dict(top)
+        results.append(result)
+        if not args.json:
+            print(f"{module:70} {result['microseconds'] / 1000:8.1f} ms")
+            for name, microseconds in top:
+                print(f"    {name:66} {microseconds / 1000:8.1f} ms")
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""Compares rows/s of the staging engines of write_postgis, writing a new table with each.
+
+Requires a PostGIS database, e.g.
+
+    BENCHMARK_DSN=postgresql://postgres@localhost/postgres python benchmarks/staging.py --rows 200000
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import psycopg
+import shapely
+from geopandas import GeoDataFrame
+from psycopg import sql
+
+from reality_synchronization.options import StagingEngine
+from reality_synchronization.sinks.postgis import write_postgis
+from reality_synchronization.util.pipeline import PipelineStats
+
+
+def make_dataframe(rows: int) -> GeoDataFrame:
+    rng = np.random.default_rng(42)
+    x = rng.uniform(300000, 900000, rows)
+    y = rng.uniform(6100000, 7700000, rows)
+    geometry = shapely.box(x, y, x + rng.uniform(5, 50, rows), y + rng.uniform(5, 50, rows))
+    df = GeoDataFrame(
+        {
+            "objektidentitet": [f"{i:08x}-0000-0000-0000-000000000000" for i in range(rows)],
+            "objektversion": rng.integers(1, 10, rows),
+            "versiongiltigfran": pd.Timestamp("2024-01-01") + pd.to_timedelta(rng.integers(0, 365, rows), unit="D"),
+            "andamal1": rng.choice(["Bostad; Småhus friliggande", "Komplementbyggnad; Garage", "Industri"], rows),
+            "husnummer": pd.array(rng.integers(0, 20, rows), dtype="Int64"),
+            "huvudbyggnad": rng.random(rows) > 0.5,
+        },
+        geometry=geometry,
+        crs=3006,
+    )
+    return df.set_index("objektidentitet")
+
+
+def run(engine: StagingEngine, df: GeoDataFrame, connection: psycopg.Connection, schema: str) -> tuple[float, float]:
+    # Seconds spent staging and writing in total
+    stats = PipelineStats()
+    start = time.perf_counter()
+    # Unlogged, as the sqlalchemy engine cannot stage into temporary tables
+    write_postgis(
+        f"benchmark_staging_{engine}",
+        schema,
+        schema,
+        df,
+        connection,
+        staging_engine=engine,
+        staging_table="unlogged",
+        stats=stats,
+    )
+    connection.commit()
+    return stats.seconds["write.staging"], time.perf_counter() - start
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--schema", default="public")
+    parser.add_argument("--dsn", default=os.environ.get("BENCHMARK_DSN"))
+    args = parser.parse_args()
+
+    df = make_dataframe(args.rows)
+    with psycopg.connect(args.dsn) as connection:
+        for engine in ("sqlalchemy", "copy"):
+            staging, total = run(engine, df, connection, args.schema)
+            print(
+                f"{engine:>10}: staging {staging:8.2f} s {args.rows / staging:12.0f} rows/s,"
+                f" total {total:8.2f} s {args.rows / total:12.0f} rows/s"
+            )
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    sql.SQL("DROP TABLE {}").format(sql.Identifier(args.schema, f"benchmark_staging_{engine}"))
+                )
+            connection.commit()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,325 @@
+"""Serves synthetic items through a minimal STAC API and their archives with range requests, in place of Lantmäteriet.
+
+Bandwidth and latency can be limited to get closer to downloading from the real API, e.g.
+
+    python benchmarks/stand_in.py /tmp/synthetic --port 8000 --bandwidth 50000000 --latency 0.02
+"""
+import argparse
+import hashlib
+import json
+import re
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any
+from urllib.parse import parse_qs, urlparse
+
+from synthetic import LAYERS, SyntheticItem
+
+_CONFORMANCE = [
+    "https://api.stacspec.org/v1.0.0/core",
+    "https://api.stacspec.org/v1.0.0/collections",
+    "https://api.stacspec.org/v1.0.0/ogcapi-features",
+    "https://api.stacspec.org/v1.0.0/item-search",
+    "http://www.opengis.net/spec/ogcapi-features-1/1.0/conf/core",
+    "http://www.opengis.net/spec/ogcapi-features-1/1.0/conf/geojson",
+]
+_FILE_EXTENSION = "https://stac-extensions.github.io/file/v2.1.0/schema.json"
+_CHUNK_SIZE = 1 << 16
+
+
+class StandIn:
+    def __init__(
+        self,
+        items: list[SyntheticItem],
+        host: str = "127.0.0.1",
+        port: int = 0,
+        bandwidth: int | None = None,
+        latency: float = 0.0,
+        page_size: int = 100,
+    ):
+        # bandwidth in bytes/s per connection, latency in seconds before every response
+        self.items = {(item.collection, item.id): item for item in items}
+        self.bandwidth = bandwidth
+        self.latency = latency
+        self.page_size = page_size
+        self._checksums = {key: item.checksum for key, item in self.items.items()}
+        self._server = ThreadingHTTPServer((host, port), _Handler)
+        self._server.daemon_threads = True
+        self._server.stand_in = self
+        self._thread: threading.Thread | None = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def collections(self) -> list[str]:
+        return sorted({collection for collection, _ in self.items})
+
+    def collection_json(self, collection: str) -> dict[str, Any]:
+        bboxes = [item.bbox for (c, _), item in self.items.items() if c == collection]
+        return {
+            "type": "Collection",
+            "stac_version": "1.0.0",
+            "id": collection,
+            "description": f"Synthetic {collection}",
+            "license": "proprietary",
+            "extent": {
+                "spatial": {
+                    "bbox": [
+                        [
+                            min(b[0] for b in bboxes),
+                            min(b[1] for b in bboxes),
+                            max(b[2] for b in bboxes),
+                            max(b[3] for b in bboxes),
+                        ]
+                    ]
+                },
+                "temporal": {"interval": [[None, None]]},
+            },
+            "summaries": {"layers": list(LAYERS[collection])},
+            "links": [
+                {"rel": "self", "href": f"{self.url}/collections/{collection}", "type": "application/json"},
+                {"rel": "root", "href": f"{self.url}/", "type": "application/json"},
+                {"rel": "parent", "href": f"{self.url}/", "type": "application/json"},
+                {"rel": "items", "href": f"{self.url}/collections/{collection}/items", "type": "application/geo+json"},
+            ],
+        }
+
+    def item_json(self, item: SyntheticItem) -> dict[str, Any]:
+        # Bbox and geometry are in SWEREF 99 TM rather than WGS 84, which does not matter to the synchronization
+        x0, y0, x1, y1 = item.bbox
+        collection = f"{self.url}/collections/{item.collection}"
+        return {
+            "type": "Feature",
+            "stac_version": "1.0.0",
+            "stac_extensions": [_FILE_EXTENSION],
+            "id": item.id,
+            "collection": item.collection,
+            "bbox": [x0, y0, x1, y1],
+            "geometry": {"type": "Polygon", "coordinates": [[[x0, y0], [x1, y0], [x1, y1], [x0, y1], [x0, y0]]]},
+            "properties": {"datetime": item.updated.isoformat(), "updated": item.updated.isoformat()},
+            "links": [
+                {"rel": "self", "href": f"{collection}/items/{item.id}", "type": "application/geo+json"},
+                {"rel": "collection", "href": collection, "type": "application/json"},
+                {"rel": "parent", "href": collection, "type": "application/json"},
+                {"rel": "root", "href": f"{self.url}/", "type": "application/json"},
+            ],
+            "assets": {
+                "data": {
+                    "href": f"{self.url}/data/{item.collection}/{item.id}.zip",
+                    "type": "application/zip",
+                    "roles": ["data"],
+                    "file:size": item.path.stat().st_size,
+                    "file:checksum": self._checksums[(item.collection, item.id)],
+                }
+            },
+        }
+
+    def landing_json(self) -> dict[str, Any]:
+        return {
+            "type": "Catalog",
+            "stac_version": "1.0.0",
+            "id": "stand-in",
+            "description": "Synthetic Lantmäteriet items",
+            "conformsTo": _CONFORMANCE,
+            "links": [
+                {"rel": "self", "href": f"{self.url}/", "type": "application/json"},
+                {"rel": "root", "href": f"{self.url}/", "type": "application/json"},
+                {"rel": "conformance", "href": f"{self.url}/conformance", "type": "application/json"},
+                {"rel": "data", "href": f"{self.url}/collections", "type": "application/json"},
+                {"rel": "search", "href": f"{self.url}/search", "type": "application/geo+json", "method": "GET"},
+                {"rel": "search", "href": f"{self.url}/search", "type": "application/geo+json", "method": "POST"},
+                *[
+                    {"rel": "child", "href": f"{self.url}/collections/{c}", "type": "application/json"}
+                    for c in self.collections()
+                ],
+            ],
+        }
+
+    def search(
+        self, collections: list[str] | None, ids: list[str] | None, limit: int | None, offset: int
+    ) -> tuple[list[dict[str, Any]], bool]:
+        matches = [
+            item
+            for (collection, item_id), item in sorted(self.items.items())
+            if (not collections or collection in collections) and (not ids or item_id in ids)
+        ]
+        limit = min(limit or self.page_size, self.page_size)
+        page = matches[offset : offset + limit]
+        return [self.item_json(item) for item in page], offset + limit < len(matches)
+
+    def __enter__(self) -> "StandIn":
+        self._thread = threading.Thread(target=self._server.serve_forever, name="stand-in", daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: ThreadingHTTPServer
+
+    @property
+    def stand_in(self) -> StandIn:
+        return self.server.stand_in
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+    def _json(self, body: Any, status: int = 200) -> None:
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(data)
+
+    def _not_found(self) -> None:
+        self._json({"code": "NotFound", "description": self.path}, 404)
+
+    def _page(self, features: list[dict[str, Any]], more: bool, next_link: dict[str, Any]) -> None:
+        self._json(
+            {
+                "type": "FeatureCollection",
+                "features": features,
+                "links": [next_link] if more else [],
+            }
+        )
+
+    def _search(self, query: dict[str, Any], method: str) -> None:
+        collections = query.get("collections")
+        ids = query.get("ids")
+        if isinstance(collections, str):
+            collections = collections.split(",")
+        if isinstance(ids, str):
+            ids = ids.split(",")
+        limit = int(query["limit"]) if query.get("limit") else None
+        offset = int(query.get("offset") or 0)
+        features, more = self.stand_in.search(collections, ids, limit, offset)
+        following = {**query, "offset": offset + len(features)}
+        if method == "POST":
+            next_link = {"rel": "next", "href": f"{self.stand_in.url}/search", "method": "POST", "body": following}
+        else:
+            parameters = "&".join(
+                f"{key}={','.join(value) if isinstance(value, list) else value}" for key, value in following.items()
+            )
+            next_link = {"rel": "next", "href": f"{self.stand_in.url}/search?{parameters}", "method": "GET"}
+        self._page(features, more, next_link)
+
+    def _file(self, item: SyntheticItem) -> None:
+        size = item.path.stat().st_size
+        etag = '"' + hashlib.sha1(f"{item.path}:{item.path.stat().st_mtime_ns}".encode()).hexdigest() + '"'
+        start, end = 0, size - 1
+        match = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            if start >= size:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", "application/zip")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", etag)
+        self.end_headers()
+        if self.command == "HEAD":
+            return
+        bandwidth = self.stand_in.bandwidth
+        begun = time.perf_counter()
+        sent = 0
+        with open(item.path, "rb") as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = f.read(min(_CHUNK_SIZE, remaining))
+                try:
+                    self.wfile.write(chunk)
+                except (BrokenPipeError, ConnectionResetError):
+                    return
+                remaining -= len(chunk)
+                sent += len(chunk)
+                if bandwidth:
+                    ahead = sent / bandwidth - (time.perf_counter() - begun)
+                    if ahead > 0:
+                        time.sleep(ahead)
+
+    def _route(self, body: dict[str, Any] | None = None) -> None:
+        if self.stand_in.latency:
+            time.sleep(self.stand_in.latency)
+        url = urlparse(self.path)
+        parts = [part for part in url.path.split("/") if part]
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        if not parts:
+            return self._json(self.stand_in.landing_json())
+        if parts == ["conformance"]:
+            return self._json({"conformsTo": _CONFORMANCE})
+        if parts == ["search"]:
+            return self._search(body if body is not None else query, self.command)
+        if parts == ["collections"]:
+            return self._json(
+                {
+                    "collections": [self.stand_in.collection_json(c) for c in self.stand_in.collections()],
+                    "links": [],
+                }
+            )
+        if parts[0] == "collections" and len(parts) >= 2 and parts[1] in self.stand_in.collections():
+            collection = parts[1]
+            if len(parts) == 2:
+                return self._json(self.stand_in.collection_json(collection))
+            if len(parts) == 3 and parts[2] == "items":
+                return self._search({**query, "collections": collection}, "GET")
+            if len(parts) == 4 and parts[2] == "items" and (collection, parts[3]) in self.stand_in.items:
+                return self._json(self.stand_in.item_json(self.stand_in.items[(collection, parts[3])]))
+        if parts[0] == "data" and len(parts) == 3 and parts[2].endswith(".zip"):
+            item = self.stand_in.items.get((parts[1], parts[2].removesuffix(".zip")))
+            if item is not None:
+                return self._file(item)
+        self._not_found()
+
+    def do_GET(self) -> None:
+        self._route()
+
+    def do_HEAD(self) -> None:
+        self._route()
+
+    def do_POST(self) -> None:
+        length = int(self.headers.get("Content-Length") or 0)
+        self._route(json.loads(self.rfile.read(length) or b"{}"))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("directory", type=Path, help="Directory written by synthetic.py")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--bandwidth", type=int, help="Bytes/s per connection")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds before every response")
+    args = parser.parse_args()
+
+    # The extents are not known without reading the archives, and do not matter to the synchronization
+    updated = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    items = [
+        SyntheticItem(path.parent.name, path.stem, path, (0.0, 0.0, 1.0, 1.0), {}, updated)
+        for path in sorted(args.directory.glob("*/*.zip"))
+    ]
+    with StandIn(items, port=args.port, bandwidth=args.bandwidth, latency=args.latency) as stand_in:
+        print(f"Serving {len(items)} items at {stand_in.url}/")
+        threading.Event().wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+"""Generates zipped GeoPackages shaped like Lantmäteriet's fastighetsindelning and byggnader items.
+
+Row counts, the share of duplicated rows and the number of vertices per polygon are configurable, and the same seed
+always gives the same files, e.g.
+
+    python benchmarks/synthetic.py /tmp/synthetic --items 2 --rows 200000 --duplicated 0.1 --vertices 16
+"""
+import argparse
+import hashlib
+import tempfile
+import uuid
+import zipfile
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import shapely
+from geopandas import GeoDataFrame
+from pyogrio import write_dataframe
+
+COLLECTIONS = ("fastighetsindelning", "byggnader")
+LAYERS = {
+    "byggnader": ("byggnad",),
+    "fastighetsindelning": ("registerenhetsomradesyta", "registerenhetsomradesgrans", "granspunkt"),
+}
+
+Bbox = tuple[float, float, float, float]
+
+# Every item covers a square of this many metres in SWEREF 99 TM
+_ITEM_SIZE = 50000.0
+
+
+@dataclass
+class SyntheticItem:
+    collection: str
+    id: str
+    path: Path
+    bbox: Bbox
+    rows: dict[str, int]
+    updated: datetime
+
+    @property
+    def checksum(self) -> str:
+        # A multihash of the SHA-256 of the file, as in file:checksum
+        digest = hashlib.sha256()
+        with open(self.path, "rb") as f:
+            while chunk := f.read(1 << 20):
+                digest.update(chunk)
+        return "1220" + digest.hexdigest()
+
+
+def _ids(rng: np.random.Generator, count: int) -> np.ndarray:
+    return np.array([str(uuid.UUID(bytes=rng.bytes(16), version=4)) for _ in range(count)])
+
+
+def _origins(rng: np.random.Generator, bbox: Bbox, count: int) -> tuple[np.ndarray, np.ndarray]:
+    return rng.uniform(bbox[0], bbox[2], count), rng.uniform(bbox[1], bbox[3], count)
+
+
+def _polygons(x: np.ndarray, y: np.ndarray, radius: np.ndarray, vertices: int, rng: np.random.Generator) -> np.ndarray:
+    # Star-shaped polygons with the given number of vertices, so that the geometry complexity can be scaled
+    angles = np.linspace(0, 2 * np.pi, vertices, endpoint=False)
+    jitter = rng.uniform(0.6, 1.0, (len(x), vertices))
+    xs = x[:, None] + radius[:, None] * jitter * np.cos(angles)
+    ys = y[:, None] + radius[:, None] * jitter * np.sin(angles)
+    rings = np.stack([xs, ys], axis=-1)
+    rings = np.concatenate([rings, rings[:, :1]], axis=1)
+    return shapely.polygons(rings)
+
+
+def _versions(rng: np.random.Generator, count: int) -> dict[str, object]:
+    return {
+        "objektversion": rng.integers(1, 10, count),
+        "versiongiltigfran": (
+            pd.Timestamp("2020-01-01", tz="UTC") + pd.to_timedelta(rng.integers(0, 1500, count), unit="D")
+        ).to_numpy(),
+    }
+
+
+def byggnader(rows: int, duplicated: float, vertices: int, bbox: Bbox, seed: int) -> dict[str, GeoDataFrame]:
+    # A share of the rows are further parts of another building, with the same objektidentitet and partly different
+    # attributes, which ByggnaderLoader merges
+    rng = np.random.default_rng(seed)
+    buildings = max(int(rows * (1 - duplicated)), 1)
+    ids = _ids(rng, buildings)
+    owner = np.concatenate([np.arange(buildings), rng.integers(0, buildings, rows - buildings)])
+    x, y = _origins(rng, bbox, buildings)
+    part = pd.Series(owner).groupby(owner).cumcount().to_numpy()
+    differs = rng.random(rows) < 0.3
+    versions = _versions(rng, buildings)
+    return {
+        "byggnad": GeoDataFrame(
+            {
+                "objektidentitet": ids[owner],
+                "objektversion": versions["objektversion"][owner],
+                "versiongiltigfran": versions["versiongiltigfran"][owner],
+                "andamal1": rng.choice(
+                    [
+                        "Bostad; Småhus friliggande",
+                        "Komplementbyggnad; Garage",
+                        "Industri; Lager",
+                        "Samhällsfunktion; Skola",
+                    ],
+                    rows,
+                ),
+                "andamal2": np.where(rng.random(rows) < 0.8, None, "Komplementbyggnad; Förråd"),
+                "husnummer": np.where(differs & (part > 0), np.nan, (owner % 5).astype(float)),
+                "huvudbyggnad": np.where(owner % 3 == 0, "Nej", "Ja"),
+                "objekttyp": rng.choice(["Bostad", "Industri", "Verksamhet", "Ekonomibyggnad"], rows),
+            },
+            geometry=_polygons(x[owner] + part * 12.0, y[owner], rng.uniform(4, 15, rows), vertices, rng),
+            crs=3006,
+        )
+    }
+
+
+def fastighetsindelning(rows: int, duplicated: float, vertices: int, bbox: Bbox, seed: int) -> dict[str, GeoDataFrame]:
+    # Parcels, their boundaries and points on the boundaries. A share of the points occur more than once with the same
+    # objektidentitet, which is deduplicated when writing.
+    rng = np.random.default_rng(seed)
+    x, y = _origins(rng, bbox, rows)
+    polygons = _polygons(x, y, rng.uniform(20, 200, rows), vertices, rng)
+    parcels = {
+        "objektidentitet": _ids(rng, rows),
+        **_versions(rng, rows),
+        "kommunkod": np.full(rows, "0000"),
+        "registeromrade": rng.choice(["Uppsala", "Knivsta", "Enköping", "Heby"], rows),
+        "trakt": rng.choice(["Kungsängen", "Luthagen", "Berthåga", "Sunnersta"], rows),
+        "block": rng.integers(1, 60, rows).astype(str),
+        "enhet": rng.integers(1, 400, rows),
+    }
+    yta = GeoDataFrame({**parcels, "ytklass": rng.choice(["Huvudyta", "Skifte"], rows)}, geometry=polygons, crs=3006)
+    grans = GeoDataFrame(
+        {
+            "objektidentitet": _ids(rng, rows),
+            **_versions(rng, rows),
+            "gransart": rng.choice(["Fastighetsgräns", "Administrativ gräns"], rows),
+        },
+        geometry=shapely.boundary(polygons),
+        crs=3006,
+    )
+    points = max(int(rows * (1 - duplicated)), 1)
+    source = np.concatenate([np.arange(points), rng.integers(0, points, rows - points)])
+    coordinates = shapely.get_coordinates(shapely.boundary(polygons[:points]))
+    chosen = rng.integers(0, len(coordinates), points)
+    punkt = GeoDataFrame(
+        {
+            "objektidentitet": _ids(rng, points)[source],
+            "objektversion": _versions(rng, points)["objektversion"][source],
+            "punkttyp": rng.choice(["Gränsröse", "Rör i mark", "Ospecificerad"], points)[source],
+        },
+        geometry=shapely.points(coordinates[chosen][source]),
+        crs=3006,
+    )
+    return {"registerenhetsomradesyta": yta, "registerenhetsomradesgrans": grans, "granspunkt": punkt}
+
+
+_GENERATORS = {"byggnader": byggnader, "fastighetsindelning": fastighetsindelning}
+
+
+def write_item(
+    directory: Path,
+    collection: str,
+    item_id: str,
+    rows: int,
+    duplicated: float = 0.1,
+    vertices: int = 8,
+    seed: int = 42,
+) -> SyntheticItem:
+    # Writes {directory}/{collection}/{item_id}.zip holding one GeoPackage. An existing file is kept, so the directory
+    # has to be specific to the other arguments.
+    index = int(hashlib.sha1(f"{collection}/{item_id}".encode()).hexdigest()[:4], 16)
+    x = 300000 + (index % 10) * _ITEM_SIZE
+    y = 6200000 + (index // 10 % 30) * _ITEM_SIZE
+    bbox = (x, y, x + _ITEM_SIZE, y + _ITEM_SIZE)
+    path = directory / collection / f"{item_id}.zip"
+    if not path.exists():
+        layers = _GENERATORS[collection](rows, duplicated, vertices, bbox, seed + index)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            gpkg = Path(tmpdirname) / f"{collection}_{item_id}.gpkg"
+            for layer, df in layers.items():
+                write_dataframe(df, gpkg, layer=layer, driver="GPKG")
+            partial = path.with_suffix(".partial")
+            with zipfile.ZipFile(partial, "w", compression=zipfile.ZIP_DEFLATED) as zip_ref:
+                zip_ref.write(gpkg, gpkg.name)
+            partial.replace(path)
+    return SyntheticItem(
+        collection,
+        item_id,
+        path,
+        bbox,
+        {layer: rows for layer in LAYERS[collection]},
+        datetime(2025, 1, 1, tzinfo=timezone.utc),
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("directory", type=Path)
+    parser.add_argument("--collections", nargs="+", choices=COLLECTIONS, default=list(COLLECTIONS))
+    parser.add_argument("--items", type=int, default=1)
+    parser.add_argument("--rows", type=int, default=100000, help="Rows per layer")
+    parser.add_argument("--duplicated", type=float, default=0.1, help="Share of rows that repeat an objektidentitet")
+    parser.add_argument("--vertices", type=int, default=8, help="Vertices per polygon")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    for collection in args.collections:
+        for idx in range(args.items):
+            item = write_item(
+                args.directory, collection, f"{idx:04d}", args.rows, args.duplicated, args.vertices, args.seed
+            )
+            print(f"{item.path}: {item.path.stat().st_size} bytes, {item.rows}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,128 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+
 import requests
 from oauthlib.oauth2 import BackendApplicationClient
 from requests_oauthlib import OAuth2Session
 
+logger = logging.getLogger(__name__)
+
+# Tokens are renewed this many seconds before they expire, so that a request is never sent with an expiring token
+TOKEN_EXPIRY_MARGIN = 120.0
+
+
+class TokenCache:
+    # Shares tokens between sessions, by default only within the process
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tokens: dict[str, dict] = {}
+
+    def get(self, key: str) -> dict | None:
+        with self._lock:
+            return self._tokens.get(key)
+
+    def put(self, key: str, token: dict) -> None:
+        with self._lock:
+            self._tokens[key] = token
+
+
+class FileTokenCache(TokenCache):
+    # Also keeps the tokens in a file, so that they are shared with later processes on the same machine
+    def __init__(self, path: str | Path = Path(tempfile.gettempdir()) / "reality-synchronization-tokens.json"):
+        super().__init__()
+        self.path = Path(path)
+
+    def _read(self) -> dict[str, dict]:
+        try:
+            return json.loads(self.path.read_text())
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def get(self, key: str) -> dict | None:
+        token = super().get(key)
+        if token is None:
+            token = self._read().get(key)
+        return token
+
+    def put(self, key: str, token: dict) -> None:
+        super().put(key, token)
+        with self._lock:
+            now = time.time()
+            tokens = {k: t for k, t in self._read().items() if t.get("expires_at", 0) > now}
+            tokens[key] = token
+            tmp = self.path.with_suffix(f".{os.getpid()}.tmp")
+            with open(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as f:
+                json.dump(tokens, f)
+            tmp.replace(self.path)
+
+
+_token_cache = TokenCache()
+
+
+class OAuth2ClientCredentialsSession(requests.Session):
+    # Sends a valid token with every request, fetching a new one when the current one is about to expire or has been
+    # rejected. Client credentials tokens cannot be refreshed, so renewing means fetching a new token.
+    def __init__(
+        self,
+        client_id: str,
+        client_secret: str,
+        scope: str | None,
+        token_url: str,
+        token_cache: TokenCache | None = None,
+    ):
+        super().__init__()
+        self._client_id = client_id
+        self._client_secret = client_secret
+        self._scope = scope
+        self._token_url = token_url
+        self._token_cache = token_cache or _token_cache
+        self._cache_key = f"{token_url} {client_id} {scope or ''}"
+        self._token_lock = threading.Lock()
+
+    def _fetch_token(self) -> dict:
+        logger.info("Fetching token for %s", self._client_id)
+        oauth = OAuth2Session(client=BackendApplicationClient(client_id=self._client_id), scope=self._scope)
+        token = dict(
+            oauth.fetch_token(self._token_url, client_id=self._client_id, client_secret=self._client_secret)
+        )
+        token.setdefault("expires_at", time.time() + float(token.get("expires_in", 3600)))
+        return token
+
+    def token(self, renew: bool = False) -> dict:
+        with self._token_lock:
+            token = None if renew else self._token_cache.get(self._cache_key)
+            if token is None or token["expires_at"] - TOKEN_EXPIRY_MARGIN <= time.time():
+                token = self._fetch_token()
+                self._token_cache.put(self._cache_key, token)
+            self.headers["Authorization"] = "Bearer " + token["access_token"]
+            return token
+
+    def prepare_request(self, request: requests.Request) -> requests.PreparedRequest:
+        self.token()
+        return super().prepare_request(request)
+
+    def request(self, method, url, *args, **kwargs) -> requests.Response:
+        response = super().request(method, url, *args, **kwargs)
+        if response.status_code == 401:
+            logger.info("Token was rejected, fetching a new one")
+            response.close()
+            self.token(renew=True)
+            response = super().request(method, url, *args, **kwargs)
+        return response
+
 
 def make_oauth2_session(
     client_id: str,
     client_secret: str,
     scope: str | None,
     token_url: str = "https://apimanager.lantmateriet.se/oauth2/token",
-):
-    client = BackendApplicationClient(client_id=client_id)
-    oauth = OAuth2Session(client=client, scope=scope)
-    token = oauth.fetch_token(
-        token_url, client_id=client_id, client_secret=client_secret
-    )
-    session = requests.Session()
-    session.headers.update({"Authorization": "Bearer " + token["access_token"]})
+    token_cache: TokenCache | None = None,
+) -> OAuth2ClientCredentialsSession:
+    session = OAuth2ClientCredentialsSession(client_id, client_secret, scope, token_url, token_cache)
+    session.token()
     return session
@@ -0,0 +1,25 @@
+from typing import Literal
+
+# Kept free of heavy imports, so that the tasks can use these as parameter types without importing pandas, GDAL and
+# psycopg before they start
+
+# extract: download, extract and read the extracted copy (the original behaviour)
+# vsizip: download and read the dataset directly from the zip through GDAL's /vsizip/
+# vsicurl: read the dataset with range requests through /vsizip//vsicurl/ without downloading the whole archive, falls
+#          back to vsizip when the server does not support range requests
+ZipMode = Literal["extract", "vsizip", "vsicurl"]
+
+StagingEngine = Literal["copy", "sqlalchemy"]
+StagingTable = Literal["temporary", "unlogged", "logged"]
+# table: one table for all subdivisions
+# partition_merge: LIST partitioned by subdivision, MERGEing into the subdivision's partition
+# partition_swap: LIST partitioned by subdivision, replacing the subdivision's partition with a freshly loaded table.
+#                 Dropping the old partition locks the whole parent until commit, which with atomic is the end of the
+#                 item, so prefer partition_merge there
+Storage = Literal["table", "partition_merge", "partition_swap"]
+# How an existing table holding only the written subdivision is updated. merge: MERGE the changed rows, swap: build a
+# new table and swap it in, auto: swap when the estimated share of changed rows exceeds SWAP_CHANGE_RATIO of
+# reality_synchronization.sinks.postgis
+LoadStrategy = Literal["merge", "swap", "auto"]
+# Access method of the indexes built on geometry columns, or none to not build any
+SpatialIndex = Literal["gist", "spgist", "brin", "none"]
@@ -0,0 +1,98 @@
+import logging
+from datetime import datetime
+
+import psycopg
+from psycopg import sql
+
+logger = logging.getLogger(__name__)
+
+
+def create_metadata_table(schema: str, connection: psycopg.Connection) -> None:
+    logger.info("Creating metadata table")
+    with connection.cursor() as cursor:
+        cursor.execute(
+            sql.SQL(
+                """
+            CREATE TABLE IF NOT EXISTS {}.metadata (
+                "table" TEXT NOT NULL PRIMARY KEY,
+                collection TEXT NOT NULL,
+                "name" TEXT NOT NULL,
+                "provider" TEXT NOT NULL,
+                last_updated TIMESTAMP WITH TIME ZONE
+            )"""
+            ).format(sql.Identifier(schema))
+        )
+        cursor.execute(
+            sql.SQL(
+                """
+            CREATE TABLE IF NOT EXISTS {}.metadata_assets (
+                "table" TEXT NOT NULL REFERENCES {}.metadata ("table"),
+                item TEXT NOT NULL,
+                remote_updated TIMESTAMP WITH TIME ZONE,
+                PRIMARY KEY ("table", item)
+            )"""
+            ).format(sql.Identifier(schema), sql.Identifier(schema))
+        )
+    connection.commit()
+
+
+def upsert_metadata(
+    table: str,
+    collection: str,
+    name: str,
+    provider: str,
+    last_updated: datetime,
+    schema: str,
+    item: str | None,
+    connection: psycopg.Connection,
+    commit: bool = True,
+) -> None:
+    logger.info("Upserting metadata")
+    with connection.cursor() as cursor:
+        cursor.execute(
+            sql.SQL("""
+            INSERT INTO {}.metadata ("table", collection, "name", "provider", last_updated)
+            VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT ("table") DO UPDATE SET last_updated = EXCLUDED.last_updated
+        """).format(sql.Identifier(schema)),
+            (table, collection, name, provider, last_updated),
+        )
+        if item is not None:
+            cursor.execute(
+                sql.SQL("""
+                INSERT INTO {}.metadata_assets ("table", item, remote_updated)
+                VALUES (%s, %s, %s)
+                ON CONFLICT ("table", item) DO UPDATE SET remote_updated = EXCLUDED.remote_updated
+            """).format(sql.Identifier(schema)),
+                (table, item, last_updated),
+            )
+    if commit:
+        connection.commit()
+
+
+def stale_items(
+    schema: str,
+    items: dict[str, datetime | None],
+    connection: psycopg.Connection,
+) -> list[str]:
+    # An item is up to date when every table it was written to has a remote_updated at least as new as the given
+    # timestamp. Items without a known timestamp are always loaded.
+    if not items:
+        return []
+    with connection.cursor() as cursor:
+        cursor.execute(
+            sql.SQL("""
+            SELECT i.item
+            FROM unnest(%s::text[], %s::timestamptz[]) AS i(item, updated)
+            LEFT JOIN (
+                SELECT item, min(remote_updated) AS remote_updated, bool_or(remote_updated IS NULL) AS has_null
+                FROM {}.metadata_assets
+                WHERE item = ANY(%s::text[])
+                GROUP BY item
+            ) AS a USING (item)
+            WHERE a.item IS NULL OR a.has_null OR i.updated IS NULL OR a.remote_updated < i.updated
+        """).format(sql.Identifier(schema)),
+            (list(items.keys()), list(items.values()), list(items.keys())),
+        )
+        stale = {row[0] for row in cursor.fetchall()}
+    return [item for item in items if item in stale]
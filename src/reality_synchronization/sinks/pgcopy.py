@@ -0,0 +1,296 @@
+import logging
+from dataclasses import dataclass
+from typing import Iterator
+
+import numpy as np
+import pandas as pd
+import psycopg
+import pyarrow as pa
+import shapely
+from geopandas.array import GeometryDtype
+from pandas import DataFrame
+from psycopg import pq, sql
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class PgColumn:
+    name: str
+    # Type used when creating the column, e.g. "int8" or "geometry(MULTIPOLYGON, 3006)"
+    ddl: str
+    # Type used by psycopg to pick a binary dumper while copying
+    copy_type: str
+    srid: int | None = None
+
+    @property
+    def is_geometry(self) -> bool:
+        return self.ddl.startswith("geometry")
+
+
+_NUMPY_TYPES = {
+    "b1": "bool",
+    "f2": "float4",
+    "f4": "float4",
+    "f8": "float8",
+    "i1": "int2",
+    "i2": "int2",
+    "i4": "int4",
+    "i8": "int8",
+    "u1": "int2",
+    "u2": "int4",
+    "u4": "int8",
+    "u8": "numeric",
+}
+
+# Results of pandas.api.types.infer_dtype for object columns, anything else is written as text
+_INFERRED_TYPES = {
+    "boolean": "bool",
+    "integer": "int8",
+    "floating": "float8",
+    "mixed-integer-float": "float8",
+    "decimal": "numeric",
+    "bytes": "bytea",
+    "datetime64": "timestamp",
+    "datetime": "timestamp",
+    "date": "date",
+    "time": "time",
+    "timedelta": "interval",
+}
+
+
+def _arrow_type(type_: pa.DataType) -> str:
+    if pa.types.is_boolean(type_):
+        return "bool"
+    if pa.types.is_integer(type_):
+        return _NUMPY_TYPES[np.dtype(type_.to_pandas_dtype()).str[1:]]
+    if pa.types.is_floating(type_):
+        return "float4" if type_.bit_width <= 32 else "float8"
+    if pa.types.is_decimal(type_):
+        return "numeric"
+    if pa.types.is_binary(type_) or pa.types.is_large_binary(type_) or pa.types.is_fixed_size_binary(type_):
+        return "bytea"
+    if pa.types.is_timestamp(type_):
+        return "timestamptz" if type_.tz is not None else "timestamp"
+    if pa.types.is_date(type_):
+        return "date"
+    if pa.types.is_time(type_):
+        return "time"
+    return "text"
+
+
+def _object_type(series: pd.Series) -> str:
+    pg_type = _INFERRED_TYPES.get(pd.api.types.infer_dtype(series, skipna=True), "text")
+    if pg_type == "timestamp" and series.dropna().iloc[0].tzinfo is not None:
+        return "timestamptz"
+    return pg_type
+
+
+def _geometry_ddl(series: pd.Series, srid: int | None, generic: bool) -> str:
+    # Mirrors the type selection of GeoDataFrame.to_postgis so that tables look the same regardless of staging engine
+    geom_types = series.geom_type.dropna().unique()
+    if generic:
+        # The geometry types of the rows still to come are unknown
+        return f"geometry(GEOMETRY, {srid})" if srid is not None else "geometry"
+    if len(geom_types) == 1:
+        geom_type = "LINESTRING" if geom_types[0] == "LinearRing" else geom_types[0].upper()
+    else:
+        geom_type = "GEOMETRY"
+    if series.has_z.any():
+        geom_type += "Z"
+    if srid is None:
+        return f"geometry({geom_type})"
+    return f"geometry({geom_type}, {srid})"
+
+
+def column_type(series: pd.Series, generic_geometry: bool = False) -> PgColumn:
+    dtype = series.dtype
+    name = str(series.name)
+    if isinstance(dtype, GeometryDtype):
+        srid = series.crs.to_epsg() if series.crs is not None else None
+        return PgColumn(name, _geometry_ddl(series, srid, generic_geometry), "bytea", srid)
+    if isinstance(dtype, pd.ArrowDtype):
+        pg_type = _arrow_type(dtype.pyarrow_dtype)
+    elif isinstance(dtype, pd.DatetimeTZDtype):
+        pg_type = "timestamptz"
+    elif isinstance(dtype, pd.CategoricalDtype):
+        pg_type = "text"
+    elif isinstance(dtype, pd.StringDtype):
+        pg_type = "text"
+    elif isinstance(dtype, pd.BooleanDtype):
+        pg_type = "bool"
+    elif isinstance(dtype, pd.api.extensions.ExtensionDtype) and dtype.kind in "iuf":
+        pg_type = _NUMPY_TYPES[np.dtype(dtype.numpy_dtype).str[1:]]
+    elif dtype.kind == "M":
+        pg_type = "timestamp"
+    elif dtype.kind == "m":
+        pg_type = "interval"
+    elif dtype.kind in "biuf":
+        pg_type = _NUMPY_TYPES[dtype.str[1:]]
+    else:
+        pg_type = _object_type(series)
+    return PgColumn(name, pg_type, pg_type)
+
+
+def table_columns(df: DataFrame, generic_geometry: bool = False) -> list[PgColumn]:
+    return [column_type(df[column], generic_geometry) for column in df.columns]
+
+
+# Rows are sent in blocks of about this many bytes, each encoded a column at a time instead of row by row
+_COPY_BLOCK_BYTES = 8 << 20
+_COPY_SIGNATURE = b"PGCOPY\n\xff\r\n\0" + bytes(8)
+_COPY_TRAILER = b"\xff\xff"
+# Binary representations of the types that are encoded as whole numpy arrays
+_FIXED_WIDTH = {"bool": "?", "int2": ">i2", "int4": ">i4", "int8": ">i8", "float4": ">f4", "float8": ">f8"}
+# Dates and timestamps are sent relative to this
+_PG_EPOCH = np.datetime64("2000-01-01")
+
+# The binary representation of a column: the length of every row's value, -1 for NULL, and the values of the rows
+# that are not NULL one after the other
+_Field = tuple[np.ndarray, np.ndarray]
+
+
+def _column_values(series: pd.Series, column: PgColumn) -> np.ndarray:
+    if column.is_geometry:
+        # Vectorized EWKB encoding, PostGIS accepts (E)WKB as the binary representation of geometry
+        geometries = np.asarray(series.values, dtype=object)
+        if column.srid is not None:
+            geometries = shapely.set_srid(geometries, column.srid)
+        return shapely.to_wkb(geometries, include_srid=column.srid is not None)
+
+    missing = series.isna().to_numpy()
+    if column.copy_type == "text" and not isinstance(series.dtype, pd.StringDtype):
+        # Also covers later batches where a column that was typed as text from an earlier batch holds other values
+        values = series.to_numpy(dtype=object, copy=True)
+        strings = np.fromiter((isinstance(v, str) for v in values), dtype=bool, count=len(values))
+        convert = ~strings & ~missing
+        if convert.any():
+            values[convert] = [str(v) for v in values[convert]]
+    else:
+        values = series.to_numpy(dtype=object, copy=True)
+    values[missing] = None
+    return values
+
+
+def _variable_width_field(values: np.ndarray | list, type_: pa.DataType) -> _Field:
+    # Arrow encodes the strings and concatenates the values in C
+    array = pa.array(values, type_)
+    offsets = np.frombuffer(array.buffers()[1], np.int64)[: len(array) + 1]
+    lengths = np.diff(offsets)
+    lengths[array.is_null().to_numpy(zero_copy_only=False)] = -1
+    data = array.buffers()[2]
+    if data is None:
+        return lengths, np.empty(0, np.uint8)
+    return lengths, np.frombuffer(data, np.uint8)[offsets[0] : offsets[-1]]
+
+
+def _fixed_width_field(values: np.ndarray, missing: np.ndarray) -> _Field:
+    encoded = np.ascontiguousarray(values[~missing])
+    return np.where(missing, -1, values.dtype.itemsize), encoded.view(np.uint8)
+
+
+def _field(series: pd.Series, column: PgColumn, cursor: psycopg.Cursor) -> _Field:
+    if column.is_geometry or column.copy_type == "bytea":
+        return _variable_width_field(_column_values(series, column), pa.large_binary())
+    if column.copy_type == "text":
+        return _variable_width_field(_column_values(series, column), pa.large_string())
+    missing = series.isna().to_numpy()
+    try:
+        if column.copy_type in _FIXED_WIDTH:
+            dtype = np.dtype(_FIXED_WIDTH[column.copy_type])
+            values = series.to_numpy(dtype=dtype.newbyteorder("="), na_value=0)
+            return _fixed_width_field(values.astype(dtype), missing)
+        if column.copy_type in ("timestamp", "timestamptz"):
+            stamps = pd.to_datetime(series, utc=column.copy_type == "timestamptz")
+            if column.copy_type == "timestamptz":
+                stamps = stamps.dt.tz_localize(None)
+            microseconds = stamps.to_numpy("datetime64[us]") - _PG_EPOCH
+            return _fixed_width_field(microseconds.astype(">i8"), missing)
+        if column.copy_type == "date":
+            days = pd.to_datetime(series).to_numpy("datetime64[D]") - _PG_EPOCH
+            return _fixed_width_field(days.astype(">i4"), missing)
+    except (ValueError, TypeError, OverflowError):
+        # E.g. values that pandas cannot convert, or dates beyond the range of its timestamps
+        pass
+    # Anything else is dumped a value at a time by psycopg
+    oid = cursor.adapters.types[column.copy_type].oid
+    dumper = cursor.adapters.get_dumper_by_oid(oid, pq.Format.BINARY)(object, cursor)
+    values = _column_values(series, column)
+    return _variable_width_field([None if v is None else bytes(dumper.dump(v)) for v in values], pa.large_binary())
+
+
+def _scatter(buffer: np.ndarray, positions: np.ndarray, widths: np.ndarray, data: np.ndarray) -> None:
+    # Copies data, values of the given widths one after the other, to the given positions of buffer
+    starts = (np.cumsum(widths) - widths).astype(positions.dtype)
+    buffer[np.repeat(positions - starts, widths) + np.arange(len(data), dtype=positions.dtype)] = data
+
+
+def _copy_blocks(fields: list[_Field], rows: int) -> Iterator[memoryview]:
+    # Binary COPY rows: the number of fields, then the length and value of each
+    widths = [np.maximum(lengths, 0) for lengths, _ in fields]
+    data_ends = [np.cumsum(width) for width in widths]
+    row_ends = np.cumsum(sum((4 + width for width in widths), np.full(rows, 2)))
+    start = 0
+    while start < rows:
+        offset = row_ends[start - 1] if start else 0
+        stop = max(start + 1, int(np.searchsorted(row_ends, offset + _COPY_BLOCK_BYTES, side="right")))
+        buffer = np.empty(row_ends[stop - 1] - offset, np.uint8)
+        # Halves the memory taken by the indices of the scatter for all but enormous rows
+        index_type = np.int32 if len(buffer) < 2**31 else np.int64
+        positions = (np.concatenate([[offset], row_ends[start : stop - 1]]) - offset).astype(index_type)
+        count = np.full(stop - start, len(fields), ">i2")
+        _scatter(buffer, positions, np.full(stop - start, 2), count.view(np.uint8))
+        positions += 2
+        for (lengths, data), width, data_end in zip(fields, widths, data_ends):
+            block_lengths = lengths[start:stop].astype(">i4")
+            _scatter(buffer, positions, np.full(stop - start, 4), block_lengths.view(np.uint8))
+            positions += 4
+            data_start = data_end[start - 1] if start else 0
+            _scatter(buffer, positions, width[start:stop], data[data_start : data_end[stop - 1]])
+            positions += width[start:stop]
+        yield buffer.data
+        start = stop
+
+
+def create_table(
+    table: str,
+    schema: str | None,
+    columns: list[PgColumn],
+    cursor: psycopg.Cursor,
+    unlogged: bool = False,
+    temporary: bool = False,
+) -> None:
+    if temporary and schema not in (None, "pg_temp"):
+        raise ValueError("Temporary tables cannot be created in a schema other than pg_temp")
+    cursor.execute(
+        sql.SQL("CREATE {}TABLE {} ({}){}").format(
+            sql.SQL("TEMPORARY " if temporary else "UNLOGGED " if unlogged else ""),
+            sql.Identifier(schema, table) if schema is not None else sql.Identifier(table),
+            sql.SQL(", ").join(
+                sql.SQL("{} {}").format(sql.Identifier(column.name), sql.SQL(column.ddl))
+                for column in columns
+            ),
+            # Dropped at the end of the transaction even if the job crashes before cleaning up
+            sql.SQL(" ON COMMIT DROP" if temporary else ""),
+        )
+    )
+
+
+def copy_dataframe(
+    table: str,
+    schema: str | None,
+    df: DataFrame,
+    columns: list[PgColumn],
+    cursor: psycopg.Cursor,
+) -> None:
+    fields = [_field(df[column.name], column, cursor) for column in columns]
+    with cursor.copy(
+        sql.SQL("COPY {} ({}) FROM STDIN (FORMAT BINARY)").format(
+            sql.Identifier(schema, table) if schema is not None else sql.Identifier(table),
+            sql.SQL(", ").join(sql.Identifier(column.name) for column in columns),
+        )
+    ) as copy:
+        copy.write(_COPY_SIGNATURE)
+        for block in _copy_blocks(fields, len(df)):
+            copy.write(block)
+        copy.write(_COPY_TRAILER)
@@ -1,213 +1,810 @@
+import hashlib
 import logging
-from datetime import datetime
+import uuid
+import weakref
+from collections import Counter
+from dataclasses import dataclass
+from itertools import chain
+from typing import TYPE_CHECKING, Iterable
 
+import numpy as np
+import pandas as pd
 import psycopg
+import shapely
 from geopandas import GeoDataFrame
+from geopandas.array import GeometryDtype
 from pandas import DataFrame
 from psycopg import sql
-from sqlalchemy import create_engine
+
+from reality_synchronization.options import LoadStrategy, SpatialIndex, StagingEngine, StagingTable, Storage
+from reality_synchronization.sinks.pgcopy import copy_dataframe, create_table, table_columns
+from reality_synchronization.util.pipeline import PipelineStats, timed_stage
+
+if TYPE_CHECKING:
+    from sqlalchemy import Engine
 
 logger = logging.getLogger(__name__)
 
+# Share of changed rows above which load=auto swaps the table rather than merging into it
+SWAP_CHANGE_RATIO = 0.3
 
-def write_postgis(
-    table: str,
-    schema: str,
-    temporary_schema: str,
-    df: GeoDataFrame | DataFrame,
-    connection: psycopg.Connection,
-    subdivision_value: str | None = None
-) -> None:
-    if df.index is None or df.index.name is None:
-        raise ValueError("DataFrame must have an index")
-    logger.info("Dumping to temporary table")
-    # TODO: create a temporary unlogged table instead
-    if isinstance(df, GeoDataFrame):
-        df.to_postgis(
-            table, create_engine("postgresql+psycopg://", creator=lambda: connection), schema=temporary_schema, if_exists="replace", index=True
-        )
-    else:
-        df.to_sql(
-            table, create_engine("postgresql+psycopg://", creator=lambda: connection), schema=temporary_schema, if_exists="replace", index=True
-        )
+# Session settings for index builds after bulk loads
+MAINTENANCE_WORK_MEM = "1GB"
+MAX_PARALLEL_MAINTENANCE_WORKERS = 4
+# Number of staging rows compared with the target to estimate the share of changed rows
+_CHANGE_SAMPLE_ROWS = 10000
 
-    id_column = df.index.name
-    columns = df.reset_index().columns
-    logger.debug("Data has columns: %s", columns)
-    logger.debug("Data has index: %s", id_column)
 
-    with connection.cursor() as cursor:
+@dataclass
+class WriteResult:
+    inserted: int = 0
+    updated: int = 0
+    deleted: int = 0
+    unchanged: int = 0
+
+
+def _canonical(series: pd.Series) -> pd.Series:
+    # The same values arrive with different dtypes depending on how they were read: whole layers have int64/float64 or
+    # object for nullable columns, Arrow batches nullable Int64/boolean and snapshots whatever parquet stored. They are
+    # converted to one representation per kind, so that the hash does not change with batch_size or snapshots.
+    if isinstance(series.dtype, GeometryDtype):
+        return pd.Series(shapely.to_wkb(np.asarray(series.values, dtype=object)), index=series.index)
+    kind = pd.api.types.infer_dtype(series, skipna=True)
+    if kind in ("boolean", "integer", "floating", "mixed-integer-float", "decimal"):
+        if series.dtype == object:
+            values = series.where(series.notna(), np.nan).astype("float64").to_numpy()
+        else:
+            values = series.astype("Float64").to_numpy(dtype="float64", na_value=np.nan)
+        return pd.Series(values, index=series.index)
+    if kind in ("datetime64", "datetime"):
+        values = pd.to_datetime(series, utc=True).dt.tz_localize(None).to_numpy(dtype="datetime64[ns]")
+        return pd.Series(values.view(np.int64), index=series.index)
+    return series.astype(object).where(series.notna(), None)
+
+
+def row_hash(df: GeoDataFrame | DataFrame) -> pd.Series:
+    # Geometries are hashed through their WKB, everything else is hashed by pandas without leaving vectorized code
+    data = DataFrame({column: _canonical(series) for column, series in df.items()}, index=df.index)
+    hashes = pd.util.hash_pandas_object(data, index=True)
+    return pd.Series(hashes.to_numpy().view(np.int64), index=df.index, name="_hash")
+
+
+def _identifier(schema: str | None, table: str) -> sql.Identifier:
+    return sql.Identifier(schema, table) if schema is not None else sql.Identifier(table)
+
+
+def _maintenance_settings(cursor: psycopg.Cursor) -> None:
+    # Lets the index builds that follow sort in memory and use parallel workers, until the end of the transaction
+    cursor.execute(
+        "SELECT set_config('maintenance_work_mem', %s, true), set_config('max_parallel_maintenance_workers', %s, true)",
+        (MAINTENANCE_WORK_MEM, str(MAX_PARALLEL_MAINTENANCE_WORKERS)),
+    )
+
+
+def _create_spatial_indexes(schema: str, table: str, method: SpatialIndex, cursor: psycopg.Cursor) -> None:
+    # Indexes the geometry columns that are not indexed yet
+    if method == "none":
+        return
+    cursor.execute(
+        """
+        SELECT columns.f_geometry_column
+        FROM geometry_columns AS columns
+        WHERE columns.f_table_schema = %s AND columns.f_table_name = %s AND NOT EXISTS (
+            SELECT 1
+            FROM pg_index AS index
+            JOIN pg_attribute AS attribute
+                ON attribute.attrelid = index.indrelid AND attribute.attnum = ANY(index.indkey)
+            WHERE index.indrelid = to_regclass(%s) AND attribute.attname = columns.f_geometry_column
+        )""",
+        (schema, table, sql.Identifier(schema, table).as_string(cursor)),
+    )
+    for (column,) in cursor.fetchall():
+        logger.info("Creating %s index on %s.%s", method, table, column)
         cursor.execute(
-            "SELECT EXISTS(SELECT 1 FROM information_schema.tables WHERE table_schema = %s AND table_name = %s)",
-            (schema, table),
+            sql.SQL("CREATE INDEX ON {} USING {} ({})").format(
+                sql.Identifier(schema, table), sql.SQL(method), sql.Identifier(column)
+            )
         )
-        if cursor.fetchone()[0]:
-            logger.info("Upserting to existing table")
-            if subdivision_value is None:
-                query = sql.SQL("""
-    MERGE INTO {}.{} AS target
-    USING {}.{} AS source
-    ON target.{} = source.{}
-    WHEN MATCHED THEN UPDATE SET
-        {}
-    WHEN NOT MATCHED BY TARGET THEN INSERT ({}, _subdivision)
-        VALUES ({}, {})
-    WHEN NOT MATCHED BY SOURCE THEN
-        DELETE;
-    """).format(
-                        sql.Identifier(schema),
-                        sql.Identifier(table),
-                        sql.Identifier(temporary_schema),
-                        sql.Identifier(table),
-                        sql.Identifier(id_column),
-                        sql.Identifier(id_column),
-                        sql.Composed(
-                            [
-                                sql.SQL("{}=source.{}").format(
-                                    sql.Identifier(column), sql.Identifier(column)
-                                )
-                                for column in df.columns
-                            ]
-                        ).join(", "),
-                        sql.Composed([sql.Identifier(i) for i in columns]).join(", "),
-                        sql.Composed(
-                            [
-                                sql.SQL("source.{}").format(sql.Identifier(column))
-                                for column in columns
-                            ]
-                        ).join(", "),
-                        sql.Placeholder(),
-                    )
-                logger.debug("Executing query: %s", query.as_string(cursor))
-                cursor.execute(
-                    query,
-                    (subdivision_value,),
+
+
+def _drop_indexes(table: sql.Identifier, cursor: psycopg.Cursor) -> None:
+    cursor.execute("SELECT indexrelid::regclass::text FROM pg_index WHERE indrelid = to_regclass(%s)", (table.as_string(cursor),))
+    for (index,) in cursor.fetchall():
+        cursor.execute(sql.SQL("DROP INDEX {}").format(sql.SQL(index)))
+
+
+def _stage_copy(
+    table: str,
+    schema: str | None,
+    batches: Iterable[GeoDataFrame | DataFrame],
+    connection: psycopg.Connection,
+    staging_table: StagingTable = "logged",
+    generic_geometry: bool = False,
+    stats: PipelineStats | None = None,
+) -> int:
+    rows = 0
+    columns = None
+    with connection.cursor() as cursor:
+        for df in batches:
+            df = df.reset_index()
+            if columns is None:
+                columns = table_columns(df, generic_geometry)
+                cursor.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(_identifier(schema, table)))
+                create_table(
+                    table,
+                    schema,
+                    columns,
+                    cursor,
+                    unlogged=staging_table == "unlogged",
+                    temporary=staging_table == "temporary",
                 )
-            else:
-                query = sql.SQL("""
-    MERGE INTO {}.{} AS target
-    USING {}.{} AS source
+            # Only the COPY itself, as getting the next batch includes waiting for it to be read
+            with timed_stage(stats, "write.staging"):
+                copy_dataframe(table, schema, df, columns, cursor)
+            rows += len(df)
+    if stats is not None:
+        stats.add_rows("write.staging", rows)
+    return rows
+
+
+_engines: "weakref.WeakKeyDictionary[psycopg.Connection, Engine]" = weakref.WeakKeyDictionary()
+
+
+def _engine(connection: psycopg.Connection) -> "Engine":
+    # One engine per connection rather than per layer. The engine only holds a weak reference, so that it is dropped
+    # together with the connection. SQLAlchemy is only imported here as the default copy staging does not need it.
+    from sqlalchemy import create_engine
+
+    engine = _engines.get(connection)
+    if engine is None:
+        ref = weakref.ref(connection)
+        engine = create_engine("postgresql+psycopg://", creator=lambda: ref())
+        _engines[connection] = engine
+    return engine
+
+
+def _stage_sqlalchemy(
+    table: str,
+    schema: str | None,
+    batches: Iterable[GeoDataFrame | DataFrame],
+    connection: psycopg.Connection,
+    staging_table: StagingTable = "logged",
+) -> int:
+    if staging_table == "temporary":
+        raise ValueError("The sqlalchemy staging engine does not support temporary staging tables")
+    engine = _engine(connection)
+    rows = 0
+    for idx, df in enumerate(batches):
+        if_exists = "append"
+        if idx == 0 and staging_table == "unlogged":
+            with connection.cursor() as cursor:
+                cursor.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(_identifier(schema, table)))
+                create_table(table, schema, table_columns(df.reset_index()), cursor, unlogged=True)
+        elif idx == 0:
+            if_exists = "replace"
+        if isinstance(df, GeoDataFrame):
+            df.to_postgis(table, engine, schema=schema, if_exists=if_exists, index=True)
+        else:
+            df.to_sql(table, engine, schema=schema, if_exists=if_exists, index=True)
+        if idx == 0 and if_exists == "replace":
+            # pandas and geoalchemy index the new table, which would only slow down the following batches
+            with connection.cursor() as cursor:
+                _drop_indexes(_identifier(schema, table), cursor)
+        rows += len(df)
+    return rows
+
+
+def _table_exists(schema: str, table: str, cursor: psycopg.Cursor) -> bool:
+    cursor.execute(
+        "SELECT EXISTS(SELECT 1 FROM information_schema.tables WHERE table_schema = %s AND table_name = %s)",
+        (schema, table),
+    )
+    return cursor.fetchone()[0]
+
+
+def _is_partitioned(schema: str, table: str, cursor: psycopg.Cursor) -> bool:
+    cursor.execute(
+        "SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass(%s)",
+        (sql.Identifier(schema, table).as_string(cursor),),
+    )
+    row = cursor.fetchone()
+    return row is not None and row[0]
+
+
+def _merge_query(
+    target: sql.Composable, staging: sql.Composable, id_column: str, data_columns: list[str], scoped: bool
+) -> sql.Composed:
+    # Takes the subdivision as parameter, and when scoped a second time to only delete rows of that subdivision
+    columns = [id_column, *data_columns]
+    # The actions are counted on the server rather than sending a row per changed row to the client (PostgreSQL 17)
+    return sql.SQL("""
+    WITH merged AS (
+    MERGE INTO {} AS target
+    USING {} AS source
     ON target.{} = source.{}
-    WHEN MATCHED THEN UPDATE SET
+    WHEN MATCHED AND target._hash IS DISTINCT FROM source._hash THEN UPDATE SET
         {}
     WHEN NOT MATCHED BY TARGET THEN INSERT ({}, _subdivision)
         VALUES ({}, {})
-    WHEN NOT MATCHED BY SOURCE AND target._subdivision = {} THEN
-        DELETE;
+    WHEN NOT MATCHED BY SOURCE{} THEN
+        DELETE
+    RETURNING merge_action() AS action
+    )
+    SELECT action, count(*) FROM merged GROUP BY action;
     """).format(
-                        sql.Identifier(schema),
-                        sql.Identifier(table),
-                        sql.Identifier(temporary_schema),
-                        sql.Identifier(table),
-                        sql.Identifier(id_column),
-                        sql.Identifier(id_column),
-                        sql.Composed(
-                            [
-                                sql.SQL("{}=source.{}").format(
-                                    sql.Identifier(column), sql.Identifier(column)
-                                )
-                                for column in df.columns
-                            ]
-                        ).join(", "),
-                        sql.Composed([sql.Identifier(i) for i in columns]).join(", "),
-                        sql.Composed(
-                            [
-                                sql.SQL("source.{}").format(sql.Identifier(column))
-                                for column in columns
-                            ]
-                        ).join(", "),
-                        sql.Placeholder(),
-                        sql.Placeholder(),
-                    )
-                logger.debug("Executing query: %s", query.as_string(cursor))
-                cursor.execute(
-                    query,
-                    (subdivision_value, subdivision_value),
+        target,
+        staging,
+        sql.Identifier(id_column),
+        sql.Identifier(id_column),
+        sql.Composed(
+            [sql.SQL("{}=source.{}").format(sql.Identifier(column), sql.Identifier(column)) for column in data_columns]
+        ).join(", "),
+        sql.Composed([sql.Identifier(i) for i in columns]).join(", "),
+        sql.Composed([sql.SQL("source.{}").format(sql.Identifier(column)) for column in columns]).join(", "),
+        sql.Placeholder(),
+        sql.SQL(" AND target._subdivision = {}").format(sql.Placeholder()) if scoped else sql.SQL(""),
+    )
+
+
+def _merge_result(cursor: psycopg.Cursor, rows: int) -> WriteResult:
+    actions = Counter({action: count for action, count in cursor})
+    return WriteResult(
+        inserted=actions["INSERT"],
+        updated=actions["UPDATE"],
+        deleted=actions["DELETE"],
+        unchanged=rows - actions["INSERT"] - actions["UPDATE"],
+    )
+
+
+def _truncated(name: str, length: int = 63) -> str:
+    # PostgreSQL silently cuts identifiers at 63 bytes
+    return name.encode()[:length].decode(errors="ignore")
+
+
+def _unique_name(name: str) -> str:
+    # Unique per write and within the 63 bytes of an identifier
+    return f"{_truncated(name, 53)}__{uuid.uuid4().hex[:8]}"
+
+
+def _index_renames(
+    schema: str, loaded: str, table: str, known: list[str], cursor: psycopg.Cursor
+) -> list[tuple[str, str]]:
+    # Indexes built on a freshly loaded table besides the known ones are named after the loaded table. They get the
+    # name PostgreSQL would give them on the table they replace, unless another relation already has that name.
+    cursor.execute(
+        """
+        SELECT class.relname, string_agg(attribute.attname, '_' ORDER BY attribute.attnum)
+        FROM pg_index AS index
+        JOIN pg_class AS class ON class.oid = index.indexrelid
+        JOIN pg_attribute AS attribute
+            ON attribute.attrelid = index.indrelid AND attribute.attnum = ANY(index.indkey)
+        WHERE index.indrelid = to_regclass(%s) AND NOT class.relname = ANY(%s)
+        GROUP BY class.relname""",
+        (sql.Identifier(schema, loaded).as_string(cursor), known),
+    )
+    renames = []
+    for index, columns in cursor.fetchall():
+        suffix = f"_{columns}_idx"
+        name = _truncated(_truncated(table, max(63 - len(suffix.encode()), 1)) + suffix)
+        cursor.execute("SELECT to_regclass(%s) IS NULL", (sql.Identifier(schema, name).as_string(cursor),))
+        if cursor.fetchone()[0]:
+            renames.append((index, name))
+    return renames
+
+
+def _partition_name(table: str, subdivision_value: str) -> str:
+    name = f"{table}__{subdivision_value}"
+    if len(name.encode()) <= 50:
+        return name
+    # PostgreSQL truncates identifiers beyond 63 bytes, which could make two partitions (or their keys) collide
+    return f"{table.encode()[:30].decode(errors='ignore')}__{hashlib.sha1(subdivision_value.encode()).hexdigest()[:16]}"
+
+
+def _write_partition(
+    table: str,
+    schema: str,
+    staging: sql.Identifier,
+    id_column: str,
+    data_columns: list[str],
+    subdivision_value: str,
+    rows: int,
+    swap: bool,
+    spatial_index: SpatialIndex,
+    cursor: psycopg.Cursor,
+    stats: PipelineStats | None = None,
+) -> WriteResult:
+    # The target is LIST partitioned by _subdivision with one partition per subdivision, so that writing a
+    # subdivision only scans, locks and dirties its own partition
+    parent = sql.Identifier(schema, table)
+    partition_name = _partition_name(table, subdivision_value)
+    partition = sql.Identifier(schema, partition_name)
+    if not _table_exists(schema, table, cursor):
+        logger.info("Creating partitioned table")
+        cursor.execute(
+            sql.SQL("CREATE TABLE {} (LIKE {}, _subdivision TEXT NOT NULL) PARTITION BY LIST (_subdivision)").format(
+                parent, staging
+            )
+        )
+        cursor.execute(
+            sql.SQL("ALTER TABLE {} ADD PRIMARY KEY ({}, _subdivision)").format(parent, sql.Identifier(id_column))
+        )
+        # Indexes on the parent are created on every partition. Freshly loaded partitions bring their own, which are
+        # taken over when they are attached.
+        _create_spatial_indexes(schema, table, spatial_index, cursor)
+    elif not _is_partitioned(schema, table, cursor):
+        raise ValueError(f"Table {schema}.{table} exists and is not partitioned")
+    else:
+        cursor.execute(sql.SQL("ALTER TABLE {} ADD COLUMN IF NOT EXISTS _hash BIGINT").format(parent))
+
+    exists = _table_exists(schema, partition_name, cursor)
+    if exists and not swap:
+        logger.info("Merging into partition %s", partition_name)
+        with timed_stage(stats, "write.analyze"):
+            cursor.execute(sql.SQL("ANALYZE {}").format(staging))
+        query = _merge_query(partition, staging, id_column, data_columns, scoped=False)
+        logger.debug("Executing query: %s", query.as_string(cursor))
+        with timed_stage(stats, "write.merge"):
+            cursor.execute(query, (subdivision_value,))
+        if stats is not None:
+            stats.add_rows("write.merge", rows)
+        return _merge_result(cursor, rows)
+
+    # A freshly loaded table is attached in place of the old partition. The CHECK constraint matches the partition
+    # bound, so attaching does not have to scan the table to validate it.
+    loaded_name = _unique_name(partition_name) if exists else partition_name
+    loaded = sql.Identifier(schema, loaded_name)
+    primary_key_name = _unique_name(f"{partition_name}_pkey") if exists else f"{partition_name}_pkey"
+    columns = sql.Composed([sql.Identifier(column) for column in [id_column, *data_columns]]).join(", ")
+    cursor.execute(sql.SQL("CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS)").format(loaded, parent))
+    with timed_stage(stats, "write.load"):
+        cursor.execute(
+            sql.SQL("INSERT INTO {} ({}, _subdivision) SELECT {}, {} FROM {}").format(
+                loaded, columns, columns, sql.Placeholder(), staging
+            ),
+            (subdivision_value,),
+        )
+    if stats is not None:
+        stats.add_rows("write.load", rows)
+    cursor.execute(
+        sql.SQL("ALTER TABLE {} ADD CHECK (_subdivision IS NOT NULL AND _subdivision = {})").format(
+            loaded, sql.Literal(subdivision_value)
+        )
+    )
+    _maintenance_settings(cursor)
+    with timed_stage(stats, "write.index"):
+        cursor.execute(
+            sql.SQL("ALTER TABLE {} ADD CONSTRAINT {} PRIMARY KEY ({}, _subdivision)").format(
+                loaded, sql.Identifier(primary_key_name), sql.Identifier(id_column)
+            )
+        )
+        _create_spatial_indexes(schema, loaded_name, spatial_index, cursor)
+    with timed_stage(stats, "write.analyze"):
+        cursor.execute(sql.SQL("ANALYZE {}").format(loaded))
+    deleted = 0
+    if exists:
+        logger.info("Swapping partition %s", partition_name)
+        cursor.execute(sql.SQL("SELECT count(*) FROM {}").format(partition))
+        deleted = cursor.fetchone()[0]
+        # Dropping a partition takes an ACCESS EXCLUSIVE lock on the parent until the transaction ends, which blocks
+        # reads of every subdivision. It is the last step of the write, but with SyncOptions.atomic the lock is held
+        # until the other layers of the item are written too.
+        cursor.execute(sql.SQL("DROP TABLE {}").format(partition))
+        cursor.execute(sql.SQL("ALTER TABLE {} RENAME TO {}").format(loaded, sql.Identifier(partition_name)))
+        renames = [(primary_key_name, f"{partition_name}_pkey")]
+        renames += _index_renames(schema, partition_name, partition_name, [primary_key_name], cursor)
+        for temporary_name, name in renames:
+            cursor.execute(
+                sql.SQL("ALTER INDEX {} RENAME TO {}").format(
+                    sql.Identifier(schema, temporary_name), sql.Identifier(name)
                 )
+            )
+    else:
+        logger.info("Creating partition %s", partition_name)
+    cursor.execute(
+        sql.SQL("ALTER TABLE {} ATTACH PARTITION {} FOR VALUES IN ({})").format(
+            parent, partition, sql.Literal(subdivision_value)
+        )
+    )
+    return WriteResult(inserted=rows, deleted=deleted)
+
+
+def _only_subdivision(schema: str, table: str, subdivision_value: str | None, cursor: psycopg.Cursor) -> bool:
+    # Whether replacing the whole table only replaces the given subdivision
+    if subdivision_value is None:
+        return True
+    cursor.execute(
+        sql.SQL("SELECT NOT EXISTS(SELECT 1 FROM {} WHERE _subdivision IS DISTINCT FROM %s)").format(
+            sql.Identifier(schema, table)
+        ),
+        (subdivision_value,),
+    )
+    return cursor.fetchone()[0]
+
+
+def _change_ratio(
+    schema: str, table: str, staging: sql.Identifier, id_column: str, rows: int, cursor: psycopg.Cursor
+) -> float:
+    # Estimates the inserted and updated rows from a sample of the staging table looked up by primary key, and the
+    # deleted rows from the difference in row counts
+    target = sql.Identifier(schema, table)
+    percent = min(100.0, 100.0 * _CHANGE_SAMPLE_ROWS / max(rows, 1))
+    cursor.execute(
+        sql.SQL(
+            """
+            SELECT count(*), count(*) FILTER (WHERE target._hash IS DISTINCT FROM source._hash)
+            FROM {} AS source TABLESAMPLE BERNOULLI (%s)
+            LEFT JOIN {} AS target ON target.{} = source.{}"""
+        ).format(staging, target, sql.Identifier(id_column), sql.Identifier(id_column)),
+        (percent,),
+    )
+    sampled, changed = cursor.fetchone()
+    cursor.execute("SELECT reltuples FROM pg_class WHERE oid = to_regclass(%s)", (target.as_string(cursor),))
+    (existing,) = cursor.fetchone()
+    if existing < 0:
+        cursor.execute(sql.SQL("SELECT count(*) FROM {}").format(target))
+        (existing,) = cursor.fetchone()
+    changed_rows = rows * changed / sampled if sampled else rows
+    return (changed_rows + max(existing - rows, 0)) / max(rows, existing, 1)
+
+
+def _dependent_views(schema: str, table: str, cursor: psycopg.Cursor) -> list[tuple[str, str, str]]:
+    # Views depending on the table, directly or through other views, in the order they can be created
+    cursor.execute(
+        """
+        WITH RECURSIVE dependents (oid, depth) AS (
+            SELECT rewrite.ev_class, 1
+            FROM pg_depend AS depend
+            JOIN pg_rewrite AS rewrite ON rewrite.oid = depend.objid
+            WHERE depend.refobjid = to_regclass(%s) AND rewrite.ev_class <> depend.refobjid
+            UNION
+            SELECT rewrite.ev_class, dependents.depth + 1
+            FROM dependents
+            JOIN pg_depend AS depend ON depend.refobjid = dependents.oid
+            JOIN pg_rewrite AS rewrite ON rewrite.oid = depend.objid
+            WHERE rewrite.ev_class <> dependents.oid
+        )
+        SELECT class.oid::regclass::text, class.relkind, pg_get_viewdef(class.oid)
+        FROM dependents
+        JOIN pg_class AS class ON class.oid = dependents.oid
+        GROUP BY class.oid, class.relkind
+        ORDER BY max(dependents.depth)""",
+        (sql.Identifier(schema, table).as_string(cursor),),
+    )
+    return cursor.fetchall()
+
+
+def _swap_blockers(schema: str, table: str, cursor: psycopg.Cursor) -> list[str]:
+    # Dependents that would not survive being dropped and created again from their definition: materialized views,
+    # which would also be refreshed while the table is locked, views with options, comments, column grants, triggers
+    # or rules of their own, and tables with foreign keys to it
+    cursor.execute(
+        """
+        WITH RECURSIVE dependents (oid) AS (
+            SELECT rewrite.ev_class
+            FROM pg_depend AS depend
+            JOIN pg_rewrite AS rewrite ON rewrite.oid = depend.objid
+            WHERE depend.refobjid = to_regclass(%s) AND rewrite.ev_class <> depend.refobjid
+            UNION
+            SELECT rewrite.ev_class
+            FROM dependents
+            JOIN pg_depend AS depend ON depend.refobjid = dependents.oid
+            JOIN pg_rewrite AS rewrite ON rewrite.oid = depend.objid
+            WHERE rewrite.ev_class <> dependents.oid
+        )
+        SELECT class.oid::regclass::text
+        FROM dependents
+        JOIN pg_class AS class ON class.oid = dependents.oid
+        WHERE class.relkind <> 'v'
+            OR class.reloptions IS NOT NULL
+            OR obj_description(class.oid, 'pg_class') IS NOT NULL
+            OR EXISTS (SELECT 1 FROM pg_description WHERE objoid = class.oid AND objsubid > 0)
+            OR EXISTS (SELECT 1 FROM pg_attribute WHERE attrelid = class.oid AND attacl IS NOT NULL)
+            OR EXISTS (SELECT 1 FROM pg_trigger WHERE tgrelid = class.oid)
+            OR EXISTS (SELECT 1 FROM pg_rewrite WHERE ev_class = class.oid AND rulename <> '_RETURN')
+        UNION ALL
+        -- Foreign keys of other tables would make dropping the target fail
+        SELECT conrelid::regclass::text
+        FROM pg_constraint
+        WHERE contype = 'f' AND confrelid = to_regclass(%s) AND conrelid <> confrelid""",
+        (sql.Identifier(schema, table).as_string(cursor),) * 2,
+    )
+    return [name for (name,) in cursor.fetchall()]
+
+
+def _privileges(relation: str, cursor: psycopg.Cursor) -> tuple[str, list[tuple[str, str, bool]]]:
+    # Owner and grants of a relation, given by name as returned by regclass
+    cursor.execute(
+        """
+        SELECT pg_get_userbyid(relowner),
+               CASE WHEN acl.grantee = 0 THEN 'PUBLIC' ELSE pg_get_userbyid(acl.grantee) END,
+               acl.privilege_type,
+               acl.is_grantable
+        FROM pg_class
+        LEFT JOIN LATERAL aclexplode(relacl) AS acl ON true
+        WHERE oid = to_regclass(%s)""",
+        (relation,),
+    )
+    rows = cursor.fetchall()
+    return rows[0][0], [(role, privilege, grantable) for _, role, privilege, grantable in rows if privilege is not None]
+
+
+def _grant_privileges(
+    owner: str, grants: list[tuple[str, str, bool]], relation: sql.Composable, cursor: psycopg.Cursor
+) -> None:
+    cursor.execute("SELECT current_user")
+    if cursor.fetchone()[0] != owner:
+        cursor.execute(sql.SQL("ALTER TABLE {} OWNER TO {}").format(relation, sql.Identifier(owner)))
+    for role, privilege, grantable in grants:
+        cursor.execute(
+            sql.SQL("GRANT {} ON {} TO {}{}").format(
+                sql.SQL(privilege),
+                relation,
+                sql.SQL("PUBLIC") if role == "PUBLIC" else sql.Identifier(role),
+                sql.SQL(" WITH GRANT OPTION") if grantable else sql.SQL(""),
+            )
+        )
+
+
+def _swap_table(
+    schema: str,
+    table: str,
+    staging: sql.Identifier,
+    id_column: str,
+    data_columns: list[str],
+    subdivision_value: str | None,
+    spatial_index: SpatialIndex,
+    cursor: psycopg.Cursor,
+    stats: PipelineStats | None = None,
+) -> WriteResult:
+    # Loads the data into a shadow table and builds its indexes there, so that the target is only locked while the
+    # tables are renamed. Owner, grants and dependent views are carried over to the new table, which the caller has to
+    # check with _swap_blockers first.
+    target = sql.Identifier(schema, table)
+    # Unique, so that concurrent swaps of the same table do not build into each other's shadow table. A shadow table
+    # left by a crash is dropped with its transaction.
+    shadow_name = _unique_name(table)
+    shadow = sql.Identifier(schema, shadow_name)
+    logger.info("Building shadow table %s", shadow_name)
+    cursor.execute(
+        sql.SQL(
+            "CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING GENERATED INCLUDING IDENTITY "
+            "INCLUDING STORAGE INCLUDING COMMENTS INCLUDING COMPRESSION)"
+        ).format(shadow, target)
+    )
+    columns = sql.Composed([sql.Identifier(column) for column in [id_column, *data_columns]]).join(", ")
+    with timed_stage(stats, "write.load"):
+        if subdivision_value is None:
+            cursor.execute(sql.SQL("INSERT INTO {} ({}) SELECT {} FROM {}").format(shadow, columns, columns, staging))
         else:
-            logger.info("Creating new table")
-            if subdivision_value is None:
+            cursor.execute(
+                sql.SQL("INSERT INTO {} ({}, _subdivision) SELECT {}, %s FROM {}").format(
+                    shadow, columns, columns, staging
+                ),
+                (subdivision_value,),
+            )
+    inserted = cursor.rowcount
+    if stats is not None:
+        stats.add_rows("write.load", inserted)
+
+    # Indexes and constraints are built after loading, under temporary names as index names are unique per schema
+    _maintenance_settings(cursor)
+    cursor.execute(
+        """
+        SELECT index.indexrelid::regclass::text, class.relname, pg_get_indexdef(index.indexrelid),
+               constraint_.conname, pg_get_constraintdef(constraint_.oid)
+        FROM pg_index AS index
+        JOIN pg_class AS class ON class.oid = index.indexrelid
+        LEFT JOIN pg_constraint AS constraint_ ON constraint_.conindid = index.indexrelid
+            AND constraint_.conrelid = index.indrelid AND constraint_.contype IN ('p', 'u', 'x')
+        WHERE index.indrelid = to_regclass(%s)""",
+        (target.as_string(cursor),),
+    )
+    renames = []
+    with timed_stage(stats, "write.index"):
+        for _, index_name, index_definition, constraint_name, constraint_definition in cursor.fetchall():
+            if constraint_name is not None:
+                temporary_name = _unique_name(constraint_name)
                 cursor.execute(
-                    sql.SQL("""CREATE TABLE {}.{} AS SELECT * FROM {}.{}""").format(
-                        sql.Identifier(schema),
-                        sql.Identifier(table),
-                        sql.Identifier(temporary_schema),
-                        sql.Identifier(table),
-                    ),
+                    sql.SQL("ALTER TABLE {} ADD CONSTRAINT {} {}").format(
+                        shadow, sql.Identifier(temporary_name), sql.SQL(constraint_definition)
+                    )
                 )
             else:
+                temporary_name = _unique_name(index_name)
+                head, using = index_definition.split(" USING ", 1)
+                unique = sql.SQL("UNIQUE ") if head.startswith("CREATE UNIQUE ") else sql.SQL("")
                 cursor.execute(
-                    sql.SQL("""CREATE TABLE {}.{} AS SELECT *, {} AS _subdivision FROM {}.{}""").format(
-                        sql.Identifier(schema),
-                        sql.Identifier(table),
-                        sql.Placeholder(),
-                        sql.Identifier(temporary_schema),
-                        sql.Identifier(table),
-                    ),
-                    (subdivision_value,),
+                    sql.SQL("CREATE {}INDEX {} ON {} USING {}").format(
+                        unique, sql.Identifier(temporary_name), shadow, sql.SQL(using)
+                    )
                 )
-            cursor.execute(sql.SQL("""ALTER TABLE {}.{} ADD PRIMARY KEY ({})""").format(sql.Identifier(schema), sql.Identifier(table), sql.Identifier(id_column)))
-            if subdivision_value:
-                cursor.execute(sql.SQL("""CREATE INDEX ON {}.{} (_subdivision)""").format(sql.Identifier(schema), sql.Identifier(table)))
+            renames.append((temporary_name, index_name))
+        _create_spatial_indexes(schema, shadow_name, spatial_index, cursor)
+    renames += _index_renames(schema, shadow_name, table, [name for name, _ in renames], cursor)
+    with timed_stage(stats, "write.analyze"):
+        cursor.execute(sql.SQL("ANALYZE {}").format(shadow))
+    _grant_privileges(*_privileges(target.as_string(cursor), cursor), shadow, cursor)
 
-        cursor.execute(sql.SQL("DROP TABLE {}.{}").format(sql.Identifier(temporary_schema), sql.Identifier(table)))
+    views = _dependent_views(schema, table, cursor)
+    view_privileges = [_privileges(view, cursor) for view, _, _ in views]
 
-def create_metadata_table(schema: str, connection: psycopg.Connection) -> None:
-    logger.info("Creating metadata table")
-    with connection.cursor() as cursor:
-        cursor.execute(
-            sql.SQL(
-                """
-            CREATE TABLE IF NOT EXISTS {}.metadata (
-                "table" TEXT NOT NULL PRIMARY KEY,
-                collection TEXT NOT NULL,
-                "name" TEXT NOT NULL,
-                "provider" TEXT NOT NULL,
-                last_updated TIMESTAMP WITH TIME ZONE
-            )"""
-            ).format(sql.Identifier(schema))
-        )
-        cursor.execute(
-            sql.SQL(
-                """
-            CREATE TABLE IF NOT EXISTS {}.metadata_assets (
-                "table" TEXT NOT NULL REFERENCES {}.metadata ("table"),
-                item TEXT NOT NULL,
-                remote_updated TIMESTAMP WITH TIME ZONE,
-                PRIMARY KEY ("table", item)
-            )"""
-            ).format(sql.Identifier(schema), sql.Identifier(schema))
-        )
-    connection.commit()
+    logger.info("Swapping %s with its shadow table", table)
+    with timed_stage(stats, "write.swap"):
+        cursor.execute(sql.SQL("SELECT count(*) FROM {}").format(target))
+        (deleted,) = cursor.fetchone()
+        for view, _, _ in reversed(views):
+            cursor.execute(sql.SQL("DROP VIEW {}").format(sql.SQL(view)))
+        cursor.execute(sql.SQL("DROP TABLE {}").format(target))
+        cursor.execute(sql.SQL("ALTER TABLE {} RENAME TO {}").format(shadow, sql.Identifier(table)))
+        for temporary_name, name in renames:
+            cursor.execute(
+                sql.SQL("ALTER INDEX {} RENAME TO {}").format(
+                    sql.Identifier(schema, temporary_name), sql.Identifier(name)
+                )
+            )
+        for (view, _, definition), (owner, grants) in zip(views, view_privileges):
+            cursor.execute(sql.SQL("CREATE VIEW {} AS {}").format(sql.SQL(view), sql.SQL(definition.rstrip(";"))))
+            _grant_privileges(owner, grants, sql.SQL(view), cursor)
+    return WriteResult(inserted=inserted, deleted=deleted)
 
 
-def upsert_metadata(
+def write_postgis(
     table: str,
-    collection: str,
-    name: str,
-    provider: str,
-    last_updated: datetime,
     schema: str,
-    item: str | None,
+    temporary_schema: str,
+    df: GeoDataFrame | DataFrame | Iterable[GeoDataFrame | DataFrame],
     connection: psycopg.Connection,
-) -> None:
-    logger.info("Upserting metadata")
-    with connection.cursor() as cursor:
-        cursor.execute(
-            sql.SQL("""
-            INSERT INTO {}.metadata ("table", collection, "name", "provider", last_updated)
-            VALUES (%s, %s, %s, %s, %s)
-            ON CONFLICT ("table") DO UPDATE SET last_updated = EXCLUDED.last_updated
-        """).format(sql.Identifier(schema)),
-            (table, collection, name, provider, last_updated),
+    subdivision_value: str | None = None,
+    staging_engine: StagingEngine = "copy",
+    staging_table: StagingTable = "temporary",
+    deduplicate: bool = False,
+    storage: Storage = "table",
+    load: LoadStrategy = "merge",
+    spatial_index: SpatialIndex = "gist",
+    stats: PipelineStats | None = None,
+) -> WriteResult:
+    # Either a single data frame or a stream of batches with the same columns and index, in which case only one batch
+    # at a time is kept in memory. With stats, the time spent in each step is recorded as write.<step>.
+    batches = iter([df]) if isinstance(df, DataFrame) else iter(df)
+    first = next(batches, None)
+    if first is None:
+        raise ValueError("No data to write")
+    if first.index is None or first.index.name is None:
+        raise ValueError("DataFrame must have an index")
+    # Stored in the target table so that the MERGE can leave unchanged rows alone instead of writing new tuple versions
+    hashed = (batch.assign(_hash=row_hash(batch)) for batch in chain([first], batches))
+    # Temporary tables live in the session's own schema and are dropped on commit, so nothing is left behind if the
+    # job crashes. Unlogged tables are placed in temporary_schema but skip the WAL, like temporary tables do.
+    if staging_table == "temporary" and connection.autocommit:
+        raise ValueError("Temporary staging tables require a connection that is not in autocommit mode")
+    # Temporary tables are always named through pg_temp, as the bare name would resolve to the target table through the
+    # search_path before the staging table exists
+    staging_schema = "pg_temp" if staging_table == "temporary" else temporary_schema
+    # Tables in temporary_schema are shared by all sessions, so concurrent writes to the same table get their own
+    staging_name = table if staging_table == "temporary" else _unique_name(table)
+    staging = _identifier(staging_schema, staging_name)
+    logger.info("Dumping to %s staging table using %s", staging_table, staging_engine)
+    if staging_engine == "copy":
+        rows = _stage_copy(
+            staging_name, staging_schema, hashed, connection, staging_table, not isinstance(df, DataFrame), stats
         )
-        if item is not None:
+    elif staging_engine == "sqlalchemy":
+        with timed_stage(stats, "write.staging"):
+            rows = _stage_sqlalchemy(staging_name, staging_schema, hashed, connection, staging_table)
+        if stats is not None:
+            stats.add_rows("write.staging", rows)
+    else:
+        raise ValueError(f"Unknown staging engine {staging_engine}")
+
+    id_column = first.index.name
+    data_columns = [*first.columns, "_hash"]
+    columns = [id_column, *data_columns]
+    logger.debug("Data has columns: %s", columns)
+    logger.debug("Data has index: %s", id_column)
+
+    if deduplicate:
+        with connection.cursor() as cursor, timed_stage(stats, "write.deduplicate"):
             cursor.execute(
-                sql.SQL("""
-                INSERT INTO {}.metadata_assets ("table", item, remote_updated)
-                VALUES (%s, %s, %s)
-                ON CONFLICT ("table", item) DO UPDATE SET remote_updated = EXCLUDED.remote_updated
-            """).format(sql.Identifier(schema)),
-                (table, item, last_updated),
+                sql.SQL("DELETE FROM {} AS a USING {} AS b WHERE a.{} = b.{} AND a.ctid > b.ctid").format(
+                    staging, staging, sql.Identifier(id_column), sql.Identifier(id_column)
+                )
+            )
+            if cursor.rowcount > 0:
+                logger.warning("Layer %s had %d duplicates", table, cursor.rowcount)
+                rows -= cursor.rowcount
+
+    with connection.cursor() as cursor:
+        if storage != "table":
+            if subdivision_value is None:
+                raise ValueError(f"Storage {storage} requires a subdivision value")
+            result = _write_partition(
+                table,
+                schema,
+                staging,
+                id_column,
+                data_columns,
+                subdivision_value,
+                rows,
+                storage == "partition_swap",
+                spatial_index,
+                cursor,
+                stats,
             )
-    connection.commit()
+        elif _table_exists(schema, table, cursor):
+            if _is_partitioned(schema, table, cursor):
+                raise ValueError(f"Table {schema}.{table} is partitioned, write to it with a partition storage mode")
+            # Autovacuum never analyzes temporary tables, without statistics the MERGE join is planned blindly
+            with timed_stage(stats, "write.analyze"):
+                cursor.execute(sql.SQL("ANALYZE {}").format(staging))
+            cursor.execute(sql.SQL("ALTER TABLE {}.{} ADD COLUMN IF NOT EXISTS _hash BIGINT").format(sql.Identifier(schema), sql.Identifier(table)))
+            swap = False
+            if load != "merge" and _only_subdivision(schema, table, subdivision_value, cursor):
+                if load == "auto":
+                    ratio = _change_ratio(schema, table, staging, id_column, rows, cursor)
+                    logger.info("Estimated %.0f%% of the rows to have changed", 100 * ratio)
+                swap = load == "swap" or ratio > SWAP_CHANGE_RATIO
+            elif load == "swap":
+                raise ValueError(f"Table {schema}.{table} holds other subdivisions and cannot be swapped")
+            if swap and (blockers := _swap_blockers(schema, table, cursor)):
+                if load == "swap":
+                    raise ValueError(f"Table {schema}.{table} cannot be swapped, as {', '.join(blockers)} depend on it")
+                logger.info("Merging rather than swapping, as %s depend on %s", ", ".join(blockers), table)
+                swap = False
+            if swap:
+                result = _swap_table(
+                    schema, table, staging, id_column, data_columns, subdivision_value, spatial_index, cursor, stats
+                )
+            else:
+                logger.info("Upserting to existing table")
+                _maintenance_settings(cursor)
+                with timed_stage(stats, "write.index"):
+                    _create_spatial_indexes(schema, table, spatial_index, cursor)
+                query = _merge_query(
+                    sql.Identifier(schema, table), staging, id_column, data_columns, scoped=subdivision_value is not None
+                )
+                logger.debug("Executing query: %s", query.as_string(cursor))
+                with timed_stage(stats, "write.merge"):
+                    cursor.execute(
+                        query,
+                        (subdivision_value,) if subdivision_value is None else (subdivision_value, subdivision_value),
+                    )
+                if stats is not None:
+                    stats.add_rows("write.merge", rows)
+                result = _merge_result(cursor, rows)
+        else:
+            logger.info("Creating new table")
+            with timed_stage(stats, "write.load"):
+                if subdivision_value is None:
+                    cursor.execute(
+                        sql.SQL("""CREATE TABLE {}.{} AS SELECT * FROM {}""").format(
+                            sql.Identifier(schema),
+                            sql.Identifier(table),
+                            staging,
+                        ),
+                    )
+                else:
+                    cursor.execute(
+                        sql.SQL("""CREATE TABLE {}.{} AS SELECT *, {} AS _subdivision FROM {}""").format(
+                            sql.Identifier(schema),
+                            sql.Identifier(table),
+                            sql.Placeholder(),
+                            staging,
+                        ),
+                        (subdivision_value,),
+                    )
+            if stats is not None:
+                stats.add_rows("write.load", rows)
+            # Indexes are built once all rows are in place, which is much faster than maintaining them while loading
+            _maintenance_settings(cursor)
+            with timed_stage(stats, "write.index"):
+                cursor.execute(sql.SQL("""ALTER TABLE {}.{} ADD PRIMARY KEY ({})""").format(sql.Identifier(schema), sql.Identifier(table), sql.Identifier(id_column)))
+                if subdivision_value:
+                    cursor.execute(sql.SQL("""CREATE INDEX ON {}.{} (_subdivision)""").format(sql.Identifier(schema), sql.Identifier(table)))
+                _create_spatial_indexes(schema, table, spatial_index, cursor)
+            with timed_stage(stats, "write.analyze"):
+                cursor.execute(sql.SQL("ANALYZE {}.{}").format(sql.Identifier(schema), sql.Identifier(table)))
+            result = WriteResult(inserted=rows)
+
+        cursor.execute(sql.SQL("DROP TABLE {}").format(staging))
+    logger.info("Inserted %d, updated %d, deleted %d and left %d rows unchanged", result.inserted, result.updated, result.deleted, result.unchanged)
+    return result
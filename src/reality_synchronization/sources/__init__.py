@@ -0,0 +1,52 @@
+import importlib
+import threading
+from importlib.metadata import entry_points
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from reality_synchronization.sources.base import ItemLoader
+
+# Loaders by source id, which is also the collection id of their items, as "module:class" so that the module (and
+# thereby geopandas, GDAL and pystac) is only imported once the source is used. Other packages can add sources through
+# entry points in ENTRY_POINT_GROUP, which are consulted for ids not listed here.
+SOURCES: dict[str, str] = {
+    "fastighetsindelning": "reality_synchronization.sources.lantmateriet.stac:FastighetsindelningLoader",
+    "byggnader": "reality_synchronization.sources.lantmateriet.stac:ByggnaderLoader",
+    "belagenhetsadress": "reality_synchronization.sources.lantmateriet.stac:BelagenhetsadressLoader",
+    "belagenhetsadresser": "reality_synchronization.sources.lantmateriet.stac:BelagenhetsadressLoader",
+    "marktacke": "reality_synchronization.sources.lantmateriet.stac:MarktackeLoader",
+    "kommun-lan-rike": "reality_synchronization.sources.lantmateriet.stac:KommunLanRikeLoader",
+    "ortnamn": "reality_synchronization.sources.lantmateriet.stac:OrtnamnLoader",
+    "smhi-aro": "reality_synchronization.sources.smhi.svar2022:AroLoader",
+    "smhi-haro": "reality_synchronization.sources.smhi.svar2022:HaroLoader",
+}
+
+ENTRY_POINT_GROUP = "reality_synchronization.sources"
+
+_classes: dict[str, type["ItemLoader"]] = {}
+_classes_lock = threading.RLock()
+
+
+def _entry_points() -> dict[str, str]:
+    return {entry_point.name: entry_point.value for entry_point in entry_points(group=ENTRY_POINT_GROUP)}
+
+
+def source_ids() -> list[str]:
+    return sorted({*SOURCES, *_entry_points()})
+
+
+def loader_class(source: str) -> type["ItemLoader"]:
+    with _classes_lock:
+        cls = _classes.get(source)
+        if cls is None:
+            target = SOURCES.get(source) or _entry_points().get(source)
+            if target is None:
+                raise KeyError(f"Unknown source {source}, expected one of {', '.join(source_ids())}")
+            module, _, name = target.partition(":")
+            cls = getattr(importlib.import_module(module), name)
+            _classes[source] = cls
+        return cls
+
+
+def get_loader(source: str) -> "ItemLoader":
+    return loader_class(source)()
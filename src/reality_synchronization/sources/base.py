@@ -0,0 +1,146 @@
+import logging
+from contextlib import AbstractContextManager
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Iterator
+
+from geopandas import GeoDataFrame
+from pystac import Asset, Item
+from requests import Session
+
+from reality_synchronization.util.download import DownloadCache, OnBytes
+from reality_synchronization.util.load_remote_zip import (
+    Subset,
+    ZipMode,
+    load_remote_zip,
+    open_remote_zip,
+    read_layer_batches,
+    read_layers,
+    stream_remote_zip,
+)
+from reality_synchronization.util.pipeline import PipelineStats
+
+logger = logging.getLogger(__name__)
+
+
+def _checksum(asset: Asset) -> str | None:
+    return asset.extra_fields.get("file:checksum")
+
+
+@dataclass
+class LoadResult:
+    remote_updated: datetime | None
+    layers: dict[str, GeoDataFrame]
+
+
+@dataclass
+class LoadStream:
+    remote_updated: datetime | None
+    # Each layer yields its data in batches, which have to be consumed before moving on to the next layer
+    layers: Iterator[tuple[str, Iterator[GeoDataFrame]]]
+
+
+class Loader:
+    scope: str | None
+    provider: str
+
+    def load(self, subdivision: str, session: Session, subset: Subset | None = None) -> LoadResult:
+        raise NotImplementedError
+
+    def stream(self, subdivision: str, session: Session, batch_size: int, subset: Subset | None = None) -> LoadStream:
+        raise NotImplementedError
+
+    def last_updated(self, subdivision: str, session: Session | None = None) -> datetime | None:
+        raise NotImplementedError
+
+
+class ItemLoader(Loader):
+    # A loader whose subdivisions are described by STAC items in the collection domain, with the data as a zip archive
+    # in their data asset. Subclasses find the items and postprocess the layers, the rest is shared, including the
+    # download and read steps used by the Synchronizer.
+    domain: str
+    # Columns that _postprocess needs, which are read even when a subset leaves them out
+    required_columns: tuple[str, ...] = ()
+
+    def item(self, subdivision: str | Item, session: Session | None = None) -> Item:
+        raise NotImplementedError
+
+    def _subset(self, subset: Subset | None) -> Subset | None:
+        return subset.with_columns(self.required_columns) if subset is not None else None
+
+    def load(
+        self,
+        subdivision: str | Item,
+        session: Session,
+        zip_mode: ZipMode = "vsizip",
+        subset: Subset | None = None,
+    ) -> LoadResult:
+        item = self.item(subdivision, session)
+        asset = item.assets["data"]
+        return LoadResult(
+            layers=load_remote_zip(
+                asset.href, session, self._postprocess, zip_mode, _checksum(asset), self._subset(subset)
+            ),
+            remote_updated=item.common_metadata.updated,
+        )
+
+    def stream(
+        self,
+        subdivision: str | Item,
+        session: Session,
+        batch_size: int = 65536,
+        zip_mode: ZipMode = "vsizip",
+        subset: Subset | None = None,
+    ) -> LoadStream:
+        item = self.item(subdivision, session)
+        asset = item.assets["data"]
+        return LoadStream(
+            layers=stream_remote_zip(
+                asset.href,
+                session,
+                self._postprocess,
+                batch_size,
+                self._batchable,
+                zip_mode,
+                _checksum(asset),
+                self._subset(subset),
+            ),
+            remote_updated=item.common_metadata.updated,
+        )
+
+    def download(
+        self,
+        subdivision: str | Item,
+        session: Session,
+        zip_mode: ZipMode = "vsizip",
+        cache: DownloadCache | None = None,
+        download_parts: int = 4,
+        on_bytes: OnBytes | None = None,
+        subset: Subset | None = None,
+    ) -> AbstractContextManager[str]:
+        # Split from read so that the next item can be downloaded while the current one is being read. The subset is
+        # for sources that can filter on the server, a zip archive is always downloaded whole.
+        item = self.item(subdivision, session)
+        asset = item.assets["data"]
+        return open_remote_zip(asset.href, session, zip_mode, _checksum(asset), cache, download_parts, on_bytes)
+
+    def read(
+        self,
+        file: str,
+        batch_size: int | None = None,
+        stats: PipelineStats | None = None,
+        subset: Subset | None = None,
+    ) -> Iterator[tuple[str, GeoDataFrame | Iterator[GeoDataFrame]]]:
+        if batch_size is None:
+            return read_layers(file, self._postprocess, stats, self._subset(subset))
+        return read_layer_batches(file, self._postprocess, batch_size, self._batchable, stats, self._subset(subset))
+
+    def last_updated(self, subdivision: str | Item, session: Session | None = None) -> datetime | None:
+        return self.item(subdivision, session).common_metadata.updated
+
+    def _postprocess(self, layer: str, df: GeoDataFrame) -> GeoDataFrame:
+        return df
+
+    def _batchable(self, layer: str) -> bool:
+        # Whether _postprocess gives the same result when applied to parts of the layer separately
+        return True
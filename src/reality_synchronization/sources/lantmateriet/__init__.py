@@ -0,0 +1,2 @@
+# Kept apart from the loaders, so that listing items does not import geopandas
+STAC_URL = "https://api.lantmateriet.se/stac-vektor/v1/"
@@ -1,69 +1,51 @@
+import numpy as np
 import pandas as pd
-from typing import Any, Literal
+import shapely
+from typing import Literal
 
 import logging
-import os
-from dataclasses import dataclass
 from datetime import datetime
 
 from geopandas import GeoDataFrame
 from pystac import Item
-from pystac_client import Client
 from requests import Session
 
-from reality_synchronization import make_oauth2_session
-from reality_synchronization.util.load_remote_zip import load_remote_zip
+from reality_synchronization.sources.base import ItemLoader, LoadResult
+from reality_synchronization.sources.lantmateriet import STAC_URL
+from reality_synchronization.util.load_remote_zip import Subset, ZipMode
+from reality_synchronization.util.stac import TTLCache, stac_client
 
 logger = logging.getLogger(__name__)
 
+# Items by (collection, item id), shared by all loaders in the process
+_items: TTLCache[Item] = TTLCache()
 
-@dataclass
-class LoadResult:
-    remote_updated: datetime | None
-    layers: dict[str, GeoDataFrame]
+# Buildings with at most this many parts are merged together in one padded array
+_MAX_PADDED_PARTS = 32
 
 
-class Loader:
-    scope: str | None
-
-    def load(self, subdivision: str, session: Session) -> LoadResult:
-        raise NotImplementedError
-
-    def last_updated(self, subdivision: str, session: Session) -> datetime | None:
-        raise NotImplementedError
-
-
-class LantmaterietStacLoader(Loader):
-    domain: str
+class LantmaterietStacLoader(ItemLoader):
+    provider = "Lantmäteriet"
 
     @classmethod
     def _get_item(cls, municipality_code: str | Item) -> Item:
         if isinstance(municipality_code, Item):
             return municipality_code
-        stac_client = Client.open("https://api.lantmateriet.se/stac-vektor/v1/")
-        return stac_client.get_collection(cls.domain).get_item(municipality_code)
+        item = _items.get((cls.domain, municipality_code))
+        if item is None:
+            item = stac_client(STAC_URL).get_collection(cls.domain).get_item(municipality_code)
+            if item is not None:
+                _items.put((cls.domain, municipality_code), item)
+        return item
 
-    def load(self, municipality_code: str | Item, session: Session) -> LoadResult:
-        item = self._get_item(municipality_code)
-        href = item.assets["data"].href
-        return LoadResult(
-            layers=load_remote_zip(href, session, self._postprocess),
-            remote_updated=item.common_metadata.updated,
-        )
-
-    def last_updated(
-        self, municipality_code: str | Item, session: Session
-    ) -> datetime | None:
-        item = self._get_item(municipality_code)
-        return item.common_metadata.updated
-
-    def _postprocess(self, layer: str, df: GeoDataFrame) -> GeoDataFrame:
-        return df
+    def item(self, municipality_code: str | Item, session: Session | None = None) -> Item:
+        return self._get_item(municipality_code)
 
 
 class FastighetsindelningLoader(LantmaterietStacLoader):
     scope = "ogc-features:fastighetsindelning.read"
     domain = "fastighetsindelning"
+    required_columns = ("objektidentitet",)
 
     def _postprocess(self, layer: str, df: GeoDataFrame) -> GeoDataFrame:
         if layer in ("registerenhetsomradesgrans", "registerenhetsomradesyta", "registerenhetsomradeslinje", "registerenhetsomradespunkt", "granspunkt"):
@@ -74,6 +56,7 @@ class FastighetsindelningLoader(LantmaterietStacLoader):
 class BelagenhetsadressLoader(LantmaterietStacLoader):
     scope = None
     domain = "belagenhetsadress"
+    required_columns = ("belagenhetsadress_objektidentitet",)
 
     def _postprocess(self, layer: str, df: GeoDataFrame) -> GeoDataFrame:
         if layer == "belagenhetsadress":
@@ -84,27 +67,58 @@ class BelagenhetsadressLoader(LantmaterietStacLoader):
 class ByggnaderLoader(LantmaterietStacLoader):
     scope = None
     domain = "byggnader"
+    required_columns = ("objektidentitet", "huvudbyggnad", "husnummer")
 
     @staticmethod
-    def _none_if_different(series: pd.Series) -> Any:
-        if series.nunique() > 1:
-            return None
-        return series.iloc[0]
+    def _merge_parts(df: GeoDataFrame) -> GeoDataFrame:
+        # Same result as dissolve(by="objektidentitet", aggfunc=<None if the values differ, else the first value>), but
+        # without calling back into Python for every group and column. Like dissolve, rows without an ID are dropped.
+        df = df[df["objektidentitet"].notna()]
+        geometry_name = df.geometry.name
+        codes, ids = pd.factorize(df["objektidentitet"])
+        attributes = df.drop(columns=geometry_name).set_index("objektidentitet")
+        first = attributes[~attributes.index.duplicated()]
+        differs = attributes.groupby(level=0, sort=False).nunique() > 1
+        attributes = first.mask(differs, None)
+
+        # Lays out the parts of every building in a row of a padded array so that they can be unioned in one call. The
+        # array is as wide as the building with the most parts, so buildings with more than _MAX_PADDED_PARTS parts are
+        # left out of it and unioned one by one.
+        order = np.argsort(codes, kind="stable")
+        sorted_codes = codes[order]
+        sorted_parts = df.geometry.to_numpy()[order]
+        counts = np.bincount(codes)
+        ends = np.cumsum(counts)
+        positions = np.arange(len(codes)) - np.repeat(ends - counts, counts)
+        padded = counts[sorted_codes] <= _MAX_PADDED_PARTS
+        parts = np.full((len(ids), positions[padded].max(initial=-1) + 1), None, dtype=object)
+        parts[sorted_codes[padded], positions[padded]] = sorted_parts[padded]
+        geometry = shapely.union_all(parts, axis=1)
+        for code in np.flatnonzero(counts > _MAX_PADDED_PARTS):
+            geometry[code] = shapely.union_all(sorted_parts[ends[code] - counts[code] : ends[code]])
+
+        merged = GeoDataFrame({geometry_name: geometry}, index=first.index, geometry=geometry_name, crs=df.crs)
+        return merged.join(attributes)
 
     def _postprocess(self, layer: str, df: GeoDataFrame) -> GeoDataFrame:
         if layer == "byggnad":
             # Buildings with multiple parts can occur multiple times with the same ID, so we need to merge them,
-            # however just some attributes might differ. As using a user defined function for aggfunc is quite slow, we
-            # only dissolve on actually duplicated rows.
+            # however just some attributes might differ. Only the actually duplicated rows are merged.
             duplicates = df.duplicated(subset=["objektidentitet"], keep=False)
             non_duplicated = df[~duplicates].set_index("objektidentitet")
-            duplicated = df[duplicates].dissolve(by="objektidentitet", aggfunc=self._none_if_different, as_index=True, sort=False)
-            df = pd.concat([non_duplicated, duplicated])
+            if duplicates.any():
+                df = pd.concat([non_duplicated, self._merge_parts(df[duplicates])])
+            else:
+                df = non_duplicated
 
             df.huvudbyggnad = df.huvudbyggnad == "Ja"
             df.husnummer = df.husnummer.astype("Int64")
         return df
 
+    def _batchable(self, layer: str) -> bool:
+        # Parts of the same building can end up in different batches
+        return layer != "byggnad"
+
 
 class MarktackeLoader(LantmaterietStacLoader):
     scope = "ogc-features:marktacke.read"
@@ -119,16 +133,23 @@ class OrtnamnLoader(LantmaterietStacLoader):
 class KommunLanRikeLoader(LantmaterietStacLoader):
     scope = None
     domain = "kommun-lan-rike"
+    required_columns = ("objektidentitet",)
 
     def _postprocess(self, layer: str, df: GeoDataFrame) -> GeoDataFrame:
         if layer in ("kommun", "lan", "rike"):
             df = df.set_index("objektidentitet")
         return df
 
-    def load(self, municipality_code: Literal["aktuell"], session: Session) -> LoadResult:
-        return super().load(municipality_code, session)
+    def load(
+        self,
+        municipality_code: Literal["aktuell"],
+        session: Session,
+        zip_mode: ZipMode = "vsizip",
+        subset: Subset | None = None,
+    ) -> LoadResult:
+        return super().load(municipality_code, session, zip_mode, subset)
 
     def last_updated(
-        self, municipality_code: Literal["aktuell"], session: Session
+        self, municipality_code: Literal["aktuell"], session: Session | None = None
     ) -> datetime | None:
         return super().last_updated(municipality_code, session)
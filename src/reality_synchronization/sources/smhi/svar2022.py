@@ -1,21 +1,173 @@
-import geopandas
+from contextlib import AbstractContextManager, contextmanager
+from dataclasses import replace
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Iterator
+
 import requests
 from geopandas import GeoDataFrame
+from pystac import Asset, Item
+from requests import Session
+
+from reality_synchronization.sources.base import ItemLoader, LoadResult, LoadStream
+from reality_synchronization.util.download import DownloadCache, OnBytes
+from reality_synchronization.util.load_remote_zip import Subset, ZipMode
+from reality_synchronization.util.pipeline import PipelineStats
+from reality_synchronization.util.stac import TTLCache
+from reality_synchronization.util.wfs import download_wfs
+
+ARO_URL = "https://opendata-download.smhi.se/svar/SVAR2022_delavrinningsomraden.zip"
+HARO_URL = "https://opendata-view.smhi.se/SMHI_vatten_RiverBasin/HY.PhysicalWaters.Catchments/wfs?service=wfs&request=getfeature&typeNames=SMHI_vatten_RiverBasin:HY.PhysicalWaters.Catchments&outputFormat=json"
+
+# Items by (source, subdivision), so that the remote timestamp is only asked for once per job
+_items: TTLCache[Item] = TTLCache()
+
 
-from reality_synchronization.util.load_remote_zip import load_remote_zip
+def _last_modified(url: str, session: Session) -> datetime | None:
+    # Not every server answers HEAD requests or sends Last-Modified, in which case the data is always loaded
+    with session.head(url, allow_redirects=True) as response:
+        header = response.headers.get("Last-Modified") if response.ok else None
+    try:
+        return parsedate_to_datetime(header) if header else None
+    except (TypeError, ValueError):
+        return None
 
 
-def load_aro():
-    url = "https://opendata-download.smhi.se/svar/SVAR2022_delavrinningsomraden.zip"
+class SmhiLoader(ItemLoader):
+    # SMHI publishes each dataset as a single file without a STAC API, so a single item is made up for it with the file
+    # as its data asset and the Last-Modified header as its updated timestamp
+    provider = "SMHI"
+    scope = None
+    url: str
+    subdivision: str
 
-    def postprocess(layer: str, df: GeoDataFrame) -> GeoDataFrame:
+    def item(self, subdivision: str | Item, session: Session | None = None) -> Item:
+        if isinstance(subdivision, Item):
+            return subdivision
+        if subdivision != self.subdivision:
+            raise KeyError(f"{self.domain} only has the subdivision {self.subdivision}, not {subdivision}")
+        item = _items.get((self.domain, subdivision))
+        if item is None:
+            if session is None:
+                with requests.Session() as session:
+                    updated = _last_modified(self.url, session)
+            else:
+                updated = _last_modified(self.url, session)
+            item = Item(
+                subdivision,
+                geometry=None,
+                bbox=None,
+                datetime=updated or datetime.now(timezone.utc),
+                properties={},
+                collection=self.domain,
+                href=self.url,
+            )
+            if updated is not None:
+                item.common_metadata.updated = updated
+            item.add_asset("data", Asset(self.url))
+            _items.put((self.domain, subdivision), item)
+        return item
+
+
+class AroLoader(SmhiLoader):
+    domain = "smhi-aro"
+    url = ARO_URL
+    subdivision = "svar2022"
+    required_columns = ("ARO_UUID",)
+
+    def _postprocess(self, layer: str, df: GeoDataFrame) -> GeoDataFrame:
         return df.set_index("ARO_UUID")
 
+
+class HaroLoader(SmhiLoader):
+    # Served by a WFS rather than as a zip archive, so the subset is applied by the server and the features are fetched
+    # in pages, several at a time. The download cache is not used, as every subset gives a different file.
+    domain = "smhi-haro"
+    url = HARO_URL
+    subdivision = "aktuell"
+    required_columns = ("HARO",)
+    page_size = 10000
+
+    def load(
+        self,
+        subdivision: str | Item,
+        session: Session,
+        zip_mode: ZipMode = "vsizip",
+        subset: Subset | None = None,
+    ) -> LoadResult:
+        item = self.item(subdivision, session)
+        with self.download(item, session, subset=subset) as file:
+            return LoadResult(remote_updated=item.common_metadata.updated, layers=dict(self.read(file, subset=subset)))
+
+    def stream(
+        self,
+        subdivision: str | Item,
+        session: Session,
+        batch_size: int = 65536,
+        zip_mode: ZipMode = "vsizip",
+        subset: Subset | None = None,
+    ) -> LoadStream:
+        item = self.item(subdivision, session)
+
+        def layers() -> Iterator[tuple[str, Iterator[GeoDataFrame]]]:
+            with self.download(item, session, subset=subset) as file:
+                yield from self.read(file, batch_size, subset=subset)
+
+        return LoadStream(remote_updated=item.common_metadata.updated, layers=layers())
+
+    @contextmanager
+    def _download(
+        self, item: Item, session: Session, subset: Subset | None, concurrency: int, on_bytes: OnBytes | None
+    ) -> Iterator[str]:
+        subset = self._subset(subset)
+        with download_wfs(
+            item.assets["data"].href,
+            session,
+            subset.bbox if subset is not None else None,
+            subset.crs if subset is not None else "EPSG:3006",
+            subset.columns if subset is not None else None,
+            sort_by="HARO",
+            page_size=self.page_size,
+            concurrency=concurrency,
+            on_bytes=on_bytes,
+        ) as path:
+            yield str(path)
+
+    def download(
+        self,
+        subdivision: str | Item,
+        session: Session,
+        zip_mode: ZipMode = "vsizip",
+        cache: DownloadCache | None = None,
+        download_parts: int = 4,
+        on_bytes: OnBytes | None = None,
+        subset: Subset | None = None,
+    ) -> AbstractContextManager[str]:
+        return self._download(self.item(subdivision, session), session, subset, download_parts, on_bytes)
+
+    def read(
+        self,
+        file: str,
+        batch_size: int | None = None,
+        stats: PipelineStats | None = None,
+        subset: Subset | None = None,
+    ) -> Iterator[tuple[str, GeoDataFrame | Iterator[GeoDataFrame]]]:
+        # GDAL names the only layer after the downloaded file
+        if subset is not None and not subset.includes("catchments"):
+            return
+        for _, data in super().read(file, batch_size, stats, replace(subset, layers=None) if subset else None):
+            yield "catchments", data
+
+    def _postprocess(self, layer: str, df: GeoDataFrame) -> GeoDataFrame:
+        return df.set_index("HARO")
+
+
+def load_aro(subset: Subset | None = None):
     with requests.Session() as session:
-        return load_remote_zip(url, session, postprocess)
+        return AroLoader().load("svar2022", session, subset=subset).layers
 
 
-def load_haro():
-    df = geopandas.read_file("https://opendata-view.smhi.se/SMHI_vatten_RiverBasin/HY.PhysicalWaters.Catchments/wfs?service=wfs&request=getfeature&typeNames=SMHI_vatten_RiverBasin:HY.PhysicalWaters.Catchments&outputFormat=json")
-    df = df.set_index("HARO")
+def load_haro(subset: Subset | None = None):
+    with requests.Session() as session:
+        (df,) = HaroLoader().load("aktuell", session, subset=subset).layers.values()
     return df
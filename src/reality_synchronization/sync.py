@@ -0,0 +1,421 @@
+import logging
+import threading
+import uuid
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import ExitStack, contextmanager
+from dataclasses import asdict, dataclass
+from itertools import chain
+from pathlib import Path
+from typing import Callable, Iterable, Iterator
+
+import psycopg
+from pandas import DataFrame
+from pyogrio import list_layers
+from pystac import Item
+from requests import Session
+
+from reality_synchronization.options import LoadStrategy, SpatialIndex, Storage, ZipMode
+from reality_synchronization.sinks.metadata import upsert_metadata
+from reality_synchronization.sinks.postgis import WriteResult, write_postgis
+from reality_synchronization.sources.base import ItemLoader
+from reality_synchronization.util.download import download_cache
+from reality_synchronization.util.load_remote_zip import Subset
+from reality_synchronization.util.pipeline import ConnectionPerThread, PipelineStats, prefetch
+from reality_synchronization.util.snapshot import SnapshotCache, read_snapshot, snapshot_cache, snapshot_layers
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class SyncJob:
+    loader: ItemLoader
+    item: Item
+    session: Session
+
+
+@dataclass
+class SyncOptions:
+    schema: str = "data"
+    temporary_schema: str = "temporary_data"
+    zip_mode: ZipMode = "vsizip"
+    # Read layers in batches of this many rows instead of loading them whole
+    batch_size: int | None = None
+    # Number of items downloaded ahead of the one being read
+    download_prefetch: int = 1
+    # Number of range requests each download is split into
+    download_parts: int = 4
+    # Directory in which downloads are kept between jobs, evicting the least recently used beyond download_cache_size
+    download_cache: str | None = None
+    download_cache_size: int = 20 << 30
+    # Number of layers (or batches when streaming) read ahead of the ones being written
+    parse_prefetch: int = 1
+    # Number of layers written at the same time, each on its own connection
+    write_concurrency: int = 1
+    # How the tables are laid out, see options.Storage
+    storage: Storage = "table"
+    # How existing tables are updated, see options.LoadStrategy
+    load: LoadStrategy = "merge"
+    # Index built on geometry columns, see options.SpatialIndex
+    spatial_index: SpatialIndex = "gist"
+    # Commit the layers of an item together or not at all, through two-phase commit. Every layer of the item holds a
+    # connection and a prepared transaction until the item is done, so max_prepared_transactions on the server and the
+    # size of the connection pool have to allow for that. Stages into unlogged tables as temporary tables cannot be
+    # part of a prepared transaction.
+    atomic: bool = False
+    # Directory in which the postprocessed layers of items are kept as GeoParquet, so that they can be loaded again
+    # without downloading and parsing them. The least recently used are evicted beyond snapshot_cache_size.
+    snapshot_cache: str | None = None
+    snapshot_cache_size: int = 50 << 30
+    # Only load the features, columns and layers in the subset, pushed down to GDAL or to the server of the source. The
+    # subdivisions of an item are replaced by what is in the subset, so rows outside it are deleted from the tables.
+    subset: Subset | None = None
+
+
+def _write_layer(
+    item: Item,
+    layer: str,
+    data: DataFrame | Iterator[DataFrame],
+    connection: psycopg.Connection,
+    options: SyncOptions,
+    stats: PipelineStats | None = None,
+) -> WriteResult | None:
+    table = f"{item.collection_id}_{layer}"
+    if not isinstance(data, DataFrame):
+        # Peek at the first batch to find out whether the layer can be written at all
+        first = next(data, None)
+        if first is None:
+            logger.info("Ignoring layer %s as it is empty", layer)
+            return None
+        index_name = first.index.name
+        data = chain([first], data)
+    else:
+        index_name = data.index.name
+        logger.info("Writing %d rows to %s", len(data), table)
+    if index_name is None:
+        logger.info("Ignoring layer %s as it does not have a named index", layer)
+        return None
+    return write_postgis(
+        table,
+        options.schema,
+        options.temporary_schema,
+        data,
+        connection,
+        item.id,
+        deduplicate=layer == "granspunkt",
+        staging_table="unlogged" if options.atomic else "temporary",
+        storage=options.storage,
+        load=options.load,
+        spatial_index=options.spatial_index,
+        stats=stats,
+    )
+
+
+def _download(
+    jobs: Iterable[SyncJob],
+    options: SyncOptions,
+    stats: PipelineStats,
+    on_bytes: Callable[[SyncJob, int, int | None], None] | None = None,
+) -> Iterator[tuple[SyncJob, str | Path | None, ExitStack, Exception | None]]:
+    # Errors are passed on with the job rather than raised, so that they can be attributed to the failing item. With a
+    # snapshot cache, the downloaded file is parsed into a snapshot right away and the snapshot path is passed on.
+    cache = download_cache(options.download_cache, options.download_cache_size) if options.download_cache else None
+    snapshots = snapshot_cache(options.snapshot_cache, options.snapshot_cache_size) if options.snapshot_cache else None
+    for job in jobs:
+        stack = ExitStack()
+
+        def received(count: int, size: int | None, job: SyncJob = job) -> None:
+            stats.add_bytes("download", count)
+            if on_bytes is not None:
+                on_bytes(job, count, size)
+
+        try:
+            key = snapshots.item_key(job.item, options.subset) if snapshots is not None else None
+            if key is None:
+                with stats.stage("download"):
+                    file = stack.enter_context(
+                        job.loader.download(
+                            job.item,
+                            job.session,
+                            options.zip_mode,
+                            cache,
+                            options.download_parts,
+                            received,
+                            options.subset,
+                        )
+                    )
+            else:
+                file = stack.enter_context(snapshots.use(key))
+                if file is not None:
+                    logger.info("Using snapshot of item %s", job.item.id)
+                else:
+                    with ExitStack() as download:
+                        with stats.stage("download"):
+                            downloaded = download.enter_context(
+                                job.loader.download(
+                                    job.item,
+                                    job.session,
+                                    options.zip_mode,
+                                    cache,
+                                    options.download_parts,
+                                    received,
+                                    options.subset,
+                                )
+                            )
+                        with stats.stage("snapshot"):
+                            file = snapshots.write(
+                                key, job.loader.read(downloaded, options.batch_size, stats, options.subset)
+                            )
+        except Exception as e:
+            stack.close()
+            yield job, None, stack, e
+        else:
+            yield job, file, stack, None
+
+
+def warm_snapshots(
+    jobs: Iterable[SyncJob], options: SyncOptions, stats: PipelineStats | None = None
+) -> Iterator[dict]:
+    # Downloads and parses items into the snapshot cache without writing them anywhere
+    if not options.snapshot_cache:
+        raise ValueError("Warming snapshots requires a snapshot cache")
+    versioned = []
+    for job in jobs:
+        if SnapshotCache.item_key(job.item, options.subset) is None:
+            logger.warning("Not snapshotting item %s, which has no updated timestamp", job.item.id)
+            yield dict(item=job.item.id, skipped=True)
+        else:
+            versioned.append(job)
+    for job, file, stack, error in _download(versioned, options, stats or PipelineStats()):
+        with stack:
+            if error is not None:
+                logger.error("Failed to snapshot item %s: %s", job.item.id, error)
+                yield dict(item=job.item.id, error=f"{type(error).__name__}: {error}")
+            else:
+                yield dict(item=job.item.id, layers=snapshot_layers(file))
+
+
+def _transaction_prefix(job: SyncJob) -> str:
+    # Item ids are only unique within a collection
+    return f"reality-synchronization:{job.item.collection_id}/{job.item.id}:"
+
+
+class Synchronizer:
+    def __init__(
+        self,
+        connect: Callable[[], psycopg.Connection],
+        options: SyncOptions | None = None,
+        on_progress: Callable[[Item, float], None] | None = None,
+        release: Callable[[psycopg.Connection], None] | None = None,
+    ):
+        # on_progress is called with the fraction of an item that is done, the first half by the bytes downloaded and
+        # the second half by the layers written
+        self.options = options or SyncOptions()
+        self.stats = PipelineStats()
+        self._connections = ConnectionPerThread(connect, release)
+        self._on_progress = on_progress
+        self._received: dict[str, int] = {}
+        self._received_lock = threading.Lock()
+
+    def _on_bytes(self, job: SyncJob, count: int, size: int | None) -> None:
+        if self._on_progress is None or not size:
+            return
+        with self._received_lock:
+            received = self._received.get(job.item.id, 0) + count
+            self._received[job.item.id] = received
+        # Only whole percents are reported, as the callback can be expensive, e.g. a request to Windmill
+        if (received - count) * 100 // size != received * 100 // size:
+            self._on_progress(job.item, 0.5 * min(received / size, 1.0))
+
+    def _write(
+        self,
+        job: SyncJob,
+        layer: str,
+        data: DataFrame | Iterator[DataFrame],
+        prepared: list[psycopg.Connection] | None = None,
+    ) -> tuple[str, int | None, WriteResult | None]:
+        # With prepared, the transaction is prepared rather than committed and its connection is added to prepared, to
+        # be committed or rolled back together with the other layers of the item
+        connection = self._connections.get()
+        rows = len(data) if isinstance(data, DataFrame) else None
+        if not isinstance(data, DataFrame):
+            # Reads the next batch while the current one is being copied
+            data = prefetch(self.stats.timed("parse", data), self.options.parse_prefetch, f"parse-{layer}")
+        if prepared is not None:
+            # Named after the item, so that transactions left prepared by a run that died can be found
+            connection.tpc_begin(f"{_transaction_prefix(job)}{layer}:{uuid.uuid4().hex[:8]}")
+        try:
+            with self.stats.stage("write"):
+                result = _write_layer(job.item, layer, data, connection, self.options, self.stats)
+            with self.stats.stage("metadata"):
+                logger.info("Updating metadata for layer %s", layer)
+                upsert_metadata(
+                    f"{job.item.collection_id}_{layer}",
+                    f"{job.item.collection_id}/{layer}",
+                    layer,
+                    job.loader.provider,
+                    job.loader.last_updated(job.item),
+                    self.options.schema,
+                    job.item.self_href,
+                    connection,
+                    commit=prepared is None,
+                )
+            if prepared is not None:
+                connection.tpc_prepare()
+                # The connection cannot be used until the prepared transaction is finished, so the next layer written by
+                # this thread gets another one
+                prepared.append(self._connections.detach())
+        except BaseException:
+            if prepared is None:
+                connection.rollback()
+            else:
+                try:
+                    connection.tpc_rollback()
+                except psycopg.Error:
+                    # E.g. when PREPARE TRANSACTION itself failed, after which psycopg cannot tell what state the
+                    # connection is in
+                    connection.close()
+            raise
+        if rows is None and result is not None:
+            rows = result.inserted + result.updated + result.unchanged
+        if rows is not None:
+            self.stats.add_rows("write", rows)
+        return layer, rows, result
+
+    def _sync_item(self, job: SyncJob, file: str | Path, executor: ThreadPoolExecutor) -> dict:
+        with self._received_lock:
+            self._received.pop(job.item.id, None)
+        if self._on_progress is not None:
+            self._on_progress(job.item, 0.5)
+        if isinstance(file, Path):
+            layer_count = len(snapshot_layers(file))
+            read = read_snapshot(file, self.options.batch_size is not None)
+        else:
+            subset = self.options.subset
+            layer_count = sum(subset is None or subset.includes(layer) for layer, _ in list_layers(file))
+            read = job.loader.read(file, self.options.batch_size, self.stats, subset)
+        layers = prefetch(
+            self.stats.timed("parse", read),
+            # Streamed layers are read lazily by the writers, so there is nothing to gain from reading them ahead
+            self.options.parse_prefetch if self.options.batch_size is None else 0,
+            f"parse-{job.item.id}",
+        )
+        rows = {}
+        changes = {}
+        written = []
+        pending: set[Future] = set()
+        prepared: list[psycopg.Connection] | None = [] if self.options.atomic else None
+
+        def collect(done: set[Future]) -> None:
+            for future in done:
+                layer, layer_rows, result = future.result()
+                written.append(layer)
+                if layer_rows is not None:
+                    rows[layer] = layer_rows
+                if result is not None:
+                    changes[layer] = asdict(result)
+                if self._on_progress is not None:
+                    self._on_progress(job.item, 0.5 + 0.5 * len(written) / max(layer_count, 1))
+
+        with ExitStack() as stack:
+            if prepared is not None:
+                stack.enter_context(self._item_lock(job))
+            try:
+                try:
+                    for layer, data in layers:
+                        # Bounds the number of layers held in memory to the number of writers
+                        while len(pending) >= self.options.write_concurrency:
+                            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                            collect(done)
+                        pending.add(executor.submit(self._write, job, layer, data, prepared))
+                    done, pending = wait(pending)
+                    collect(done)
+                finally:
+                    for future in pending:
+                        future.cancel()
+                    wait(pending)
+            except BaseException:
+                if prepared:
+                    self._finish_prepared(prepared, commit=False)
+                raise
+            if prepared:
+                self._finish_prepared(prepared, commit=True)
+
+        return dict(item=job.item.id, layers=rows, changes=changes, last_updated=job.loader.last_updated(job.item))
+
+    @contextmanager
+    def _item_lock(self, job: SyncJob) -> Iterator[None]:
+        # Held while the layers of an item are prepared and finished, so that only one run at a time prepares
+        # transactions for the item. Transactions prepared for it that are found while holding the lock were left by a
+        # run that died, and keep their locks and hold back the xmin horizon until they are rolled back.
+        connection = self._connections.get()
+        # Session locks outlive transactions, but the session must not be left in one while the layers are written
+        connection.autocommit = True
+        try:
+            connection.execute("SELECT pg_advisory_lock(hashtextextended(%s, 0))", (_transaction_prefix(job),))
+            try:
+                stale = [
+                    xid
+                    for xid in connection.tpc_recover()
+                    if xid.database == connection.info.dbname and xid.gtrid.startswith(_transaction_prefix(job))
+                ]
+                if stale:
+                    logger.warning("Rolling back %d transactions left prepared for item %s", len(stale), job.item.id)
+                    for xid in stale:
+                        connection.tpc_rollback(xid)
+                yield
+            finally:
+                connection.execute("SELECT pg_advisory_unlock(hashtextextended(%s, 0))", (_transaction_prefix(job),))
+        finally:
+            connection.autocommit = False
+
+    def _finish_prepared(self, connections: list[psycopg.Connection], commit: bool) -> None:
+        # Commits or rolls back the prepared transactions of an item on the connections that prepared them, and gives
+        # the connections back
+        logger.info("%s %d prepared transactions", "Committing" if commit else "Rolling back", len(connections))
+        failed: psycopg.Error | None = None
+        for connection in connections:
+            if commit and failed is not None:
+                # Left prepared for the next run of the item to roll back
+                connection.close()
+            else:
+                try:
+                    if commit:
+                        connection.tpc_commit()
+                    else:
+                        connection.tpc_rollback()
+                except psycopg.Error as e:
+                    logger.exception("Could not finish a prepared transaction")
+                    failed = failed or e
+                    connection.close()
+            self._connections.release(connection)
+        if commit and failed is not None:
+            raise failed
+
+    def sync(self, jobs: Iterable[SyncJob], isolate_failures: bool = False) -> Iterator[dict]:
+        # With isolate_failures, an item that fails is reported with its error instead of aborting the remaining items
+        # /vsicurl/ reads are configured through process wide GDAL options, so items are not opened ahead of time
+        download_prefetch = self.options.download_prefetch if self.options.zip_mode != "vsicurl" else 0
+        downloads = prefetch(
+            _download(jobs, self.options, self.stats, self._on_bytes), download_prefetch, "download"
+        )
+        with ThreadPoolExecutor(max_workers=self.options.write_concurrency, thread_name_prefix="write") as executor:
+            for job, file, stack, error in downloads:
+                with stack:
+                    try:
+                        if error is not None:
+                            raise error
+                        yield self._sync_item(job, file, executor)
+                    except Exception as e:
+                        if not isolate_failures:
+                            raise
+                        logger.exception("Failed to synchronize item %s", job.item.id)
+                        yield dict(item=job.item.id, error=f"{type(e).__name__}: {e}")
+
+    def close(self) -> None:
+        self._connections.close()
+
+    def __enter__(self) -> "Synchronizer":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
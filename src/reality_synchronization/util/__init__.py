@@ -1,12 +1,236 @@
-from typing import Any
+import asyncio
+import json
+import logging
+import random
+import threading
+import time
+from typing import Any, AsyncIterator, Callable
 
+import httpx
+from pystac_client.exceptions import APIError
 from pystac_client.stac_api_io import StacApiIO
+from requests import Request
+
+logger = logging.getLogger(__name__)
+
+_RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Keep-alive connections are reused between requests, HTTP/2 multiplexes requests to the same host over one of them
+# and responses are compressed with gzip or brotli (the encodings httpx advertises depend on what is installed)
+_CLIENT_OPTIONS: dict[str, Any] = dict(
+    http2=True,
+    follow_redirects=True,
+    timeout=httpx.Timeout(60.0, connect=10.0),
+    limits=httpx.Limits(max_connections=32, max_keepalive_connections=16, keepalive_expiry=60.0),
+)
+
+_client: httpx.Client | None = None
+_client_lock = threading.Lock()
+
+
+def shared_http_client() -> httpx.Client:
+    global _client
+    with _client_lock:
+        if _client is None or _client.is_closed:
+            _client = httpx.Client(**_CLIENT_OPTIONS)
+        return _client
+
+
+def _retry_delay(attempt: int, response: httpx.Response | None, backoff: float) -> float:
+    retry_after = response.headers.get("Retry-After", "") if response is not None else ""
+    if retry_after.isdigit():
+        return float(retry_after)
+    # Full jitter, so that parallel jobs that were throttled at the same time do not retry in lockstep
+    return random.uniform(0, backoff * 2**attempt)
+
+
+def _build_request(
+    client: httpx.Client | httpx.AsyncClient,
+    href: str,
+    method: str | None,
+    headers: dict[str, str],
+    parameters: dict[str, Any],
+    extra_headers: dict[str, str] | None,
+    extra_parameters: dict[str, Any] | None,
+    timeout: Any,
+) -> httpx.Request:
+    if method == "POST":
+        return client.build_request(
+            "POST",
+            href,
+            headers={**headers, **(extra_headers or {})},
+            params=parameters,
+            json=extra_parameters,
+            timeout=timeout,
+        )
+    return client.build_request(
+        "GET",
+        href,
+        headers={**headers, **(extra_headers or {})},
+        params={**parameters, **(extra_parameters or {})},
+        timeout=timeout,
+    )
+
+
+def response_text(response: httpx.Response) -> str:
+    if response.status_code != 200:
+        raise APIError.from_response(response)
+    try:
+        return response.content.decode("utf-8")
+    except Exception as err:
+        raise APIError(str(err))
 
 
 class HttpxStacApiIO(StacApiIO):
-    def request(self,
+    # StacApiIO on top of a process wide httpx client, retrying throttled and failed requests
+    def __init__(
+        self,
+        headers: dict[str, str] | None = None,
+        parameters: dict[str, Any] | None = None,
+        timeout: float | None = None,
+        max_retries: int = 5,
+        backoff: float = 0.5,
+        client: httpx.Client | None = None,
+    ):
+        self.headers: dict[str, str] = {}
+        self.parameters: dict[str, Any] = {}
+        super().__init__(headers=headers, parameters=parameters, timeout=timeout, max_retries=None)
+        self.client = client or shared_http_client()
+        self.max_retries = max_retries
+        self.backoff = backoff
+
+    def update(
+        self,
+        headers: dict[str, str] | None = None,
+        parameters: dict[str, Any] | None = None,
+        request_modifier: Callable[[Request], Request | None] | None = None,
+        timeout: float | None = None,
+    ) -> None:
+        if request_modifier is not None:
+            raise ValueError("request_modifier works on requests.Request and is not supported by HttpxStacApiIO")
+        self.headers.update(headers or {})
+        self.parameters.update(parameters or {})
+        self._req_modifier = None
+        self.timeout = timeout
+
+    def send(
+        self,
+        href: str,
+        method: str | None = None,
+        headers: dict[str, str] | None = None,
+        parameters: dict[str, Any] | None = None,
+    ) -> httpx.Response:
+        timeout = self.timeout if self.timeout is not None else httpx.USE_CLIENT_DEFAULT
+        request = _build_request(self.client, href, method, self.headers, self.parameters, headers, parameters, timeout)
+        logger.debug("%s %s", request.method, request.url)
+        attempt = 0
+        while True:
+            try:
+                response = self.client.send(request)
+            except httpx.TransportError as err:
+                if attempt >= self.max_retries:
+                    raise APIError(str(err))
+                response = None
+            else:
+                if response.status_code not in _RETRY_STATUSES or attempt >= self.max_retries:
+                    return response
+            delay = _retry_delay(attempt, response, self.backoff)
+            logger.info("Retrying %s %s in %.1f s", request.method, request.url, delay)
+            time.sleep(delay)
+            attempt += 1
+
+    def request(
+        self,
         href: str,
         method: str | None = None,
         headers: dict[str, str] | None = None,
-        parameters: dict[str, Any] | None = None,) -> str:
-        pass
+        parameters: dict[str, Any] | None = None,
+    ) -> str:
+        return response_text(self.send(href, method, headers, parameters))
+
+
+class AsyncHttpxStacApiIO:
+    # Async counterpart of HttpxStacApiIO for fetching many pages or items concurrently, as pystac-client is
+    # synchronous this only covers raw requests and paging
+    def __init__(
+        self,
+        headers: dict[str, str] | None = None,
+        parameters: dict[str, Any] | None = None,
+        timeout: float | None = None,
+        max_retries: int = 5,
+        backoff: float = 0.5,
+    ):
+        self.headers = dict(headers or {})
+        self.parameters = dict(parameters or {})
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.client = httpx.AsyncClient(**_CLIENT_OPTIONS)
+
+    async def send(
+        self,
+        href: str,
+        method: str | None = None,
+        headers: dict[str, str] | None = None,
+        parameters: dict[str, Any] | None = None,
+    ) -> httpx.Response:
+        timeout = self.timeout if self.timeout is not None else httpx.USE_CLIENT_DEFAULT
+        request = _build_request(self.client, href, method, self.headers, self.parameters, headers, parameters, timeout)
+        attempt = 0
+        while True:
+            try:
+                response = await self.client.send(request)
+            except httpx.TransportError as err:
+                if attempt >= self.max_retries:
+                    raise APIError(str(err))
+                response = None
+            else:
+                if response.status_code not in _RETRY_STATUSES or attempt >= self.max_retries:
+                    return response
+            delay = _retry_delay(attempt, response, self.backoff)
+            logger.info("Retrying %s %s in %.1f s", request.method, request.url, delay)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def request(
+        self,
+        href: str,
+        method: str | None = None,
+        headers: dict[str, str] | None = None,
+        parameters: dict[str, Any] | None = None,
+    ) -> str:
+        return response_text(await self.send(href, method, headers, parameters))
+
+    async def read_json(
+        self,
+        href: str,
+        method: str | None = None,
+        headers: dict[str, str] | None = None,
+        parameters: dict[str, Any] | None = None,
+    ) -> dict[str, Any]:
+        return json.loads(await self.request(href, method, headers, parameters))
+
+    async def get_pages(
+        self, url: str, method: str | None = None, parameters: dict[str, Any] | None = None
+    ) -> AsyncIterator[dict[str, Any]]:
+        # Follows the next links like StacApiIO.get_pages
+        page = await self.read_json(url, method, parameters=parameters)
+        while page.get("features") or page.get("collections"):
+            yield page
+            link = next((link for link in page.get("links", []) if link["rel"] == "next"), None)
+            if link is None:
+                return
+            if link.get("method", "GET") == "POST":
+                body = {**(parameters or {}), **link.get("body", {})} if link.get("merge", False) else link.get("body", {})
+                page = await self.read_json(link["href"], "POST", link.get("headers"), body)
+            else:
+                page = await self.read_json(link["href"], headers=link.get("headers"))
+
+    async def aclose(self) -> None:
+        await self.client.aclose()
+
+    async def __aenter__(self) -> "AsyncHttpxStacApiIO":
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        await self.aclose()
@@ -0,0 +1,350 @@
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path, PurePosixPath
+from typing import Callable, Iterator
+from urllib.parse import urlparse
+
+from requests import Session
+
+logger = logging.getLogger(__name__)
+
+_CHUNK_SIZE = 1 << 20
+# Parts are never smaller than this, so that small files are downloaded with a single request
+_MIN_PART_SIZE = 16 << 20
+
+# Multihash codes of the hash functions that file:checksum may use
+_MULTIHASH = {0x11: "sha1", 0x12: "sha256", 0x13: "sha512", 0xD5: "md5"}
+
+# Called with the number of bytes just received and the size of the file when known, possibly from several threads
+OnBytes = Callable[[int, int | None], None]
+
+
+@dataclass
+class RemoteFile:
+    size: int | None
+    # Either the ETag or the Last-Modified header, None when the server sends neither and the file cannot be cached
+    version: str | None
+    ranges: bool
+
+
+def _read_varint(data: bytes, offset: int) -> tuple[int, int]:
+    value = shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, offset
+
+
+def parse_checksum(checksum: str) -> tuple[str, str] | None:
+    # Decodes a STAC file:checksum, a hex encoded multihash, into a hashlib algorithm and hex digest
+    try:
+        data = bytes.fromhex(checksum)
+        code, offset = _read_varint(data, 0)
+        length, offset = _read_varint(data, offset)
+    except (ValueError, IndexError):
+        logger.warning("Ignoring malformed checksum %s", checksum)
+        return None
+    if code not in _MULTIHASH or len(data) - offset != length:
+        logger.warning("Ignoring checksum %s with unsupported hash function 0x%x", checksum, code)
+        return None
+    return _MULTIHASH[code], data[offset:].hex()
+
+
+def probe(url: str, session: Session) -> RemoteFile:
+    with session.get(url, headers={"Range": "bytes=0-0"}, stream=True) as response:
+        response.raise_for_status()
+        version = response.headers.get("ETag") or response.headers.get("Last-Modified")
+        content_range = response.headers.get("Content-Range", "")
+        if response.status_code == 206 and "/" in content_range:
+            size = content_range.rsplit("/", 1)[1]
+            return RemoteFile(int(size) if size.isdigit() else None, version, size.isdigit())
+        size = response.headers.get("Content-Length", "")
+        return RemoteFile(int(size) if size.isdigit() else None, version, False)
+
+
+class DownloadCache:
+    # Downloaded files keyed by URL and ETag. The least recently used files are evicted once the cache grows beyond
+    # max_bytes, except for those that are in use.
+    def __init__(self, directory: str | Path, max_bytes: int):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._in_use: Counter[str] = Counter()
+
+    @staticmethod
+    def key(url: str, version: str) -> str:
+        return hashlib.sha256(f"{url}\n{version}".encode()).hexdigest()
+
+    def path(self, key: str, suffix: str = "") -> Path:
+        return self.directory / f"{key}{suffix}"
+
+    def partial(self, key: str) -> Path:
+        # An unfinished download, kept so that a retry or a later job can resume it
+        return self.directory / f"{key}.partial"
+
+    @contextmanager
+    def lock(self, key: str) -> Iterator[None]:
+        # Held while writing the partial file of key, so that concurrent jobs, in this process or in others sharing the
+        # directory, do not write it at the same time
+        with open(self.directory / f"{key}.lock", "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _locked(self, key: str) -> bool:
+        try:
+            fd = os.open(self.directory / f"{key}.lock", os.O_RDONLY)
+        except FileNotFoundError:
+            return False
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+        finally:
+            os.close(fd)
+        return False
+
+    @contextmanager
+    def use(self, key: str, suffix: str = "") -> Iterator[Path | None]:
+        # The cached file, or None when it is not cached. It will not be evicted before the block exits.
+        with self._lock:
+            self._in_use[key] += 1
+        try:
+            path = self.path(key, suffix)
+            if path.exists():
+                os.utime(path)
+                yield path
+            else:
+                yield None
+        finally:
+            with self._lock:
+                self._in_use[key] -= 1
+                if not self._in_use[key]:
+                    del self._in_use[key]
+
+    def evict(self) -> None:
+        with self._lock:
+            entries = []
+            for path in self.directory.iterdir():
+                # Lock files are empty, and removing one while it is held would let another job take the lock again
+                if path.suffix == ".lock":
+                    continue
+                try:
+                    stat = path.stat()
+                except FileNotFoundError:
+                    continue
+                size = sum(p.stat().st_size for p in path.iterdir()) if path.is_dir() else stat.st_size
+                entries.append((stat.st_mtime, size, path))
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries, key=lambda entry: entry[0]):
+                if total <= self.max_bytes:
+                    break
+                key = path.name.split(".", 1)[0]
+                if key in self._in_use or self._locked(key):
+                    continue
+                logger.info("Evicting %s from the download cache", path.name)
+                if path.is_dir():
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    path.unlink(missing_ok=True)
+                total -= size
+
+
+_caches: dict[str, DownloadCache] = {}
+_caches_lock = threading.Lock()
+
+
+def download_cache(directory: str, max_bytes: int) -> DownloadCache:
+    # One cache object per directory and process, so that files in use by one job are not evicted by another
+    with _caches_lock:
+        if directory not in _caches:
+            _caches[directory] = DownloadCache(directory, max_bytes)
+        cache = _caches[directory]
+        cache.max_bytes = max_bytes
+        return cache
+
+
+def _pwrite(fd: int, data: bytes, offset: int) -> None:
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
+
+def _download_part(
+    url: str,
+    session: Session,
+    fd: int,
+    start: int,
+    end: int | None,
+    retries: int,
+    received: int = 0,
+    on_progress: Callable[[int], None] | None = None,
+    on_bytes: Callable[[int], None] | None = None,
+) -> None:
+    # Writes bytes start..end at their offset in fd, continuing after the bytes an earlier attempt already received.
+    # on_progress is called with the number of bytes of the part received so far.
+    attempt = 0
+    while True:
+        offset = start + received
+        if end is not None and offset > end:
+            return
+        try:
+            headers = {"Range": f"bytes={offset}-{'' if end is None else end}"} if end is not None or offset else {}
+            with session.get(url, headers=headers, stream=True, timeout=(10, 120)) as response:
+                response.raise_for_status()
+                if headers and response.status_code != 206:
+                    raise IOError(f"{url} ignored the range request")
+                for chunk in response.iter_content(chunk_size=_CHUNK_SIZE):
+                    _pwrite(fd, chunk, start + received)
+                    received += len(chunk)
+                    if on_progress is not None:
+                        on_progress(received)
+                    if on_bytes is not None:
+                        on_bytes(len(chunk))
+            if end is None:
+                return
+            # A response that ends early is a failed attempt too, or an empty body would be requested again forever
+            if start + received <= end:
+                raise IOError(f"Response from {url} ended at byte {start + received} of {end + 1}")
+        except (IOError, OSError) as e:
+            if attempt >= retries:
+                raise
+            attempt += 1
+            delay = min(2**attempt, 60)
+            logger.warning("Download of %s failed at byte %d (%s), resuming in %d s", url, offset, e, delay)
+            time.sleep(delay)
+
+
+def _fetch(
+    url: str,
+    session: Session,
+    remote: RemoteFile,
+    path: Path,
+    parts: int,
+    retries: int,
+    on_bytes: OnBytes | None = None,
+) -> None:
+    # Downloads url into path, each part written at its offset in the preallocated file. The bytes received of every
+    # part are recorded next to it, so that a later attempt can resume the parts.
+    received = None if on_bytes is None else lambda count: on_bytes(count, remote.size)
+    progress_path = path.with_name(f"{path.name}.parts")
+    if not remote.ranges or remote.size is None:
+        # Starts over, as the server cannot continue where an earlier attempt stopped
+        progress_path.unlink(missing_ok=True)
+        with open(path, "wb") as f:
+            _download_part(url, session, f.fileno(), 0, None, 0, on_bytes=received)
+        return
+
+    count = max(1, min(parts, remote.size // _MIN_PART_SIZE))
+    bounds = [remote.size * i // count for i in range(count + 1)]
+    done = [0] * count
+    # Progress of an earlier attempt with a different number of parts or size cannot be continued
+    if path.exists() and path.stat().st_size == remote.size and progress_path.exists():
+        progress = progress_path.read_bytes()
+        if len(progress) == 8 * count:
+            done = [int.from_bytes(progress[8 * i : 8 * i + 8], "little") for i in range(count)]
+    fd = os.open(path, os.O_RDWR | os.O_CREAT)
+    progress_fd = os.open(progress_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC)
+    try:
+        if not any(done):
+            os.ftruncate(fd, 0)
+            os.posix_fallocate(fd, 0, remote.size)
+        _pwrite(progress_fd, b"".join(part.to_bytes(8, "little") for part in done), 0)
+        logger.info("Downloading %s (%d bytes) in %d parts", url, remote.size, count)
+        with ThreadPoolExecutor(max_workers=count, thread_name_prefix="download-part") as executor:
+            futures = [
+                executor.submit(
+                    _download_part,
+                    url,
+                    session,
+                    fd,
+                    bounds[i],
+                    bounds[i + 1] - 1,
+                    retries,
+                    done[i],
+                    lambda part, i=i: _pwrite(progress_fd, part.to_bytes(8, "little"), 8 * i),
+                    received,
+                )
+                for i in range(count)
+            ]
+            for future in futures:
+                future.result()
+    finally:
+        os.close(fd)
+        os.close(progress_fd)
+    progress_path.unlink()
+
+
+def _verify(path: Path, url: str, checksum: str | None) -> None:
+    expected = parse_checksum(checksum) if checksum else None
+    if expected is None:
+        return
+    digest = hashlib.new(expected[0])
+    with open(path, "rb") as f:
+        while chunk := f.read(_CHUNK_SIZE):
+            digest.update(chunk)
+    if digest.hexdigest() != expected[1]:
+        # The download is corrupt, so the next attempt must not resume it
+        path.unlink()
+        raise IOError(f"Checksum mismatch for {url}, expected {expected[1]} but got {digest.hexdigest()}")
+
+
+@contextmanager
+def download(
+    url: str,
+    session: Session,
+    checksum: str | None = None,
+    cache: DownloadCache | None = None,
+    parts: int = 4,
+    retries: int = 5,
+    on_bytes: OnBytes | None = None,
+) -> Iterator[Path]:
+    # Downloads url with parallel range requests when the server supports them, resuming interrupted parts. With a
+    # cache, files are kept between jobs, and unfinished downloads between attempts.
+    remote = probe(url, session)
+    # Kept, as GDAL recognizes archives by their extension
+    suffix = PurePosixPath(urlparse(url).path).suffix
+    if cache is None or remote.version is None:
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            path = Path(tmpdirname) / f"data{suffix}"
+            _fetch(url, session, remote, path, parts, retries, on_bytes)
+            _verify(path, url, checksum)
+            yield path
+        return
+
+    key = cache.key(url, remote.version)
+    with cache.use(key, suffix) as path:
+        if path is not None:
+            logger.info("Using cached copy of %s", url)
+            yield path
+            return
+        path = cache.path(key, suffix)
+        with cache.lock(key):
+            # Another job may have finished the download while this one waited for the lock
+            if path.exists():
+                logger.info("Using copy of %s downloaded by another job", url)
+            else:
+                partial = cache.partial(key)
+                _fetch(url, session, remote, partial, parts, retries, on_bytes)
+                _verify(partial, url, checksum)
+                partial.replace(path)
+        cache.evict()
+        yield path
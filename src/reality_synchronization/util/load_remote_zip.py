@@ -1,45 +1,352 @@
+import io
 import logging
 
-from pathlib import Path
+from contextlib import contextmanager
+from dataclasses import dataclass
+from itertools import repeat
+from pathlib import PurePosixPath
 
 import zipfile
 
 import tempfile
+import threading
+import time
 
+import pandas as pd
+import pyarrow as pa
+import shapely
 from geopandas import GeoDataFrame
-from pyogrio import list_layers, read_dataframe
-from typing import Callable
+from pyogrio import (
+    get_gdal_config_option,
+    list_layers,
+    open_arrow,
+    read_dataframe,
+    read_info,
+    set_gdal_config_options,
+)
+from pyproj import CRS, Transformer
+from typing import Callable, Iterator
 
-from requests import Session
+from requests import Request, Session
 
+from reality_synchronization import OAuth2ClientCredentialsSession
+from reality_synchronization.options import ZipMode
+from reality_synchronization.util.download import DownloadCache, OnBytes, download, probe
+from reality_synchronization.util.pipeline import PipelineStats
 
 logger = logging.getLogger(__name__)
 
+# Seconds a token must still be valid for when a vsicurl read starts
+VSICURL_TOKEN_LIFETIME = 900.0
+
+# Nullable integers and booleans would otherwise become float or object depending on whether a batch contains nulls
+_ARROW_TYPES = {
+    pa.int8(): pd.Int8Dtype(),
+    pa.int16(): pd.Int16Dtype(),
+    pa.int32(): pd.Int32Dtype(),
+    pa.int64(): pd.Int64Dtype(),
+    pa.uint8(): pd.UInt8Dtype(),
+    pa.uint16(): pd.UInt16Dtype(),
+    pa.uint32(): pd.UInt32Dtype(),
+    pa.uint64(): pd.UInt64Dtype(),
+    pa.bool_(): pd.BooleanDtype(),
+}
+
+Bbox = tuple[float, float, float, float]
+
+
+@dataclass(frozen=True)
+class Subset:
+    # Only features intersecting bbox (minx, miny, maxx, maxy in crs), only the given attribute columns besides the
+    # geometry and the columns the loader needs, and only the given layers. Pushed down to GDAL, which uses the spatial
+    # index of GeoPackages, so that with vsicurl only the matching pages are fetched.
+    bbox: Bbox | None = None
+    crs: str = "EPSG:3006"
+    columns: tuple[str, ...] | None = None
+    layers: tuple[str, ...] | None = None
+
+    def with_columns(self, columns: tuple[str, ...]) -> "Subset":
+        if self.columns is None:
+            return self
+        return Subset(self.bbox, self.crs, tuple(dict.fromkeys(self.columns + columns)), self.layers)
+
+    def includes(self, layer: str) -> bool:
+        return self.layers is None or layer in self.layers
+
+    def key(self) -> str:
+        return repr((self.bbox, self.crs, sorted(self.columns or []) or None, sorted(self.layers or []) or None))
+
+    def intersects(self, bbox: list[float] | None, crs: str = "EPSG:4326") -> bool:
+        # Whether anything of an item with the given bbox (e.g. of a STAC item, which is in WGS 84) can be in the subset
+        if self.bbox is None or not bbox:
+            return True
+        if len(bbox) == 6:
+            bbox = [bbox[0], bbox[1], bbox[3], bbox[4]]
+        minx, miny, maxx, maxy = Transformer.from_crs(self.crs, crs, always_xy=True).transform_bounds(*self.bbox)
+        return bbox[0] <= maxx and minx <= bbox[2] and bbox[1] <= maxy and miny <= bbox[3]
+
+    @staticmethod
+    def from_params(
+        bbox: list[float] | None, crs: str, columns: list[str] | None, layers: list[str] | None
+    ) -> "Subset | None":
+        # From the parameters of a task, None when nothing is left out
+        if bbox is None and columns is None and layers is None:
+            return None
+        if bbox is not None and len(bbox) != 4:
+            raise ValueError(f"bbox must be minx, miny, maxx, maxy, got {bbox}")
+        return Subset(
+            tuple(bbox) if bbox is not None else None,
+            crs,
+            tuple(columns) if columns is not None else None,
+            tuple(layers) if layers is not None else None,
+        )
+
+
+_DATASET_SUFFIXES = (".gpkg", ".shp", ".geojson", ".json", ".gml", ".tab", ".fgb")
+
+
+class _HttpRangeFile(io.RawIOBase):
+    # Just enough of a file object for zipfile to read the central directory of a remote archive
+    def __init__(self, url: str, session: Session, size: int):
+        self._url = url
+        self._session = session
+        self._size = size
+        self._position = 0
+
+    def seekable(self) -> bool:
+        return True
+
+    def readable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            self._position = offset
+        elif whence == io.SEEK_CUR:
+            self._position += offset
+        else:
+            self._position = self._size + offset
+        return self._position
+
+    def readinto(self, buffer) -> int:
+        end = min(self._position + len(buffer), self._size)
+        if end <= self._position:
+            return 0
+        response = self._session.get(self._url, headers={"Range": f"bytes={self._position}-{end - 1}"})
+        response.raise_for_status()
+        data = response.content
+        buffer[: len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+
+def _find_dataset(names: list[str]) -> str:
+    files = [name for name in names if not name.endswith("/")]
+    for suffix in _DATASET_SUFFIXES:
+        for name in files:
+            if name.lower().endswith(suffix):
+                return name
+    return next(name for name in files if len(PurePosixPath(name).parts) == 1)
+
+
+# GDAL config options are global to the process. Readers in several threads share the options set to the same value,
+# and a reader that needs another value waits until the option is no longer in use.
+_gdal_config_condition = threading.Condition()
+# Value and number of users of every option in use, and the value to restore once it is no longer used
+_gdal_config_users: dict[str, tuple[str | None, int]] = {}
+_gdal_config_previous: dict[str, str | None] = {}
+
+
+@contextmanager
+def _gdal_config(options: dict[str, str | None]) -> Iterator[None]:
+    with _gdal_config_condition:
+        _gdal_config_condition.wait_for(
+            lambda: all(_gdal_config_users.get(key, (value, 0))[0] == value for key, value in options.items())
+        )
+        unused = {key: value for key, value in options.items() if key not in _gdal_config_users}
+        _gdal_config_previous.update({key: get_gdal_config_option(key) for key in unused})
+        set_gdal_config_options(unused)
+        for key, value in options.items():
+            _gdal_config_users[key] = (value, _gdal_config_users.get(key, (value, 0))[1] + 1)
+    try:
+        yield
+    finally:
+        with _gdal_config_condition:
+            restore = {}
+            for key in options:
+                value, users = _gdal_config_users.pop(key)
+                if users > 1:
+                    _gdal_config_users[key] = (value, users - 1)
+                else:
+                    restore[key] = _gdal_config_previous.pop(key)
+            set_gdal_config_options(restore)
+            _gdal_config_condition.notify_all()
+
+
+@contextmanager
+def _open_vsicurl(url: str, session: Session, size: int) -> Iterator[str]:
+    with zipfile.ZipFile(io.BufferedReader(_HttpRangeFile(url, session, size), buffer_size=65536)) as zip_ref:
+        member = _find_dataset(zip_ref.namelist())
+    # GDAL copies the header when it opens the file and cannot renew the token, so reads that outlast the token fail
+    # with 401. The token is renewed up front unless it has VSICURL_TOKEN_LIFETIME left, longer reads should use vsizip.
+    if (
+        isinstance(session, OAuth2ClientCredentialsSession)
+        and session.token()["expires_at"] - time.time() < VSICURL_TOKEN_LIFETIME
+    ):
+        session.token(renew=True)
+    authorization = session.prepare_request(Request("GET", url)).headers.get("Authorization")
+    with _gdal_config({
+        "GDAL_HTTP_HEADERS": f"Authorization: {authorization}" if authorization else None,
+        "GDAL_DISABLE_READDIR_ON_OPEN": "EMPTY_DIR",
+        "GDAL_HTTP_MAX_RETRY": "5",
+        "GDAL_HTTP_RETRY_DELAY": "1",
+    }):
+        yield f"/vsizip//vsicurl/{url}/{member}"
+
+
+@contextmanager
+def open_remote_zip(
+    url: str,
+    session: Session,
+    mode: ZipMode = "vsizip",
+    checksum: str | None = None,
+    cache: DownloadCache | None = None,
+    download_parts: int = 4,
+    on_bytes: OnBytes | None = None,
+) -> Iterator[str]:
+    if mode == "vsicurl":
+        remote = probe(url, session)
+        if remote.ranges:
+            logger.info("Reading %s through range requests", url)
+            with _open_vsicurl(url, session, remote.size) as path:
+                yield path
+            return
+        logger.info("%s does not support range requests, downloading it instead", url)
+        mode = "vsizip"
 
-def load_remote_zip(url: str, session: Session, postprocess: Callable[[str, GeoDataFrame], GeoDataFrame]) -> dict[str, GeoDataFrame]:
     logger.info("Downloading %s", url)
-    response = session.get(url, stream=True)
-    response.raise_for_status()
-    with tempfile.TemporaryDirectory() as tmpdirname:
-        zip_path = f"{tmpdirname}/data.zip"
-        with open(zip_path, "wb") as f:
-            for chunk in response.iter_content(chunk_size=65536):
-                f.write(chunk)
-        logger.info("Extracting zip")
+    with download(url, session, checksum, cache, download_parts, on_bytes=on_bytes) as zip_path:
         with zipfile.ZipFile(zip_path, "r") as zip_ref:
-            zip_ref.extractall(tmpdirname)
-        file = next(
-            f
-            for f in Path(tmpdirname).iterdir()
-            if f.is_file() and f.name != "data.zip"
-        )
-        logger.info("Loading data")
-        result = {}
-        for (layer, geometry_type) in list_layers(file):
-            logger.info("Loading layer %s", layer)
-            df = read_dataframe(file, layer=layer, use_arrow=True)
-            if df.index is not None and not df.index.name:
-                df = df.reset_index(drop=True)
-            df = postprocess(layer, df)
-            result[layer] = df
+            member = _find_dataset(zip_ref.namelist())
+            if mode == "extract":
+                with tempfile.TemporaryDirectory() as tmpdirname:
+                    logger.info("Extracting zip")
+                    zip_ref.extractall(tmpdirname)
+                    yield f"{tmpdirname}/{member}"
+                return
+        # GDAL only recognizes archives without a .zip extension when the path is in braces
+        yield f"/vsizip/{zip_path}/{member}" if zip_path.suffix.lower() == ".zip" else f"/vsizip/{{{zip_path}}}/{member}"
+
+
+def _measured(
+    postprocess: Callable[[str, GeoDataFrame], GeoDataFrame], stats: PipelineStats | None
+) -> Callable[[str, GeoDataFrame], GeoDataFrame]:
+    if stats is None:
+        return postprocess
+
+    def measured(layer: str, df: GeoDataFrame) -> GeoDataFrame:
+        with stats.stage("postprocess"):
+            result = postprocess(layer, df)
+        stats.add_rows("postprocess", len(df))
         return result
+
+    return measured
+
+
+def _read_options(file: str, layer: str, subset: Subset | None) -> dict:
+    # The arguments of read_dataframe/open_arrow that read the subset of the layer, with the bbox in the CRS of the
+    # layer and only the requested columns that exist in it
+    if subset is None:
+        return {}
+    options: dict = {}
+    info = read_info(file, layer=layer)
+    if subset.bbox is not None:
+        bbox = subset.bbox
+        if info["crs"] is not None and not CRS.from_user_input(info["crs"]).equals(CRS.from_user_input(subset.crs)):
+            bbox = Transformer.from_crs(subset.crs, info["crs"], always_xy=True).transform_bounds(*bbox)
+        options["bbox"] = tuple(bbox)
+    if subset.columns is not None:
+        options["columns"] = [column for column in info["fields"] if column in subset.columns]
+    return options
+
+
+def _layers(file: str, subset: Subset | None) -> list[str]:
+    return [layer for layer, _ in list_layers(file) if subset is None or subset.includes(layer)]
+
+
+def read_layers(
+    file: str,
+    postprocess: Callable[[str, GeoDataFrame], GeoDataFrame],
+    stats: PipelineStats | None = None,
+    subset: Subset | None = None,
+) -> Iterator[tuple[str, GeoDataFrame]]:
+    logger.info("Loading data")
+    postprocess = _measured(postprocess, stats)
+    for layer in _layers(file, subset):
+        logger.info("Loading layer %s", layer)
+        df = read_dataframe(file, layer=layer, use_arrow=True, **_read_options(file, layer, subset))
+        if df.index is not None and not df.index.name:
+            df = df.reset_index(drop=True)
+        yield layer, postprocess(layer, df)
+
+
+def _read_batches(file: str, layer: str, batch_size: int, subset: Subset | None = None) -> Iterator[GeoDataFrame]:
+    options = _read_options(file, layer, subset)
+    with open_arrow(file, layer=layer, batch_size=batch_size, use_pyarrow=True, **options) as (meta, reader):
+        geometry_name = meta["geometry_name"] or "wkb_geometry"
+        for batch in reader:
+            df = batch.to_pandas(types_mapper=_ARROW_TYPES.get)
+            if geometry_name in df.columns:
+                wkb_values = df.pop(geometry_name).to_numpy()
+                df["geometry"] = shapely.from_wkb(wkb_values)
+                df = GeoDataFrame(df, geometry="geometry", crs=meta["crs"])
+            yield df
+
+
+def read_layer_batches(
+    file: str,
+    postprocess: Callable[[str, GeoDataFrame], GeoDataFrame],
+    batch_size: int,
+    batchable: Callable[[str], bool] = lambda layer: True,
+    stats: PipelineStats | None = None,
+    subset: Subset | None = None,
+) -> Iterator[tuple[str, Iterator[GeoDataFrame]]]:
+    # The batches of a layer have to be consumed before moving on to the next layer. Layers whose postprocessing needs
+    # to see all rows at once are concatenated and postprocessed as a single batch.
+    postprocess = _measured(postprocess, stats)
+    for layer in _layers(file, subset):
+        logger.info("Streaming layer %s in batches of %d rows", layer, batch_size)
+        batches = _read_batches(file, layer, batch_size, subset)
+        if batchable(layer):
+            yield layer, map(postprocess, repeat(layer), batches)
+        else:
+            yield layer, iter([postprocess(layer, pd.concat(list(batches), ignore_index=True))])
+
+
+def load_remote_zip(
+    url: str,
+    session: Session,
+    postprocess: Callable[[str, GeoDataFrame], GeoDataFrame],
+    mode: ZipMode = "vsizip",
+    checksum: str | None = None,
+    subset: Subset | None = None,
+) -> dict[str, GeoDataFrame]:
+    with open_remote_zip(url, session, mode, checksum) as file:
+        return dict(read_layers(file, postprocess, subset=subset))
+
+
+def stream_remote_zip(
+    url: str,
+    session: Session,
+    postprocess: Callable[[str, GeoDataFrame], GeoDataFrame],
+    batch_size: int,
+    batchable: Callable[[str], bool] = lambda layer: True,
+    mode: ZipMode = "vsizip",
+    checksum: str | None = None,
+    subset: Subset | None = None,
+) -> Iterator[tuple[str, Iterator[GeoDataFrame]]]:
+    with open_remote_zip(url, session, mode, checksum) as file:
+        yield from read_layer_batches(file, postprocess, batch_size, batchable, subset=subset)
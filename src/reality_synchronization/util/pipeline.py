@@ -0,0 +1,242 @@
+import logging
+import queue
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import AbstractContextManager, contextmanager, nullcontext
+from typing import Callable, Iterable, Iterator, TypeVar
+
+import psycopg
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+_DONE = object()
+
+
+class StageTimings:
+    # Seconds spent per stage. Stages run concurrently, so the sum can exceed the wall time.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.seconds: dict[str, float] = defaultdict(float)
+
+    def add(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self.seconds[stage] += seconds
+
+    @contextmanager
+    def stage(self, stage: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def timed(self, stage: str, iterable: Iterable[T]) -> Iterator[T]:
+        # Attributes the time spent producing each value to the stage
+        iterator = iter(iterable)
+        while True:
+            with self.stage(stage):
+                value = next(iterator, _DONE)
+            if value is _DONE:
+                return
+            yield value
+
+    def as_dict(self) -> dict[str, float]:
+        with self._lock:
+            return {stage: round(seconds, 3) for stage, seconds in self.seconds.items()}
+
+
+def timed_stage(timings: StageTimings | None, stage: str) -> AbstractContextManager:
+    return nullcontext() if timings is None else timings.stage(stage)
+
+
+def peak_rss() -> int | None:
+    # Peak resident set size of the process in bytes, None where getrusage is not available
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class PipelineStats(StageTimings):
+    # Stage timings together with the rows and bytes each stage processed, from which the throughput of every stage
+    # follows, and the peak memory use of the process
+    def __init__(self):
+        super().__init__()
+        self.rows: dict[str, int] = defaultdict(int)
+        self.bytes: dict[str, int] = defaultdict(int)
+
+    def add_rows(self, stage: str, rows: int) -> None:
+        with self._lock:
+            self.rows[stage] += rows
+
+    def add_bytes(self, stage: str, count: int) -> None:
+        with self._lock:
+            self.bytes[stage] += count
+
+    def summary(self) -> dict:
+        with self._lock:
+            stages = {}
+            for stage in sorted({*self.seconds, *self.rows, *self.bytes}):
+                seconds = self.seconds.get(stage, 0.0)
+                values: dict[str, float | int] = dict(seconds=round(seconds, 3))
+                if stage in self.rows:
+                    values["rows"] = self.rows[stage]
+                    if seconds > 0:
+                        values["rows_per_second"] = round(self.rows[stage] / seconds, 1)
+                if stage in self.bytes:
+                    values["bytes"] = self.bytes[stage]
+                    if seconds > 0:
+                        values["bytes_per_second"] = round(self.bytes[stage] / seconds, 1)
+                stages[stage] = values
+        return dict(stages=stages, peak_rss_bytes=peak_rss())
+
+    def prometheus(self, prefix: str = "reality_synchronization", labels: dict[str, str] | None = None) -> str:
+        # Prometheus text exposition format, e.g. for a textfile collector or a push gateway
+        def series(name: str, stage: str | None = None) -> str:
+            values = {**(labels or {}), **({"stage": stage} if stage is not None else {})}
+            escaped = ",".join(f'{key}="{_escape_label(str(value))}"' for key, value in values.items())
+            return f"{prefix}_{name}{{{escaped}}}" if escaped else f"{prefix}_{name}"
+
+        summary = self.summary()
+        lines = []
+        for name, key, help_text in [
+            ("stage_seconds_total", "seconds", "Seconds spent in the stage"),
+            ("stage_rows_total", "rows", "Rows processed by the stage"),
+            ("stage_bytes_total", "bytes", "Bytes processed by the stage"),
+        ]:
+            lines += [f"# HELP {prefix}_{name} {help_text}", f"# TYPE {prefix}_{name} counter"]
+            for stage, values in summary["stages"].items():
+                if key in values:
+                    lines.append(f"{series(name, stage)} {values[key]}")
+        if summary["peak_rss_bytes"] is not None:
+            lines += [
+                f"# HELP {prefix}_peak_rss_bytes Peak resident set size of the process",
+                f"# TYPE {prefix}_peak_rss_bytes gauge",
+                f"{series('peak_rss_bytes')} {summary['peak_rss_bytes']}",
+            ]
+        return "\n".join(lines) + "\n"
+
+    def export_opentelemetry(self, meter_name: str = "reality_synchronization", attributes: dict | None = None) -> None:
+        # Records the stats through the OpenTelemetry API, which is not a dependency of this package. Nothing is
+        # exported unless the host has installed and configured an SDK meter provider.
+        from opentelemetry import metrics
+
+        meter = metrics.get_meter(meter_name)
+        seconds = meter.create_counter("pipeline.stage.duration", unit="s", description="Seconds spent in the stage")
+        rows = meter.create_counter("pipeline.stage.rows", unit="{row}", description="Rows processed by the stage")
+        size = meter.create_counter("pipeline.stage.bytes", unit="By", description="Bytes processed by the stage")
+        summary = self.summary()
+        for stage, values in summary["stages"].items():
+            stage_attributes = {**(attributes or {}), "stage": stage}
+            seconds.add(values["seconds"], stage_attributes)
+            if "rows" in values:
+                rows.add(values["rows"], stage_attributes)
+            if "bytes" in values:
+                size.add(values["bytes"], stage_attributes)
+        if summary["peak_rss_bytes"] is not None:
+            meter.create_gauge("process.memory.peak", unit="By").set(summary["peak_rss_bytes"], attributes or {})
+
+
+def prefetch(iterable: Iterable[T], depth: int = 1, name: str = "prefetch") -> Iterator[T]:
+    # Produces up to depth values ahead of the consumer in a background thread
+    if depth <= 0:
+        yield from iterable
+        return
+
+    values: queue.Queue = queue.Queue(maxsize=depth)
+    stopped = threading.Event()
+
+    def put(value, error) -> bool:
+        while not stopped.is_set():
+            try:
+                values.put((value, error), timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce() -> None:
+        iterator = iter(iterable)
+        try:
+            for value in iterator:
+                if not put(value, None):
+                    return
+            put(_DONE, None)
+        except BaseException as e:
+            put(_DONE, e)
+        finally:
+            close = getattr(iterator, "close", None)
+            if close is not None:
+                close()
+
+    thread = threading.Thread(target=produce, name=name, daemon=True)
+    thread.start()
+    try:
+        while True:
+            value, error = values.get()
+            if error is not None:
+                raise error
+            if value is _DONE:
+                return
+            yield value
+    finally:
+        stopped.set()
+
+
+class ConnectionPerThread:
+    # Gives every worker thread its own connection, as a psycopg connection can only run one statement at a time.
+    # Connections are closed when done, or handed to release, e.g. to return them to a pool.
+    def __init__(
+        self,
+        connect: Callable[[], psycopg.Connection],
+        release: Callable[[psycopg.Connection], None] | None = None,
+    ):
+        self._connect = connect
+        self._release = release
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections: list[psycopg.Connection] = []
+
+    def get(self) -> psycopg.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None or connection.closed:
+            connection = self._connect()
+            self._local.connection = connection
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+
+    def detach(self) -> psycopg.Connection:
+        # Hands the thread's connection over to the caller, e.g. to finish a prepared transaction on it later, and gives
+        # the thread a new connection on its next get. The caller passes it to release when done with it.
+        connection = self.get()
+        self._local.connection = None
+        return connection
+
+    def release(self, connection: psycopg.Connection) -> None:
+        with self._lock:
+            self._connections.remove(connection)
+        if self._release is not None and not connection.closed:
+            self._release(connection)
+        else:
+            connection.close()
+
+    def close(self) -> None:
+        with self._lock:
+            for connection in self._connections:
+                if self._release is not None and not connection.closed:
+                    self._release(connection)
+                else:
+                    connection.close()
+            self._connections.clear()
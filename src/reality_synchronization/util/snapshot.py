@@ -0,0 +1,105 @@
+import json
+import logging
+import shutil
+import threading
+from pathlib import Path
+from typing import Iterator
+
+import geopandas
+import pandas as pd
+from geopandas import GeoDataFrame
+from pandas import DataFrame
+from pystac import Item
+
+from reality_synchronization.util.download import DownloadCache
+from reality_synchronization.util.load_remote_zip import Subset
+
+logger = logging.getLogger(__name__)
+
+_MANIFEST = "layers.json"
+
+Layers = Iterator[tuple[str, DataFrame | Iterator[DataFrame]]]
+
+
+class SnapshotCache(DownloadCache):
+    # Postprocessed layers of items as GeoParquet, one directory per item and updated timestamp, so that loading an
+    # item again (after a failed write, or into another database) does not download and parse it again
+    @staticmethod
+    def item_key(item: Item, subset: Subset | None = None) -> str | None:
+        # Snapshots of different subsets of an item are kept apart. Items without an updated timestamp get no key, as a
+        # snapshot of them could never be told apart from one of a later version.
+        updated = item.common_metadata.updated
+        if updated is None:
+            return None
+        version = updated.isoformat()
+        if subset is not None:
+            version += f"\n{subset.key()}"
+        return DownloadCache.key(f"{item.collection_id}/{item.id}", version)
+
+    def write(self, key: str, layers: Layers) -> Path:
+        # Consumes the layers, writing every data frame or batch as a GeoParquet part of its layer
+        with self.lock(key):
+            partial = self.partial(key)
+            shutil.rmtree(partial, ignore_errors=True)
+            partial.mkdir()
+            manifest = []
+            for idx, (layer, data) in enumerate(layers):
+                batches = [data] if isinstance(data, DataFrame) else data
+                parts = 0
+                for batch in batches:
+                    path = partial / f"{idx}.{parts}.parquet"
+                    if isinstance(batch, GeoDataFrame):
+                        batch.to_parquet(path)
+                    else:
+                        batch.to_parquet(path, engine="pyarrow")
+                    parts += 1
+                manifest.append(dict(layer=layer, parts=parts))
+            (partial / _MANIFEST).write_text(json.dumps(manifest))
+            path = self.path(key)
+            shutil.rmtree(path, ignore_errors=True)
+            partial.replace(path)
+        self.evict()
+        return path
+
+
+_caches: dict[str, SnapshotCache] = {}
+_caches_lock = threading.Lock()
+
+
+def snapshot_cache(directory: str, max_bytes: int) -> SnapshotCache:
+    # One cache object per directory and process, so that snapshots in use by one job are not evicted by another
+    with _caches_lock:
+        if directory not in _caches:
+            _caches[directory] = SnapshotCache(directory, max_bytes)
+        cache = _caches[directory]
+        cache.max_bytes = max_bytes
+        return cache
+
+
+def snapshot_layers(path: Path) -> list[str]:
+    return [entry["layer"] for entry in json.loads((path / _MANIFEST).read_text())]
+
+
+def _read_part(path: Path) -> DataFrame:
+    # Memory mapped, which saves reading the file into a buffer of its own first. Converting the Arrow table to pandas
+    # still copies the data, so a part takes about its decoded size in memory either way.
+    try:
+        return geopandas.read_parquet(path, memory_map=True)
+    except ValueError:
+        # Written from a plain data frame, without GeoParquet metadata
+        return pd.read_parquet(path, engine="pyarrow", memory_map=True)
+
+
+def read_snapshot(path: Path, batched: bool) -> Layers:
+    # Yields the layers like LantmaterietStacLoader.read, batched layers as one data frame per part
+    for idx, entry in enumerate(json.loads((path / _MANIFEST).read_text())):
+        parts = [path / f"{idx}.{part}.parquet" for part in range(entry["parts"])]
+        if batched:
+            yield entry["layer"], map(_read_part, parts)
+        elif entry["parts"] == 1:
+            yield entry["layer"], _read_part(parts[0])
+        elif entry["parts"] > 1:
+            yield entry["layer"], pd.concat([_read_part(part) for part in parts])
+        else:
+            # Written from a batched read that yielded no batches, whose columns are unknown
+            yield entry["layer"], GeoDataFrame()
@@ -0,0 +1,114 @@
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Generic, Hashable, TypeVar
+
+from pystac import Item
+from pystac_client import Client
+
+from reality_synchronization.util import HttpxStacApiIO, response_text
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# How long responses and items are used without asking the API again
+DEFAULT_TTL = 300.0
+
+
+class TTLCache(Generic[T]):
+    # Thread safe least recently used cache whose entries expire after ttl seconds
+    def __init__(self, ttl: float = DEFAULT_TTL, max_entries: int = 4096):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[Hashable, tuple[float, T]] = OrderedDict()
+
+    def get(self, key: Hashable, allow_expired: bool = False) -> T | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            stored, value = entry
+            if not allow_expired and time.monotonic() - stored > self.ttl:
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key: Hashable, value: T) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+@dataclass
+class CachedResponse:
+    text: str
+    etag: str | None
+    last_modified: str | None
+
+
+class CachingStacApiIO(HttpxStacApiIO):
+    # Keeps GET responses for ttl seconds and revalidates them afterwards with If-None-Match/If-Modified-Since, so
+    # that an unchanged landing page, collection or item costs at most a 304
+    def __init__(self, ttl: float = DEFAULT_TTL, max_entries: int = 4096, **kwargs: Any):
+        super().__init__(**kwargs)
+        self.cache: TTLCache[CachedResponse] = TTLCache(ttl, max_entries)
+
+    def request(
+        self,
+        href: str,
+        method: str | None = None,
+        headers: dict[str, str] | None = None,
+        parameters: dict[str, Any] | None = None,
+    ) -> str:
+        if method == "POST":
+            return super().request(href, method, headers, parameters)
+
+        key = (href, json.dumps(parameters or {}, sort_keys=True, default=str))
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached.text
+        stale = self.cache.get(key, allow_expired=True)
+        headers = dict(headers or {})
+        if stale is not None:
+            if stale.etag is not None:
+                headers["If-None-Match"] = stale.etag
+            if stale.last_modified is not None:
+                headers["If-Modified-Since"] = stale.last_modified
+
+        response = self.send(href, headers=headers, parameters=parameters)
+        if response.status_code == 304 and stale is not None:
+            logger.debug("%s has not been modified", href)
+            self.cache.put(key, stale)
+            return stale.text
+        text = response_text(response)
+        self.cache.put(key, CachedResponse(text, response.headers.get("ETag"), response.headers.get("Last-Modified")))
+        return text
+
+
+_clients: dict[str, Client] = {}
+_clients_lock = threading.Lock()
+
+
+def stac_client(url: str) -> Client:
+    # One client per API and process, so that the landing page is only fetched once and responses are shared
+    with _clients_lock:
+        if url not in _clients:
+            _clients[url] = Client.open(url, stac_io=CachingStacApiIO())
+        return _clients[url]
+
+
+def list_items(url: str, collection: str, item_ids: list[str] | None = None) -> list[Item]:
+    # The items of a collection, or only those in item_ids
+    logger.info("Listing items in %s", collection)
+    return list(stac_client(url).get_collection(collection).get_items(*(item_ids or [])))
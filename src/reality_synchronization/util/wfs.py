@@ -0,0 +1,129 @@
+import json
+import logging
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from itertools import islice
+from pathlib import Path
+from typing import Callable, Iterator
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from requests import Session
+
+from reality_synchronization.util.download import OnBytes
+
+logger = logging.getLogger(__name__)
+
+
+def with_params(url: str, params: dict[str, str]) -> str:
+    # Sets query parameters, replacing existing ones case insensitively as WFS parameter names are
+    parts = urlsplit(url)
+    names = {name.lower() for name in params}
+    query = [
+        (name, value) for name, value in parse_qsl(parts.query, keep_blank_values=True) if name.lower() not in names
+    ]
+    return urlunsplit(parts._replace(query=urlencode([*query, *params.items()], safe=":,")))
+
+
+def _get_page(url: str, session: Session, on_bytes: OnBytes | None) -> dict:
+    with session.get(url) as response:
+        response.raise_for_status()
+        content = response.content
+    if on_bytes is not None:
+        on_bytes(len(content), None)
+    return json.loads(content)
+
+
+def _geometry_property(url: str, session: Session) -> str | None:
+    # GeoServer names the geometry property of every GeoJSON feature, which propertyName has to include
+    page = _get_page(with_params(url, {"startIndex": "0", "count": "1"}), session, None)
+    features = page.get("features") or [{}]
+    return features[0].get("geometry_name")
+
+
+def _features(
+    first: dict,
+    page: Callable[[int], dict],
+    matched: int | str | None,
+    page_size: int,
+    executor: ThreadPoolExecutor,
+    window: int,
+) -> Iterator[list[dict]]:
+    yield first.get("features", [])
+    if isinstance(matched, int):
+        # The number of features is known, so the remaining pages are fetched concurrently, and written in order. At
+        # most window pages are requested ahead of the one being written, so that pages fetched while a slow one is
+        # still outstanding do not pile up in memory.
+        starts = iter(range(page_size, matched, page_size))
+        pending = deque(executor.submit(page, start) for start in islice(starts, window))
+        try:
+            while pending:
+                result = pending.popleft().result()
+                pending.extend(executor.submit(page, start) for start in islice(starts, 1))
+                yield result.get("features", [])
+        finally:
+            for future in pending:
+                future.cancel()
+        return
+    # Otherwise the pages are fetched until one is not full
+    features = first.get("features", [])
+    start = 0
+    while len(features) == page_size:
+        start += page_size
+        features = page(start).get("features", [])
+        yield features
+
+
+@contextmanager
+def download_wfs(
+    url: str,
+    session: Session,
+    bbox: tuple[float, float, float, float] | None = None,
+    crs: str = "EPSG:3006",
+    properties: tuple[str, ...] | None = None,
+    sort_by: str | None = None,
+    page_size: int = 10000,
+    concurrency: int = 4,
+    on_bytes: OnBytes | None = None,
+) -> Iterator[Path]:
+    # Fetches the features of a WFS 2.0 GetFeature request (url with typeNames and a GeoJSON outputFormat) in pages of
+    # page_size through startIndex/count, up to concurrency pages at a time, and writes them to one GeoJSON file. The
+    # server only returns the features intersecting bbox (in crs), with only the given properties besides the geometry.
+    params = {"service": "WFS", "version": "2.0.0", "request": "GetFeature"}
+    if bbox is not None:
+        # With EPSG:<code> rather than a URN the coordinates are in x/y order whatever the axis order of the CRS
+        params["bbox"] = ",".join(map(str, bbox)) + f",{crs}"
+    if sort_by is not None:
+        # Pages are only consistent with each other when the features are in a well defined order
+        params["sortBy"] = sort_by
+    url = with_params(url, params)
+    if properties is not None:
+        geometry = _geometry_property(url, session)
+        if geometry is None:
+            logger.warning("Could not find the geometry property of %s, fetching all properties", url)
+        else:
+            url = with_params(url, {"propertyName": ",".join(dict.fromkeys([*properties, geometry]))})
+
+    def page(start: int) -> dict:
+        return _get_page(with_params(url, {"startIndex": str(start), "count": str(page_size)}), session, on_bytes)
+
+    logger.info("Fetching %s", url)
+    first = page(0)
+    matched = first.get("numberMatched", first.get("totalFeatures"))
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        path = Path(tmpdirname) / "data.geojson"
+        with open(path, "w") as f, ThreadPoolExecutor(concurrency, "wfs") as executor:
+            f.write('{"type": "FeatureCollection", ')
+            if "crs" in first:
+                f.write(f'"crs": {json.dumps(first["crs"])}, ')
+            f.write('"features": [')
+            count = 0
+            for features in _features(first, page, matched, page_size, executor, concurrency * 2):
+                for feature in features:
+                    f.write((", " if count else "") + json.dumps(feature))
+                    count += 1
+            f.write("]}")
+        logger.info("Fetched %d features", count)
+        yield path
+
@@ -1,10 +1,13 @@
-from typing import TypedDict, cast
+import threading
+from typing import Literal, NotRequired, TypedDict, cast
 
 import psycopg
 import requests
 import wmill
+from psycopg_pool import ConnectionPool
 
-from reality_synchronization import make_oauth2_session
+from reality_synchronization import FileTokenCache, TokenCache, make_oauth2_session
+from reality_synchronization.util.pipeline import PipelineStats
 
 
 class postgresql(TypedDict):
@@ -15,10 +18,12 @@ class postgresql(TypedDict):
     sslmode: str
     password: str
     root_certificate_pem: str
+    # Set when connecting through pgbouncer in transaction mode, which does not keep prepared statements
+    pgbouncer: NotRequired[bool]
 
 
-def connect_to_postgresql(db_config: postgresql) -> psycopg.Connection:
-    return psycopg.connect(
+def _connection_kwargs(db_config: postgresql) -> dict:
+    return dict(
         host=db_config["host"],
         port=db_config.get("port", 5432),
         user=db_config["user"],
@@ -29,17 +34,98 @@ def connect_to_postgresql(db_config: postgresql) -> psycopg.Connection:
     )
 
 
+def connect_to_postgresql(db_config: postgresql) -> psycopg.Connection:
+    return psycopg.connect(**_connection_kwargs(db_config))
+
+
+POOL_MAX_SIZE = 16
+
+_pools: dict[tuple, ConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+
+def _reset_connection(connection: psycopg.Connection) -> None:
+    # Borrowers such as pypgstac change the search path and autocommit, which must not leak to the next borrower
+    connection.autocommit = True
+    connection.execute("RESET ALL")
+    connection.autocommit = False
+
+
+def postgresql_pool(db_config: postgresql) -> ConnectionPool:
+    # One pool per database resource and worker process, so that connections (and their TLS handshakes) are shared
+    # between the layers, items and tasks that run in the same worker
+    kwargs = _connection_kwargs(db_config)
+    if db_config.get("pgbouncer", False):
+        kwargs["prepare_threshold"] = None
+    key = tuple(sorted(kwargs.items()))
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None or pool.closed:
+            pool = ConnectionPool(
+                kwargs=kwargs,
+                min_size=1,
+                max_size=POOL_MAX_SIZE,
+                max_idle=300.0,
+                check=ConnectionPool.check_connection,
+                reset=_reset_connection,
+                name=f"{db_config['user']}@{db_config['host']}/{db_config['dbname']}",
+                open=True,
+            )
+            _pools[key] = pool
+        return pool
+
+
+def postgresql_connection(db_config: postgresql):
+    # A connection borrowed from the pool, committed and returned when the block exits
+    return postgresql_pool(db_config).connection()
+
+
 class OAuth(TypedDict):
     client_id: str
     client_secret: str
 
 
+class StateTokenCache(TokenCache):
+    # Also keeps the tokens in the Windmill state of the script, so that they are shared with its later runs
+    def get(self, key: str) -> dict | None:
+        token = super().get(key)
+        if token is None:
+            token = (wmill.get_state() or {}).get("oauth2_tokens", {}).get(key)
+        return token
+
+    def put(self, key: str, token: dict) -> None:
+        super().put(key, token)
+        state = wmill.get_state() or {}
+        wmill.set_state({**state, "oauth2_tokens": {**state.get("oauth2_tokens", {}), key: token}})
+
+
+# memory: shared within the worker process, file: also with later jobs on the same worker, state: also with later runs
+# of the same script
+TokenCacheMode = Literal["memory", "file", "state"]
+
+
 def oauth2_client(
     resource_id: str,
     scope: str | None,
     token_url: str = "https://apimanager.lantmateriet.se/oauth2/token",
+    token_cache: TokenCacheMode = "memory",
 ) -> requests.Session:
     config = cast(OAuth, wmill.get_resource(resource_id))
+    cache = FileTokenCache() if token_cache == "file" else StateTokenCache() if token_cache == "state" else None
     return make_oauth2_session(
-        config["client_id"], config["client_secret"], scope, token_url
+        config["client_id"], config["client_secret"], scope, token_url, cache
     )
+
+
+# Where the stats of a job are exported to, besides being part of its result. prometheus: added to the result in the
+# text exposition format, opentelemetry: recorded through the OpenTelemetry API of the worker
+MetricsExport = Literal["prometheus", "opentelemetry"]
+
+
+def export_stats(stats: PipelineStats, export: MetricsExport | None, labels: dict[str, str]) -> dict:
+    # The entries to add to the result of the job
+    if export == "prometheus":
+        return dict(prometheus=stats.prometheus(labels=labels))
+    if export == "opentelemetry":
+        stats.export_opentelemetry(attributes=labels)
+    return {}
@@ -1,4 +1,27 @@
-from .fetch_lantmateriet_stac import fetch_lantmateriet_stac
-from .fetch_lantmateriet_stac_items import fetch_lantmateriet_stac_items
+import importlib
+from typing import TYPE_CHECKING
 
-__all__ = ["fetch_lantmateriet_stac", "fetch_lantmateriet_stac_items"]
+if TYPE_CHECKING:
+    from .fetch_lantmateriet_stac import fetch_lantmateriet_stac
+    from .fetch_lantmateriet_stac_batch import fetch_lantmateriet_stac_batch
+    from .fetch_lantmateriet_stac_items import fetch_lantmateriet_stac_items
+    from .fetch_source import fetch_source
+    from .plan_lantmateriet_stac import plan_lantmateriet_stac
+    from .warm_lantmateriet_snapshots import warm_lantmateriet_snapshots
+
+__all__ = [
+    "fetch_lantmateriet_stac",
+    "fetch_lantmateriet_stac_batch",
+    "fetch_lantmateriet_stac_items",
+    "fetch_source",
+    "plan_lantmateriet_stac",
+    "warm_lantmateriet_snapshots",
+]
+
+
+def __getattr__(name: str):
+    # Every task is in the module of the same name, which is only imported once the task is used, so that a job does
+    # not pay for importing the dependencies of the other tasks
+    if name not in __all__:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    return getattr(importlib.import_module(f".{name}", __name__), name)
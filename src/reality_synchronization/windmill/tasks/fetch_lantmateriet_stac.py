@@ -1,83 +1,94 @@
 import logging
-from typing import Type
 
 from pystac import Item
 from wmill import set_progress
 
-from reality_synchronization.sinks.postgis import (
-    write_postgis,
-    create_metadata_table,
-    upsert_metadata,
-)
-from reality_synchronization.sources.lantmateriet.stac import (
-    FastighetsindelningLoader,
-    LantmaterietStacLoader,
-    ByggnaderLoader,
-    BelagenhetsadressLoader,
-    MarktackeLoader,
-    KommunLanRikeLoader,
-    OrtnamnLoader,
-)
+from reality_synchronization.options import LoadStrategy, SpatialIndex, Storage, ZipMode
+from reality_synchronization.sinks.metadata import create_metadata_table, stale_items
+from reality_synchronization.sources import get_loader
 from reality_synchronization.windmill import (
-    connect_to_postgresql,
+    MetricsExport,
+    TokenCacheMode,
+    export_stats,
     oauth2_client,
     postgresql,
+    postgresql_connection,
+    postgresql_pool,
 )
 
-LOADERS: dict[str, Type[LantmaterietStacLoader]] = {
-    "fastighetsindelning": FastighetsindelningLoader,
-    "byggnader": ByggnaderLoader,
-    "belagenhetsadresser": BelagenhetsadressLoader,
-    "marktacke": MarktackeLoader,
-    "kommun-lan-rike": KommunLanRikeLoader,
-    "ortnamn": OrtnamnLoader,
-}
-
 logger = logging.getLogger(__name__)
 
 
-def fetch_lantmateriet_stac(item: dict, database: postgresql, oauth_resource_id: str):
+def fetch_lantmateriet_stac(
+    item: dict,
+    database: postgresql,
+    oauth_resource_id: str,
+    incremental: bool = False,
+    zip_mode: ZipMode = "vsizip",
+    batch_size: int | None = None,
+    parse_prefetch: int = 1,
+    write_concurrency: int = 1,
+    download_parts: int = 4,
+    download_cache: str | None = None,
+    token_cache: TokenCacheMode = "memory",
+    storage: Storage = "table",
+    load: LoadStrategy = "merge",
+    spatial_index: SpatialIndex = "gist",
+    atomic: bool = False,
+    snapshot_cache: str | None = None,
+    metrics_export: MetricsExport | None = None,
+    bbox: list[float] | None = None,
+    bbox_crs: str = "EPSG:3006",
+    columns: list[str] | None = None,
+    layers: list[str] | None = None,
+):
+    from reality_synchronization.sync import SyncJob, SyncOptions, Synchronizer
+    from reality_synchronization.util.load_remote_zip import Subset
+
     item = Item.from_dict(item)
-    loader = LOADERS[item.collection_id]()
+    loader = get_loader(item.collection_id)
 
-    with connect_to_postgresql(database) as db:
+    with postgresql_connection(database) as db:
         create_metadata_table("data", db)
 
-        with oauth2_client(oauth_resource_id, loader.scope) as session:
-            data = loader.load(item, session)
-
-            for idx, (layer, df) in enumerate(data.layers.items()):
-                set_progress(int(50 + 50.0 * idx / len(data.layers)))
-                table = f"{item.collection_id}_{layer}"
-                if df.index is None or df.index.name is None:
-                    logger.info("Ignoring layer %s as it does not have a named index", layer)
-                else:
-                    logger.info("Writing %d rows to %s", len(df), table)
-                    if layer == "granspunkt":
-                        duplicates = df.index.duplicated()
-                        if duplicates.any():
-                            df = df.reset_index().drop_duplicates(subset=["objektidentitet"]).set_index("objektidentitet")
-                            logger.warning("Layer %s had %d duplicates", layer, duplicates.sum())
-
-                    write_postgis(
-                        table,
-                        "data",
-                        "temporary_data",
-                        df,
-                        db,
-                        item.id,
-                    )
-
-                logger.info("Updating metadata for layer %s", layer)
-                upsert_metadata(
-                    table,
-                    f"{item.collection_id}/{layer}",
-                    layer,
-                    "Lantmäteriet",
-                    data.remote_updated,
-                    "data",
-                    item.self_href,
-                    db,
-                )
+        if incremental:
+            remote_updated = loader.last_updated(item)
+            if not stale_items("data", {item.self_href: remote_updated}, db):
+                logger.info("Item %s has not been updated since %s, skipping", item.id, remote_updated)
+                return dict(layers={}, changes={}, last_updated=remote_updated, skipped=True)
 
-            return dict(layers={k: len(v) for k, v in data.layers.items()}, last_updated=data.remote_updated)
+    options = SyncOptions(
+        zip_mode=zip_mode,
+        batch_size=batch_size,
+        parse_prefetch=parse_prefetch,
+        write_concurrency=write_concurrency,
+        download_parts=download_parts,
+        download_cache=download_cache,
+        storage=storage,
+        load=load,
+        spatial_index=spatial_index,
+        atomic=atomic,
+        snapshot_cache=snapshot_cache,
+        subset=Subset.from_params(bbox, bbox_crs, columns, layers),
+    )
+    pool = postgresql_pool(database)
+    with (
+        oauth2_client(oauth_resource_id, loader.scope, token_cache=token_cache) as session,
+        Synchronizer(
+            pool.getconn,
+            options,
+            lambda _, fraction: set_progress(int(100.0 * fraction)),
+            release=pool.putconn,
+        ) as synchronizer,
+    ):
+        (result,) = synchronizer.sync([SyncJob(loader, item, session)])
+        stats = synchronizer.stats.summary()
+        logger.info("Stage stats: %s", stats)
+        return dict(
+            layers=result["layers"],
+            changes=result["changes"],
+            last_updated=result["last_updated"],
+            timings=synchronizer.stats.as_dict(),
+            stats=stats,
+            **export_stats(synchronizer.stats, metrics_export, dict(collection=item.collection_id, item=item.id)),
+        )
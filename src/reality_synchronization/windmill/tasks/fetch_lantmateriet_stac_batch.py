@@ -0,0 +1,123 @@
+import logging
+from contextlib import ExitStack
+
+from pystac import Item
+from requests import Session
+from wmill import set_progress
+
+from reality_synchronization.options import LoadStrategy, SpatialIndex, Storage, ZipMode
+from reality_synchronization.sinks.metadata import create_metadata_table, stale_items
+from reality_synchronization.sources import get_loader
+from reality_synchronization.sources.lantmateriet import STAC_URL
+from reality_synchronization.util.stac import list_items
+from reality_synchronization.windmill import (
+    MetricsExport,
+    TokenCacheMode,
+    export_stats,
+    oauth2_client,
+    postgresql,
+    postgresql_connection,
+    postgresql_pool,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def fetch_lantmateriet_stac_batch(
+    database: postgresql,
+    oauth_resource_id: str,
+    items: list[dict] | None = None,
+    collection: str | None = None,
+    item_ids: list[str] | None = None,
+    incremental: bool = False,
+    zip_mode: ZipMode = "vsizip",
+    batch_size: int | None = None,
+    download_prefetch: int = 1,
+    parse_prefetch: int = 1,
+    write_concurrency: int = 1,
+    download_parts: int = 4,
+    download_cache: str | None = None,
+    token_cache: TokenCacheMode = "memory",
+    storage: Storage = "table",
+    load: LoadStrategy = "merge",
+    spatial_index: SpatialIndex = "gist",
+    atomic: bool = False,
+    snapshot_cache: str | None = None,
+    metrics_export: MetricsExport | None = None,
+    bbox: list[float] | None = None,
+    bbox_crs: str = "EPSG:3006",
+    columns: list[str] | None = None,
+    layers: list[str] | None = None,
+):
+    # Synchronizes several items in one job, either the given items or the items of a collection (optionally only
+    # those in item_ids), sharing OAuth sessions and database connections between them
+    from reality_synchronization.sync import SyncJob, SyncOptions, Synchronizer
+    from reality_synchronization.util.load_remote_zip import Subset
+
+    if items is not None:
+        stac_items = [Item.from_dict(item) for item in items]
+    elif collection is not None:
+        stac_items = list_items(STAC_URL, collection, item_ids)
+    else:
+        raise ValueError("Either items or collection must be given")
+    subset = Subset.from_params(bbox, bbox_crs, columns, layers)
+    if subset is not None:
+        # Items entirely outside the bbox are not downloaded at all
+        listed = len(stac_items)
+        stac_items = [item for item in stac_items if subset.intersects(item.bbox)]
+        logger.info("Skipping %d items outside the bbox", listed - len(stac_items))
+    loaders = {collection_id: get_loader(collection_id) for collection_id in {item.collection_id for item in stac_items}}
+
+    with postgresql_connection(database) as db:
+        create_metadata_table("data", db)
+
+        skipped = []
+        if incremental:
+            remote_updated = {item.self_href: loaders[item.collection_id].last_updated(item) for item in stac_items}
+            stale = set(stale_items("data", remote_updated, db))
+            skipped = [item.id for item in stac_items if item.self_href not in stale]
+            stac_items = [item for item in stac_items if item.self_href in stale]
+            logger.info("Skipping %d items that have not been updated", len(skipped))
+
+    options = SyncOptions(
+        zip_mode=zip_mode,
+        batch_size=batch_size,
+        download_prefetch=download_prefetch,
+        parse_prefetch=parse_prefetch,
+        write_concurrency=write_concurrency,
+        download_parts=download_parts,
+        download_cache=download_cache,
+        storage=storage,
+        load=load,
+        spatial_index=spatial_index,
+        atomic=atomic,
+        snapshot_cache=snapshot_cache,
+        subset=subset,
+    )
+    results = []
+    pool = postgresql_pool(database)
+    with (
+        ExitStack() as stack,
+        Synchronizer(pool.getconn, options, release=pool.putconn) as synchronizer,
+    ):
+        # One session, and thereby one token, per scope for the whole batch
+        sessions: dict[str | None, Session] = {
+            scope: stack.enter_context(oauth2_client(oauth_resource_id, scope, token_cache=token_cache))
+            for scope in {loaders[item.collection_id].scope for item in stac_items}
+        }
+        jobs = [
+            SyncJob(loaders[item.collection_id], item, sessions[loaders[item.collection_id].scope])
+            for item in stac_items
+        ]
+        for result in synchronizer.sync(jobs, isolate_failures=True):
+            results.append(result)
+            set_progress(int(100.0 * len(results) / max(len(stac_items), 1)))
+
+        timings = synchronizer.stats.as_dict()
+        stats = synchronizer.stats.summary()
+        logger.info("Stage stats: %s", stats)
+        exported = export_stats(synchronizer.stats, metrics_export, dict(collection=collection) if collection else {})
+
+    failed = [result["item"] for result in results if "error" in result]
+    logger.info("Synchronized %d items, %d failed", len(results) - len(failed), len(failed))
+    return dict(items=results, failed=failed, skipped=skipped, timings=timings, stats=stats, **exported)
@@ -1,33 +1,168 @@
+import json
 import logging
+import time
+from datetime import datetime, timedelta
+from typing import Any, Iterator, Literal
+
+from psycopg.types.json import Jsonb
 from pypgstac.db import PgstacDB
 from pypgstac.load import Loader, Methods
 from pypgstac.migrate import Migrate
 from pystac_client import Client
-from typing import Literal
+from pystac_client.conformance import ConformanceClasses
 from wmill import set_progress
 
-from reality_synchronization.windmill import postgresql
+from reality_synchronization.util import HttpxStacApiIO
+from reality_synchronization.util.pipeline import StageTimings, prefetch
+from reality_synchronization.windmill import postgresql, postgresql_pool
 
 logger = logging.getLogger(__name__)
 
+CHECKPOINT_TABLE = "public.lantmateriet_stac_checkpoint"
+
+
+def _collection_id(collection: str) -> str:
+    return "lantmateriet/" + collection.replace("orto-", "orto/")
+
+
+def _next_link(page: dict[str, Any], body: dict[str, Any] | None) -> dict[str, Any] | None:
+    link = next((link for link in page.get("links", []) if link["rel"] == "next"), None)
+    if link is None:
+        return None
+    method = link.get("method", "GET")
+    next_body = link.get("body")
+    if method == "POST" and link.get("merge", False):
+        next_body = {**(body or {}), **(next_body or {})}
+    return dict(method=method, href=link["href"], headers=link.get("headers"), body=next_body)
+
+
+def _pages(stac_io: HttpxStacApiIO, link: dict[str, Any]) -> Iterator[tuple[dict[str, Any], dict[str, Any] | None]]:
+    # Follows the next links like StacApiIO.get_pages, but also yields the link to the following page so that it can
+    # be stored as a checkpoint
+    while True:
+        page = json.loads(stac_io.request(link["href"], link["method"], link.get("headers"), link.get("body")))
+        next_link = _next_link(page, link.get("body")) if page.get("features") else None
+        yield page, next_link
+        if next_link is None:
+            return
+        link = next_link
+
+
+def _last_updated(collections: list[str], db: PgstacDB) -> dict[str, datetime]:
+    rows = db.connect().execute(
+        """
+        SELECT collection, max((content->'properties'->>'updated')::timestamptz)
+        FROM pgstac.items
+        WHERE collection = ANY(%s)
+        GROUP BY collection""",
+        (collections,),
+    )
+    return {collection: updated for collection, updated in rows if updated is not None}
+
+
+def _updated_filter(remote_ids: dict[str, str], since: dict[str, datetime]) -> dict[str, Any]:
+    # Items of collections that have been harvested before and changed since then, and all items of the other
+    # collections
+    return {
+        "op": "or",
+        "args": [
+            {
+                "op": "and",
+                "args": [
+                    {"op": "=", "args": [{"property": "collection"}, remote_id]},
+                    {"op": ">=", "args": [{"property": "updated"}, {"timestamp": since[collection].isoformat()}]},
+                ],
+            }
+            if collection in since
+            else {"op": "=", "args": [{"property": "collection"}, remote_id]}
+            for collection, remote_id in remote_ids.items()
+        ],
+    }
+
+
+def _delete_removed_items(client: Client, remote_ids: dict[str, str], db: PgstacDB) -> dict[str, int]:
+    # Compares the item ids of every collection with those in pgstac and deletes the items that no longer exist
+    fields = {"include": ["id"], "exclude": ["geometry", "bbox", "properties", "assets", "links"]}
+    use_fields = client.conforms_to(ConformanceClasses.FIELDS)
+    connection = db.connect()
+    deleted = {}
+    for collection, remote_id in remote_ids.items():
+        search = client.search(collections=[remote_id], limit=10000, fields=fields if use_fields else None)
+        remote = {item["id"] for page in search.pages_as_dicts() for item in page.get("features", [])}
+        if not remote:
+            logger.warning("No items listed in %s, not deleting any", remote_id)
+            continue
+        local = {row[0] for row in connection.execute("SELECT id FROM pgstac.items WHERE collection = %s", (collection,))}
+        removed = list(local - remote)
+        if removed:
+            logger.info("Deleting %d items removed from %s", len(removed), remote_id)
+            connection.execute(
+                "DELETE FROM pgstac.items WHERE collection = %s AND id = ANY(%s)", (collection, removed)
+            )
+            if not connection.autocommit:
+                connection.commit()
+        deleted[collection] = len(removed)
+    return deleted
+
+
+def _create_checkpoint_table(db: PgstacDB) -> None:
+    db.connect().execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS {CHECKPOINT_TABLE} (
+            catalog TEXT NOT NULL PRIMARY KEY,
+            next JSONB NOT NULL,
+            items BIGINT NOT NULL,
+            updated_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()
+        )"""
+    )
+
+
+def _read_checkpoint(catalog: str, db: PgstacDB) -> tuple[dict[str, Any], int] | None:
+    row = db.connect().execute(f"SELECT next, items FROM {CHECKPOINT_TABLE} WHERE catalog = %s", (catalog,)).fetchone()
+    return (row[0], row[1]) if row is not None else None
+
+
+def _write_checkpoint(catalog: str, link: dict[str, Any] | None, items: int, db: PgstacDB) -> None:
+    connection = db.connect()
+    if link is None:
+        connection.execute(f"DELETE FROM {CHECKPOINT_TABLE} WHERE catalog = %s", (catalog,))
+    else:
+        connection.execute(
+            f"""
+            INSERT INTO {CHECKPOINT_TABLE} (catalog, next, items) VALUES (%s, %s, %s)
+            ON CONFLICT (catalog) DO UPDATE SET next = EXCLUDED.next, items = EXCLUDED.items, updated_at = now()""",
+            (catalog, Jsonb(link), items),
+        )
+    if not connection.autocommit:
+        connection.commit()
+
 
 def fetch_lantmateriet_stac_items(
-        catalog: Literal["bild", "hojd", "vektor"], database: postgresql
+        catalog: Literal["bild", "hojd", "vektor"],
+        database: postgresql,
+        batch_size: int = 50000,
+        prefetch_pages: int = 2,
+        resume: bool = True,
+        incremental: bool = False,
+        overlap_hours: float = 24.0,
 ):
-    client = Client.open(f"https://api.lantmateriet.se/stac-{catalog}/v1/")
+    # Pages are fetched up to prefetch_pages ahead of the ingest and loaded in batches of at least batch_size items.
+    # After every batch the link to the next page is stored, so that a failed run continues from the last loaded batch.
+    # In incremental mode only items updated since the last harvest (minus overlap_hours) are fetched, and items that
+    # have been removed from the catalog are found by comparing item ids.
+    stac_io = HttpxStacApiIO()
+    client = Client.open(f"https://api.lantmateriet.se/stac-{catalog}/v1/", stac_io=stac_io)
 
     logger.info("Preparing database")
-    db = PgstacDB(
-        dsn=f"postgresql://{database['user']}:{database['password']}@{database['host']}:{database.get('port', 5432)}/{database['dbname']}")
+    db = PgstacDB(pool=postgresql_pool(database))
     Migrate(db).run_migration()
 
     loader = Loader(db)
 
     logger.info("Downloading collections")
-    collections = [
-        {**c.to_dict(), "id": "lantmateriet/" + c.id.replace("orto-", "orto/")}
-        for c in client.get_collections()
-    ]
+    remote_collections = list(client.get_collections())
+    remote_ids = {_collection_id(c.id): c.id for c in remote_collections}
+    collections = [{**c.to_dict(), "id": _collection_id(c.id)} for c in remote_collections]
 
     set_progress(10)
 
@@ -36,19 +171,71 @@ def fetch_lantmateriet_stac_items(
 
     set_progress(20)
 
-    logger.info("Downloading items")
+    timings = StageTimings()
     with db as db:
         db.connection.add_notice_handler(lambda a: logger.info(repr(a)))
-        for idx, page in enumerate(client.search(limit=10000).pages_as_dicts()):
-            logger.info("Processing page %s", idx)
-            items = [
-                {
-                    **i,
-                    "collection": "lantmateriet/" + i["collection"].replace("orto-", "orto/")
+        _create_checkpoint_table(db)
+
+        checkpoint = _read_checkpoint(catalog, db) if resume else None
+        if checkpoint is not None:
+            link, loaded = checkpoint
+            logger.info("Resuming after %d items from %s", loaded, link["href"])
+        else:
+            search_filter = None
+            if incremental and not client.conforms_to(ConformanceClasses.FILTER):
+                logger.warning("The API does not support filtering, harvesting all items")
+            elif incremental:
+                since = {
+                    collection: updated - timedelta(hours=overlap_hours)
+                    for collection, updated in _last_updated(list(remote_ids), db).items()
                 }
+                logger.info("Harvesting items updated since %s", {c: t.isoformat() for c, t in since.items()})
+                search_filter = _updated_filter(remote_ids, since)
+            search = client.search(limit=10000, filter=search_filter, filter_lang="cql2-json" if search_filter else None)
+            link = dict(method=search.method, href=search.url, headers=None, body=search.get_parameters())
+            loaded = 0
+
+        logger.info("Downloading items")
+        resumed = loaded
+        start = time.perf_counter()
+        matched: int | None = None
+        items: list[dict[str, Any]] = []
+        for idx, (page, next_link) in enumerate(prefetch(timings.timed("fetch", _pages(stac_io, link)), prefetch_pages)):
+            matched = page.get("numberMatched", matched)
+            items.extend(
+                {**i, "collection": _collection_id(i["collection"])}
                 for i in page.get("features", [])
-            ]
-            loader.load_items(items, Methods.upsert)
-        db.connection.commit()
+            )
+            if len(items) < batch_size and next_link is not None:
+                continue
+
+            with timings.stage("load"):
+                loader.load_items(iter(items), Methods.upsert, chunksize=max(len(items), 1))
+                loaded += len(items)
+                _write_checkpoint(catalog, next_link, loaded, db)
+            elapsed = time.perf_counter() - start
+            logger.info(
+                "Loaded %d items after %d pages (%.0f items/s, fetch %.1f s, load %.1f s)",
+                loaded,
+                idx + 1,
+                (loaded - resumed) / elapsed,
+                timings.seconds["fetch"],
+                timings.seconds["load"],
+            )
+            if matched:
+                set_progress(min(int(20 + 80.0 * loaded / matched), 99))
+            items = []
+
+        deleted = _delete_removed_items(client, remote_ids, db) if incremental else {}
 
-    return dict(collections=collections)
+    elapsed = time.perf_counter() - start
+    logger.info("Stage timings: %s", timings.as_dict())
+    return dict(
+        collections=collections,
+        items=loaded - resumed,
+        resumed_after=resumed,
+        deleted=deleted,
+        seconds=round(elapsed, 3),
+        items_per_second=round((loaded - resumed) / elapsed, 1) if elapsed > 0 else None,
+        timings=timings.as_dict(),
+    )
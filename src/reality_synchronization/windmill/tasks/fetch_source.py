@@ -0,0 +1,101 @@
+import logging
+
+import requests
+from wmill import set_progress
+
+from reality_synchronization.options import LoadStrategy, SpatialIndex, Storage, ZipMode
+from reality_synchronization.sinks.metadata import create_metadata_table, stale_items
+from reality_synchronization.sources import get_loader
+from reality_synchronization.windmill import (
+    MetricsExport,
+    TokenCacheMode,
+    export_stats,
+    oauth2_client,
+    postgresql,
+    postgresql_connection,
+    postgresql_pool,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def fetch_source(
+    source: str,
+    database: postgresql,
+    subdivision: str,
+    oauth_resource_id: str | None = None,
+    incremental: bool = False,
+    zip_mode: ZipMode = "vsizip",
+    batch_size: int | None = None,
+    parse_prefetch: int = 1,
+    write_concurrency: int = 1,
+    download_parts: int = 4,
+    download_cache: str | None = None,
+    token_cache: TokenCacheMode = "memory",
+    storage: Storage = "table",
+    load: LoadStrategy = "merge",
+    spatial_index: SpatialIndex = "gist",
+    atomic: bool = False,
+    snapshot_cache: str | None = None,
+    metrics_export: MetricsExport | None = None,
+    bbox: list[float] | None = None,
+    bbox_crs: str = "EPSG:3006",
+    columns: list[str] | None = None,
+    layers: list[str] | None = None,
+):
+    # Synchronizes one subdivision of any registered source (see reality_synchronization.sources.SOURCES), e.g.
+    # source="smhi-aro", subdivision="svar2022". Sources that do not need a token are fetched without
+    # oauth_resource_id.
+    from reality_synchronization.sync import SyncJob, SyncOptions, Synchronizer
+    from reality_synchronization.util.load_remote_zip import Subset
+
+    loader = get_loader(source)
+    session = (
+        oauth2_client(oauth_resource_id, loader.scope, token_cache=token_cache)
+        if oauth_resource_id is not None
+        else requests.Session()
+    )
+    with session:
+        item = loader.item(subdivision, session)
+
+        with postgresql_connection(database) as db:
+            create_metadata_table("data", db)
+
+            if incremental:
+                remote_updated = loader.last_updated(item)
+                if not stale_items("data", {item.self_href: remote_updated}, db):
+                    logger.info("%s %s has not been updated since %s, skipping", source, subdivision, remote_updated)
+                    return dict(layers={}, changes={}, last_updated=remote_updated, skipped=True)
+
+        options = SyncOptions(
+            zip_mode=zip_mode,
+            batch_size=batch_size,
+            parse_prefetch=parse_prefetch,
+            write_concurrency=write_concurrency,
+            download_parts=download_parts,
+            download_cache=download_cache,
+            storage=storage,
+            load=load,
+            spatial_index=spatial_index,
+            atomic=atomic,
+            snapshot_cache=snapshot_cache,
+            subset=Subset.from_params(bbox, bbox_crs, columns, layers),
+        )
+        pool = postgresql_pool(database)
+        with Synchronizer(
+            pool.getconn,
+            options,
+            lambda _, fraction: set_progress(int(100.0 * fraction)),
+            release=pool.putconn,
+        ) as synchronizer:
+            (result,) = synchronizer.sync([SyncJob(loader, item, session)])
+            stats = synchronizer.stats.summary()
+            logger.info("Stage stats: %s", stats)
+            return dict(
+                layers=result["layers"],
+                changes=result["changes"],
+                last_updated=result["last_updated"],
+                timings=synchronizer.stats.as_dict(),
+                stats=stats,
+                **export_stats(synchronizer.stats, metrics_export, dict(collection=source, item=item.id)),
+            )
@@ -0,0 +1,22 @@
+import logging
+
+from reality_synchronization.sinks.metadata import create_metadata_table, stale_items
+from reality_synchronization.sources.lantmateriet import STAC_URL
+from reality_synchronization.util.stac import stac_client
+from reality_synchronization.windmill import postgresql_connection, postgresql
+
+logger = logging.getLogger(__name__)
+
+
+def plan_lantmateriet_stac(collection: str, database: postgresql) -> list[dict]:
+    client = stac_client(STAC_URL)
+
+    logger.info("Listing items in %s", collection)
+    items = {item.self_href: item for item in client.get_collection(collection).get_items()}
+
+    with postgresql_connection(database) as db:
+        create_metadata_table("data", db)
+        stale = stale_items("data", {href: item.common_metadata.updated for href, item in items.items()}, db)
+
+    logger.info("%d of %d items in %s need to be loaded", len(stale), len(items), collection)
+    return [items[href].to_dict() for href in stale]
@@ -0,0 +1,88 @@
+import logging
+from contextlib import ExitStack
+
+from pystac import Item
+from requests import Session
+from wmill import set_progress
+
+from reality_synchronization.options import ZipMode
+from reality_synchronization.sources import get_loader
+from reality_synchronization.sources.lantmateriet import STAC_URL
+from reality_synchronization.util.pipeline import PipelineStats
+from reality_synchronization.util.stac import list_items
+from reality_synchronization.windmill import TokenCacheMode, oauth2_client
+
+logger = logging.getLogger(__name__)
+
+
+def warm_lantmateriet_snapshots(
+    oauth_resource_id: str,
+    snapshot_cache: str,
+    items: list[dict] | None = None,
+    collection: str | None = None,
+    item_ids: list[str] | None = None,
+    snapshot_cache_size: int = 50 << 30,
+    zip_mode: ZipMode = "vsizip",
+    batch_size: int | None = None,
+    download_prefetch: int = 1,
+    download_parts: int = 4,
+    download_cache: str | None = None,
+    token_cache: TokenCacheMode = "memory",
+    bbox: list[float] | None = None,
+    bbox_crs: str = "EPSG:3006",
+    columns: list[str] | None = None,
+    layers: list[str] | None = None,
+):
+    # Downloads and parses items into the snapshot cache ahead of the jobs that load them, which then only read the
+    # snapshots. Snapshots written with batch_size can be loaded with or without it.
+    from reality_synchronization.sync import SyncJob, SyncOptions, warm_snapshots
+    from reality_synchronization.util.load_remote_zip import Subset
+
+    if items is not None:
+        stac_items = [Item.from_dict(item) for item in items]
+    elif collection is not None:
+        stac_items = list_items(STAC_URL, collection, item_ids)
+    else:
+        raise ValueError("Either items or collection must be given")
+    subset = Subset.from_params(bbox, bbox_crs, columns, layers)
+    if subset is not None:
+        # Items entirely outside the bbox are not downloaded at all
+        listed = len(stac_items)
+        stac_items = [item for item in stac_items if subset.intersects(item.bbox)]
+        logger.info("Skipping %d items outside the bbox", listed - len(stac_items))
+    loaders = {collection_id: get_loader(collection_id) for collection_id in {item.collection_id for item in stac_items}}
+
+    options = SyncOptions(
+        zip_mode=zip_mode,
+        batch_size=batch_size,
+        download_prefetch=download_prefetch,
+        download_parts=download_parts,
+        download_cache=download_cache,
+        snapshot_cache=snapshot_cache,
+        snapshot_cache_size=snapshot_cache_size,
+        subset=subset,
+    )
+    stats = PipelineStats()
+    results = []
+    with ExitStack() as stack:
+        sessions: dict[str | None, Session] = {
+            scope: stack.enter_context(oauth2_client(oauth_resource_id, scope, token_cache=token_cache))
+            for scope in {loaders[item.collection_id].scope for item in stac_items}
+        }
+        jobs = [
+            SyncJob(loaders[item.collection_id], item, sessions[loaders[item.collection_id].scope])
+            for item in stac_items
+        ]
+        for result in warm_snapshots(jobs, options, stats):
+            results.append(result)
+            set_progress(int(100.0 * len(results) / max(len(stac_items), 1)))
+
+    failed = [result["item"] for result in results if "error" in result]
+    skipped = [result["item"] for result in results if result.get("skipped")]
+    logger.info(
+        "Snapshotted %d items, %d failed and %d were skipped",
+        len(results) - len(failed) - len(skipped),
+        len(failed),
+        len(skipped),
+    )
+    return dict(items=results, failed=failed, skipped=skipped, stats=stats.summary())
@@ -0,0 +1,171 @@
+import hashlib
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from reality_synchronization.util import download as download_module
+from reality_synchronization.util.download import DownloadCache, download, parse_checksum
+
+# Four chunks, so that a response ending half way through has delivered whole chunks
+DATA = bytes(range(256)) * (4 * download_module._CHUNK_SIZE // 256)
+
+
+def _multihash(data: bytes) -> str:
+    return "1220" + hashlib.sha256(data).hexdigest()
+
+
+def test_parse_checksum():
+    digest = hashlib.sha256(DATA).hexdigest()
+    assert parse_checksum("1220" + digest) == ("sha256", digest)
+    # Codes from 0x80 take two bytes
+    assert parse_checksum("d50110" + hashlib.md5(DATA).hexdigest()) == ("md5", hashlib.md5(DATA).hexdigest())
+
+
+@pytest.mark.parametrize(
+    "checksum",
+    [
+        "not hex",
+        "",
+        # Digest shorter than its length says
+        "1220" + "00" * 31,
+        # Unsupported hash function
+        "1b20" + "00" * 32,
+    ],
+)
+def test_parse_checksum_ignores_unusable_checksums(checksum):
+    assert parse_checksum(checksum) is None
+
+
+def _put(cache: DownloadCache, key: str, size: int, mtime: float) -> None:
+    path = cache.path(key, ".zip")
+    path.write_bytes(b"x" * size)
+    os.utime(path, (mtime, mtime))
+
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    cache = DownloadCache(tmp_path, max_bytes=250)
+    for idx, key in enumerate(["a", "b", "c"]):
+        _put(cache, key, 100, 1000 + idx)
+    with cache.use("a", ".zip") as path:
+        # Using a file makes it the most recently used
+        assert path == cache.path("a", ".zip")
+    cache.evict()
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["a.zip", "c.zip"]
+
+
+def test_cache_keeps_files_in_use_and_being_written(tmp_path):
+    cache = DownloadCache(tmp_path, max_bytes=0)
+    _put(cache, "a", 100, 1000)
+    _put(cache, "b", 100, 1000)
+    cache.partial("c").write_bytes(b"x" * 100)
+    with cache.use("a", ".zip"), cache.lock("c"):
+        cache.evict()
+        assert sorted(path.name for path in tmp_path.iterdir()) == ["a.zip", "c.lock", "c.partial"]
+    cache.evict()
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["c.lock"]
+
+
+class _Server(ThreadingHTTPServer):
+    # Serves DATA with range requests, failing the first requests in the ways listed in failures
+    def __init__(self, failures: list[str]):
+        super().__init__(("127.0.0.1", 0), _Handler)
+        self.failures = failures
+        self.ranges: list[str | None] = []
+        self.lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/data.zip"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server: _Server
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        range_header = self.headers.get("Range")
+        with self.server.lock:
+            self.server.ranges.append(range_header)
+            # The probe of a single byte never fails
+            failure = self.server.failures.pop(0) if self.server.failures and range_header != "bytes=0-0" else None
+        if failure == "error":
+            self.send_error(503)
+            return
+        start, end = 0, len(DATA) - 1
+        if range_header is not None:
+            first, last = range_header.removeprefix("bytes=").split("-")
+            start, end = int(first), int(last) if last else len(DATA) - 1
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(DATA)}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("ETag", '"1"')
+        self.end_headers()
+        body = DATA[start : end + 1]
+        # A truncated response ends the connection half way through the body
+        self.wfile.write(body[: len(body) // 2] if failure == "truncate" else body)
+
+
+@pytest.fixture
+def server(request):
+    server = _Server(list(getattr(request, "param", [])))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(download_module.time, "sleep", sleeps.append)
+    return sleeps
+
+
+@pytest.mark.parametrize("server", [["truncate", "error", "truncate"]], indirect=True)
+def test_download_resumes_with_backoff(server, sleeps):
+    with requests.Session() as session, download(server.url, session, _multihash(DATA), parts=1) as path:
+        assert path.read_bytes() == DATA
+    assert sleeps == [2, 4, 8]
+    # Every retry continues after the bytes that were already received
+    offsets = [int(header.removeprefix("bytes=").split("-")[0]) for header in server.ranges[1:]]
+    assert offsets == [0, len(DATA) // 2, len(DATA) // 2, len(DATA) * 3 // 4]
+
+
+@pytest.mark.parametrize("server", [["error"] * 3], indirect=True)
+def test_download_gives_up_after_retries(server, sleeps):
+    with requests.Session() as session, pytest.raises(requests.HTTPError):
+        with download(server.url, session, parts=1, retries=2):
+            pass
+    assert sleeps == [2, 4]
+
+
+def test_download_in_parts_into_the_cache(server, sleeps, tmp_path, monkeypatch):
+    monkeypatch.setattr(download_module, "_MIN_PART_SIZE", len(DATA) // 4)
+    cache = DownloadCache(tmp_path, 1 << 30)
+    with requests.Session() as session:
+        with download(server.url, session, _multihash(DATA), cache, parts=4) as path:
+            assert path.read_bytes() == DATA
+            assert path.suffix == ".zip"
+        requests_made = len(server.ranges)
+        with download(server.url, session, _multihash(DATA), cache) as cached:
+            assert cached == path
+    # The probe and four parts, and then only the probe
+    assert requests_made == 5
+    assert len(server.ranges) == 6
+    assert not cache.partial(DownloadCache.key(server.url, '"1"')).exists()
+
+
+def test_download_rejects_checksum_mismatch(server, tmp_path):
+    cache = DownloadCache(tmp_path, 1 << 30)
+    with requests.Session() as session, pytest.raises(IOError, match="Checksum mismatch"):
+        with download(server.url, session, _multihash(b"other"), cache):
+            pass
+    assert [path.suffix for path in tmp_path.iterdir()] == [".lock"]
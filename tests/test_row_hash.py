@@ -0,0 +1,56 @@
+import numpy as np
+import pandas as pd
+import pytest
+import shapely
+from geopandas import GeoDataFrame
+
+from reality_synchronization.sinks.postgis import row_hash
+
+
+def _hash(values, dtype=None) -> list[int]:
+    return row_hash(pd.DataFrame({"value": pd.Series(values, dtype=dtype)}).rename_axis("id")).tolist()
+
+
+@pytest.mark.parametrize(
+    "values, dtypes",
+    [
+        ([1, 2, None], ["float64", "Int64", "object", "int64[pyarrow]"]),
+        ([1.5, None, 3.0], ["float64", "Float64", "object"]),
+        ([True, False, None], ["boolean", "object", "bool[pyarrow]"]),
+        (["a", None, "c"], ["object", "string", "string[pyarrow]"]),
+    ],
+)
+def test_same_values_hash_the_same_whatever_the_dtype(values, dtypes):
+    hashes = [_hash(values, dtype) for dtype in dtypes]
+    assert all(h == hashes[0] for h in hashes)
+
+
+def test_whole_numbers_hash_like_nullable_ones():
+    assert _hash([1, 2, 3], "int64") == _hash([1, 2, 3], "Int64")
+    assert _hash([True, False], "bool") == _hash([True, False], "boolean")
+
+
+def test_timestamps_hash_the_same_with_and_without_time_zone():
+    naive = pd.Series(pd.to_datetime(["2024-01-01 12:00", "2024-06-01 00:30"]))
+    assert _hash(naive) == _hash(naive.dt.tz_localize("UTC"))
+    assert _hash(naive) == _hash(naive.astype("datetime64[us]"))
+
+
+def test_hash_changes_with_values_and_index():
+    df = pd.DataFrame({"a": [1, 2], "b": ["x", "y"]}).rename_axis("id")
+    hashes = row_hash(df)
+    assert hashes.name == "_hash"
+    assert hashes.dtype == np.int64
+    changed = row_hash(df.assign(b=["x", "z"]))
+    assert changed[0] == hashes[0]
+    assert changed[1] != hashes[1]
+    moved = row_hash(df.set_axis([5, 6]).rename_axis("id"))
+    assert (moved.to_numpy() != hashes.to_numpy()).all()
+
+
+def test_geometries_are_hashed_by_their_coordinates():
+    df = GeoDataFrame({"a": [1, 2]}, geometry=[shapely.Point(0, 0), shapely.Point(1, 1)], crs=3006)
+    moved = df.set_geometry([shapely.Point(0, 0), shapely.Point(1, 2)], crs=3006)
+    assert row_hash(df).tolist() == row_hash(df.copy()).tolist()
+    assert row_hash(moved)[0] == row_hash(df)[0]
+    assert row_hash(moved)[1] != row_hash(df)[1]
@@ -0,0 +1,39 @@
+import pytest
+
+from reality_synchronization.util.load_remote_zip import Subset
+
+
+def test_from_params_without_restrictions_is_none():
+    assert Subset.from_params(None, "EPSG:3006", None, None) is None
+
+
+def test_from_params_converts_lists_to_tuples():
+    subset = Subset.from_params([1, 2, 3, 4], "EPSG:3006", ["a", "b"], ["byggnad"])
+    assert subset == Subset((1, 2, 3, 4), "EPSG:3006", ("a", "b"), ("byggnad",))
+    assert Subset.from_params(None, "EPSG:3006", None, ["byggnad"]) == Subset(layers=("byggnad",))
+
+
+def test_from_params_rejects_malformed_bbox():
+    with pytest.raises(ValueError):
+        Subset.from_params([1, 2, 3], "EPSG:3006", None, None)
+
+
+def test_key_ignores_order_of_columns_and_layers():
+    assert Subset(columns=("a", "b"), layers=("x", "y")).key() == Subset(columns=("b", "a"), layers=("y", "x")).key()
+    assert Subset(columns=("a",)).key() != Subset(columns=("a", "b")).key()
+    assert Subset(bbox=(0, 0, 1, 1)).key() != Subset(bbox=(0, 0, 1, 1), crs="EPSG:4326").key()
+
+
+def test_with_columns_adds_columns_only_when_restricted():
+    assert Subset(layers=("x",)).with_columns(("id",)) == Subset(layers=("x",))
+    assert Subset(columns=("a", "id")).with_columns(("id", "b")).columns == ("a", "id", "b")
+
+
+def test_intersects_compares_in_the_crs_of_the_item():
+    # Around Stockholm in SWEREF 99 TM
+    subset = Subset(bbox=(670000, 6570000, 680000, 6585000))
+    assert subset.intersects([17.9, 59.2, 18.2, 59.4])
+    assert subset.intersects([17.9, 59.2, 0, 18.2, 59.4, 100])
+    assert not subset.intersects([11.9, 57.6, 12.1, 57.8])
+    assert subset.intersects(None)
+    assert Subset(layers=("x",)).intersects([11.9, 57.6, 12.1, 57.8])
@@ -0,0 +1,88 @@
+import io
+import json
+import stat
+import time
+
+import pytest
+import requests
+
+from reality_synchronization import TOKEN_EXPIRY_MARGIN, FileTokenCache, OAuth2ClientCredentialsSession, TokenCache
+
+
+@pytest.fixture
+def fetched(monkeypatch):
+    # Tokens handed out by the token endpoint, numbered in order
+    fetched = []
+
+    def fetch_token(self):
+        fetched.append(f"token-{len(fetched)}")
+        return dict(access_token=fetched[-1], expires_at=time.time() + 3600)
+
+    monkeypatch.setattr(OAuth2ClientCredentialsSession, "_fetch_token", fetch_token)
+    return fetched
+
+
+def _session(cache: TokenCache, scope: str | None = "read") -> OAuth2ClientCredentialsSession:
+    return OAuth2ClientCredentialsSession("client", "secret", scope, "https://auth.example/token", cache)
+
+
+def test_sessions_share_tokens_through_the_cache(fetched):
+    cache = TokenCache()
+    assert _session(cache).token()["access_token"] == "token-0"
+    assert _session(cache).token()["access_token"] == "token-0"
+    # Another scope needs a token of its own
+    assert _session(cache, "write").token()["access_token"] == "token-1"
+    assert _session(TokenCache()).token()["access_token"] == "token-2"
+
+
+def test_expiring_tokens_are_renewed(fetched):
+    cache = TokenCache()
+    session = _session(cache)
+    session.token()
+    key = "https://auth.example/token client read"
+    cache.put(key, dict(access_token="old", expires_at=time.time() + TOKEN_EXPIRY_MARGIN / 2))
+    assert session.token()["access_token"] == "token-1"
+    assert session.headers["Authorization"] == "Bearer token-1"
+    assert session.token(renew=True)["access_token"] == "token-2"
+
+
+def test_rejected_token_is_renewed_once(fetched, monkeypatch):
+    statuses = [401, 200]
+    sent = []
+
+    def request(self, method, url, *args, **kwargs):
+        sent.append(self.headers["Authorization"])
+        response = requests.Response()
+        response.status_code = statuses.pop(0)
+        response.raw = io.BytesIO()
+        return response
+
+    monkeypatch.setattr(requests.Session, "request", request)
+    session = _session(TokenCache())
+    session.token()
+    assert session.request("GET", "https://api.example/").status_code == 200
+    assert sent == ["Bearer token-0", "Bearer token-1"]
+
+
+def test_file_cache_shares_tokens_between_processes(tmp_path):
+    path = tmp_path / "tokens.json"
+    token = dict(access_token="a", expires_at=time.time() + 3600)
+    FileTokenCache(path).put("key", token)
+    # A new cache, as a later process would create, reads the token from the file
+    assert FileTokenCache(path).get("key") == token
+    assert FileTokenCache(path).get("other") is None
+    assert stat.S_IMODE(path.stat().st_mode) == 0o600
+
+
+def test_file_cache_drops_expired_tokens(tmp_path):
+    path = tmp_path / "tokens.json"
+    cache = FileTokenCache(path)
+    cache.put("expired", dict(access_token="a", expires_at=time.time() - 1))
+    cache.put("valid", dict(access_token="b", expires_at=time.time() + 3600))
+    assert set(json.loads(path.read_text())) == {"valid"}
+
+
+def test_file_cache_ignores_unreadable_file(tmp_path):
+    path = tmp_path / "tokens.json"
+    path.write_text("not json")
+    assert FileTokenCache(path).get("key") is None
@@ -0,0 +1,87 @@
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+
+from reality_synchronization.util.wfs import _features, download_wfs, with_params
+
+
+class _Response:
+    def __init__(self, content: bytes):
+        self.content = content
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def raise_for_status(self):
+        pass
+
+
+class _Session:
+    # Pages of features numbered 0 to count - 1, with numberMatched unless matched is False
+    def __init__(self, count: int, matched: bool = True):
+        self.count = count
+        self.matched = matched
+        self.starts: list[int] = []
+        self._lock = threading.Lock()
+
+    def get(self, url: str) -> _Response:
+        query = parse_qs(urlsplit(url).query)
+        start, page_size = int(query["startIndex"][0]), int(query["count"][0])
+        with self._lock:
+            self.starts.append(start)
+        # Later pages answer sooner, so that the order they are written in is not the order they arrive in
+        time.sleep(0.001 * (self.count - start) / page_size)
+        page = dict(features=[dict(id=idx) for idx in range(start, min(start + page_size, self.count))])
+        if self.matched:
+            page["numberMatched"] = self.count
+        return _Response(json.dumps(page).encode())
+
+
+def _ids(session: _Session, **kwargs) -> list[int]:
+    with download_wfs("https://wfs.example/wfs?typeNames=byggnad", session, **kwargs) as path:
+        return [feature["id"] for feature in json.loads(path.read_text())["features"]]
+
+
+@pytest.mark.parametrize("count", [0, 1, 99, 100, 101, 1050])
+def test_pages_are_written_in_order(count):
+    session = _Session(count)
+    assert _ids(session, page_size=100, concurrency=3) == list(range(count))
+    assert sorted(session.starts) == list(range(0, max(count, 1), 100))
+
+
+@pytest.mark.parametrize("count", [0, 99, 100, 250])
+def test_pages_are_fetched_until_one_is_not_full_without_number_matched(count):
+    session = _Session(count, matched=False)
+    assert _ids(session, page_size=100) == list(range(count))
+    assert session.starts == list(range(0, count + 1, 100))
+
+
+def test_pages_are_fetched_at_most_a_window_ahead():
+    fetched = []
+
+    def page(start: int) -> dict:
+        fetched.append(start)
+        return dict(features=[dict(id=start)])
+
+    with ThreadPoolExecutor(2) as executor:
+        pages = _features(dict(features=[]), page, 100, 1, executor, window=4)
+        next(pages)
+        next(pages)
+        time.sleep(0.05)
+        # The page just written and the window after it
+        assert sorted(fetched) == [1, 2, 3, 4, 5]
+        assert [features[0]["id"] for features in pages] == list(range(2, 100))
+
+
+def test_with_params_replaces_parameters_case_insensitively():
+    url = "https://wfs.example/wfs?TYPENAMES=a&Count=5&srsName=EPSG:3006"
+    url = with_params(url, {"count": "10", "startIndex": "0"})
+    query = parse_qs(urlsplit(url).query)
+    assert query == dict(TYPENAMES=["a"], srsName=["EPSG:3006"], count=["10"], startIndex=["0"])